@@ -0,0 +1,90 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import cv2
+
+
+class BatchedInference:
+    """
+    Run a network for several streams at once.
+
+    Frames submitted through `infer` are gathered into one `blobFromImages` tensor and go through a single forward
+    pass, the detections are then split and handed back to the callers. A batch is run as soon as it is full or the
+    oldest frame in it has waited for `max_wait` seconds, so the latency added by batching stays bounded.
+    """
+
+    def __init__(self, model, scale_factor, size, mean, max_batch_size=8, max_wait=0.01):
+        """
+        :param model: `SharedModel` of the network, e.g. from `ModelRegistry.caffe_model`.
+        :param scale_factor: Scale factor passed to `blobFromImages`.
+        :param size: Input size of the network, (width, height).
+        :param mean: Mean subtracted by `blobFromImages`.
+        :param max_batch_size: Maximum number of frames in one forward pass.
+        :param max_wait: Maximum time in seconds a frame waits for the batch to fill.
+        """
+        self.model = model
+        self.scale_factor = scale_factor
+        self.size = size
+        self.mean = mean
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def infer(self, image):
+        """
+        Run the network on one image, blocks until the batch containing it is done.
+        :param image: Image in openCV format, resized to `size` by `blobFromImages`.
+        :return: Output of the network for this image, same layout as a forward pass on a batch of one.
+        """
+        future = Future()
+        self.requests.put((image, future))
+        return future.result()
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                blob = cv2.dnn.blobFromImages(
+                    [image for (image, _) in batch], self.scale_factor, self.size, self.mean
+                )
+                outputs = split_detections(self.model.forward(blob), len(batch))
+            except Exception as e:
+                for (_, future) in batch:
+                    future.set_exception(e)
+                continue
+
+            for ((_, future), output) in zip(batch, outputs):
+                future.set_result(output)
+
+
+def split_detections(output, batch_size):
+    """
+    Split the output of a forward pass on a batch into the outputs of each image.
+    :param output: Output of the network. `DetectionOutput` layers (SSD) put the detections of all the images in
+        one (1, 1, N, 7) array with the index of the image in the first column, other networks have one row per image.
+    :param batch_size: Number of images in the batch.
+    :return: List of outputs, each shaped like the output of a batch of one.
+    """
+    if batch_size == 1:
+        return [output]
+    if output.shape[0] == batch_size:
+        return [output[i:i + 1] for i in range(batch_size)]
+
+    image_ids = output[0, 0, :, 0]
+    return [output[:, :, image_ids == i, :] for i in range(batch_size)]
@@ -1,54 +1,322 @@
+from Metrics import metrics, MetricsPublisher
 from FrameProvider import *
 from FrameProcessor import *
+from FrameTransport import *
+from FrameScheduler import FrameScheduler, AdaptiveFrameScheduler
+from StagedPipeline import StagedPipeline
+from EventRecorder import EventRecorder
+from DetectionLog import DetectionLog
+from ProcessPool import FrameProcessPool, PooledCameraPipeline
+import time
 import redis
-import redis_lock
 import argparse
 
+
+def create_frame_provider(camera_mode, camera_source, **options):
+    """
+    Create the frame provider of a camera.
+    :param camera_mode: `queue`, `newest` or `fast`.
+    :param camera_source: `local` or url to the remote camera.
+    :param options: Extra keyword arguments of `FastFrameProvider`, e.g. `target_fps` and `max_width`.
+    :return: The frame provider.
+    """
+    use_local_camera = camera_source == 'local'
+    url = None if use_local_camera else camera_source
+
+    if camera_mode == 'queue':
+        return QueueFrameProvider(use_local_camera, url)
+    elif camera_mode == 'newest':
+        return NewestFrameProvider(use_local_camera, url)
+    elif camera_mode == 'fast':
+        return FastFrameProvider(use_local_camera, url, **options)
+    else:
+        raise ValueError(f'unknown camera mode: {camera_mode}')
+
+
+def create_batched_inference(process_method, max_batch_size=8, max_wait=0.01, backend=None):
+    """
+    Create an inference stage shared by the cameras using the same process method.
+    :param process_method: `ssd_obj` or `obj_tracker`.
+    :param max_batch_size: Maximum number of frames in one forward pass.
+    :param max_wait: Maximum time in seconds a frame waits for the batch to fill.
+    :param backend: Keyword arguments of `create_backend`, OpenCV DNN with its defaults if not set.
+    :return: The `BatchedInference`.
+    """
+    if process_method == 'ssd_obj':
+        return MobileNetSsdObjectDetectionFrameProcessor.create_batched_inference(
+            'net/MobileNetSsd.proto', 'net/MobileNetSsd.caffemodel', max_batch_size=max_batch_size,
+            max_wait=max_wait, backend=backend
+        )
+    elif process_method == 'obj_tracker':
+        return ObjectTrackerFrameProcessor.create_batched_inference(
+            'net/ObjectTracker.proto', 'net/ObjectTracker.caffemodel', max_batch_size=max_batch_size,
+            max_wait=max_wait, backend=backend
+        )
+    else:
+        raise ValueError(f'process method does not support batching: {process_method}')
+
+
+def create_frame_processor(process_method, frame_provider, batched_inference=None, **options):
+    """
+    Create the frame processor of a camera.
+    :param process_method: One of `abs_motion`, `rel_motion`, `darknet`, `ssd_obj` and `obj_tracker`. `darknet`
+        and `ssd_obj` can be prefixed with `gated_` to only run the detector where something moved.
+    :param frame_provider: Frame provider of the camera, `abs_motion` takes its first frame as the initial frame.
+    :param batched_inference: Inference stage from `create_batched_inference`, only for `ssd_obj` and `obj_tracker`.
+    :param options: Extra keyword arguments of the processor, e.g. `detect_every` of `obj_tracker`, `backend` of
+        the detectors or `process_width` of the motion processors.
+    :return: The frame processor.
+    """
+    if process_method in ('gated_darknet', 'gated_ssd_obj'):
+        # the motion stage is the one to shrink the frames, the detector keeps its own input size
+        gate_options = {name: options.pop(name) for name in ('process_width',) if name in options}
+        return MotionGatedFrameProcessor(
+            create_frame_processor(process_method[len('gated_'):], frame_provider, batched_inference, **options),
+            **gate_options
+        )
+    elif process_method == 'abs_motion':
+        return AbsoluteMotionDetectionFrameProcessor(frame_provider.next_frame(), **options)
+    elif process_method == 'rel_motion':
+        return RelativeMotionDetectionFrameProcessor(**options)
+    elif process_method == 'darknet':
+        # the full YOLO unless the camera picks another network, e.g. cfg/tiny-yolo.cfg
+        return DarknetObjectDetectionFrameProcessor(
+            options.pop('model', 'net/Yolo.cfg'), options.pop('weights', 'net/Yolo.weights'), 1.0, **options
+        )
+    elif process_method == 'ssd_obj':
+        return MobileNetSsdObjectDetectionFrameProcessor(
+            'net/MobileNetSsd.proto', 'net/MobileNetSsd.caffemodel', batched_inference=batched_inference, **options
+        )
+    elif process_method == 'obj_tracker':
+        return ObjectTrackerFrameProcessor(
+            'net/ObjectTracker.proto', 'net/ObjectTracker.caffemodel', batched_inference=batched_inference, **options
+        )
+    else:
+        raise ValueError(f'unknown process method: {process_method}')
+
+
+def create_frame_publisher(transport, redis_client, camera_id=None, locking=True, renditions=None, overlay=False):
+    """
+    Create the frame publisher of a camera.
+    :param transport: `redis` to publish JPEG frames in Redis, `shm` to share raw frames through shared memory.
+    :param redis_client: Connection to the Redis server.
+    :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+    :param locking: Whether `redis` takes a `redis_lock` around every frame.
+    :param renditions: List of `Rendition` published by `redis`, `shm` frames are encoded by the web server.
+    :param overlay: Whether the publisher draws the detections, see `overlay_targets`.
+    :return: The frame publisher.
+    """
+    if transport == 'redis':
+        return RedisFramePublisher(redis_client, frame_key(camera_id), locking, renditions, overlay)
+    elif transport == 'shm':
+        return SharedMemoryFramePublisher(shared_frame_path(camera_id), overlay=overlay)
+    else:
+        raise ValueError(f'unknown transport: {transport}')
+
+
+def overlay_targets(overlay):
+    """
+    Decide who draws the detections on the frames.
+    :param overlay: `processor` to draw them while processing, `encode` to draw them once before encoding, `client`
+        to leave the frames untouched and let the web page draw the published detections.
+    :return: (whether the processor draws, whether the publisher draws)
+    """
+    if overlay not in ('processor', 'encode', 'client'):
+        raise ValueError(f'unknown overlay: {overlay}')
+    return overlay == 'processor', overlay == 'encode'
+
+
+def parse_size(text):
+    """
+    :param text: Size as `<width>x<height>`, e.g. `416x416`.
+    :return: (width, height).
+    """
+    (width, height) = text.lower().split('x')
+    return int(width), int(height)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('camera_mode', metavar='camera_mode', type=str,
-                        help='< queue | newest >')
+                        help='< queue | newest | fast >')
     parser.add_argument('camera_source', metavar='camera_source', type=str,
                         help='< local | url_to_remote_camera >')
     parser.add_argument('process_method', metavar='process_method', type=str,
-                        help='< abs_motion | rel_motion | darknet | ssd_obj | obj_tracker >')
+                        help='< abs_motion | rel_motion | darknet | ssd_obj | obj_tracker | gated_darknet | '
+                             'gated_ssd_obj >')
+    parser.add_argument('--transport', type=str, default='redis',
+                        help='< redis | shm >, must match FRAME_TRANSPORT of the web server')
+    parser.add_argument('--lock-free', action='store_true',
+                        help='publish without redis_lock, FRAME_LOCKING of the web server must be False')
+    parser.add_argument('--detect-every', type=int, default=1,
+                        help='obj_tracker only: run the detector every N frames and track the boxes in between')
+    parser.add_argument('--min-change', type=float, default=None,
+                        help='skip publishing frames where less than this fraction of the pixels changed, '
+                             'only for abs_motion and rel_motion')
+    parser.add_argument('--target-fps', type=float, default=None,
+                        help='fast only: decode at most this many frames per second')
+    parser.add_argument('--max-width', type=int, default=None,
+                        help='fast only: shrink the frames to this width when decoding')
+    parser.add_argument('--process-width', type=int, default=None,
+                        help='look for motion on frames shrunk to this width, only for abs_motion, rel_motion and '
+                             'the gated_ methods')
+    parser.add_argument('--max-fps', type=float, default=None,
+                        help='process at most this many frames per second while something moves or is detected, '
+                             'and fewer while the scene is idle or nobody is watching')
+    parser.add_argument('--idle-fps', type=float, default=2.0,
+                        help='with --max-fps: frames per second while the scene is idle or nobody is watching')
+    parser.add_argument('--backend', type=str, default=None,
+                        help='< opencv | onnx >, run darknet, ssd_obj and obj_tracker through this inference backend, '
+                             'darknet runs in darkflow if not set')
+    parser.add_argument('--dnn-backend', type=str, default='default',
+                        help='opencv only: < default | opencv | openvino | cuda >')
+    parser.add_argument('--dnn-target', type=str, default='cpu',
+                        help='opencv only: < cpu | cpu_fp16 | opencl | opencl_fp16 | cuda | cuda_fp16 >')
+    parser.add_argument('--onnx-model', type=str, default=None,
+                        help='onnx only: path to the ONNX model, e.g. quantized with InferenceBackend.py')
+    parser.add_argument('--inference-threads', type=int, default=None,
+                        help='number of threads of the inference backend')
+    parser.add_argument('--model', type=str, default=None,
+                        help='darknet only: cfg of the network, e.g. cfg/tiny-yolo.cfg, net/Yolo.cfg if not set')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='darknet only: weights of the network, net/Yolo.weights if not set')
+    parser.add_argument('--input-size', type=parse_size, default=None,
+                        help='darknet only, with --backend: input size of the network, e.g. 320x320')
+    parser.add_argument('--latency-budget', type=float, default=None,
+                        help='darknet only: switch to the fallback network when detecting a frame takes longer than '
+                             'this many seconds on average')
+    parser.add_argument('--fallback-model', type=str, default=None,
+                        help='darknet only: cfg of the network used beyond --latency-budget, cfg/tiny-yolo.cfg if not '
+                             'set')
+    parser.add_argument('--fallback-weights', type=str, default=None,
+                        help='darknet only: weights of the network used beyond --latency-budget, '
+                             'net/tiny-yolo.weights if not set')
+    parser.add_argument('--fallback-onnx-model', type=str, default=None,
+                        help='darknet only, with --backend onnx and --latency-budget: path to the ONNX model of the '
+                             'fallback network')
+    parser.add_argument('--record', type=str, default=None,
+                        help='record clips around motion and detections in this directory')
+    parser.add_argument('--log-detections', action='store_true',
+                        help='send the detections and track events to the event store of the web server')
+    parser.add_argument('--overlay', type=str, default='processor',
+                        help='< processor | encode | client >, who draws the detections on the frames')
+    parser.add_argument('--staged', action='store_true',
+                        help='capture, process, encode and publish in concurrent stages and print their stats')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='process frames in a pool of N worker processes, only darknet and ssd_obj run faster')
 
     args = parser.parse_args()
 
-    if args.camera_mode == 'queue':
-        if args.camera_source == 'local':
-            frame_provider = QueueFrameProvider()
-        else:
-            frame_provider = QueueFrameProvider(False, args.camera_source)
-    elif args.camera_mode == 'newest':
-        if args.camera_source == 'local':
-            frame_provider = NewestFrameProvider()
+    r = redis.StrictRedis(host='localhost', port=6379, db=0)
+
+    try:
+        # started before the capture threads, the workers load their own networks
+        process_pool = None if args.processes is None else FrameProcessPool(args.processes)
+        provider_options = {
+            name: value for (name, value) in (('target_fps', args.target_fps), ('max_width', args.max_width))
+            if value is not None
+        }
+        frame_provider = create_frame_provider(args.camera_mode, args.camera_source, **provider_options)
+        options = {'detect_every': args.detect_every} if args.process_method == 'obj_tracker' else {}
+        if args.process_width is not None:
+            options['process_width'] = args.process_width
+        (options['overlay'], publisher_overlay) = overlay_targets(args.overlay)
+        if args.backend == 'opencv':
+            options['backend'] = {'type': 'opencv', 'backend': args.dnn_backend, 'target': args.dnn_target}
+        elif args.backend == 'onnx':
+            options['backend'] = {'type': 'onnx', 'model': args.onnx_model}
+        elif args.backend is not None:
+            raise ValueError(f'unknown inference backend: {args.backend}')
+        if args.backend is not None:
+            if args.process_method.replace('gated_', '') not in ('darknet', 'ssd_obj', 'obj_tracker'):
+                raise ValueError(f'process method does not run a network: {args.process_method}')
+            options['backend']['threads'] = args.inference_threads
+        darknet_options = {
+            name: value for (name, value) in (
+                ('model', args.model), ('weights', args.weights), ('input_size', args.input_size),
+                ('latency_budget', args.latency_budget), ('fallback_model', args.fallback_model),
+                ('fallback_weights', args.fallback_weights),
+            )
+            if value is not None
+        }
+        if args.fallback_onnx_model is not None:
+            darknet_options['fallback_backend'] = {
+                'type': 'onnx', 'model': args.fallback_onnx_model, 'threads': args.inference_threads
+            }
+        if darknet_options:
+            if args.process_method.replace('gated_', '') != 'darknet':
+                raise ValueError('--model, --weights, --input-size, --latency-budget and the --fallback- options '
+                                 'are for darknet only')
+            options.update(darknet_options)
+        if process_pool is None:
+            frame_processor = create_frame_processor(args.process_method, frame_provider, **options)
         else:
-            frame_provider = NewestFrameProvider(False, args.camera_source)
-    else:
-        print('unknown camera mode')
+            frame_processor = process_pool.frame_processor(None, args.process_method, **options)
+        frame_publisher = create_frame_publisher(
+            args.transport, r, locking=not args.lock_free, overlay=publisher_overlay
+        )
+    except ValueError as e:
+        print(e)
         exit()
 
-    if args.process_method == 'abs_motion':
-        frame_processor = AbsoluteMotionDetectionFrameProcessor(frame_provider.next_frame())
-    elif args.process_method == 'rel_motion':
-        frame_processor = RelativeMotionDetectionFrameProcessor()
-    elif args.process_method == 'darknet':
-        frame_processor = DarknetObjectDetectionFrameProcessor('net/Yolo.cfg', 'net/Yolo.weights', 1.0)
-    elif args.process_method == 'ssd_obj':
-        frame_processor = MobileNetSsdObjectDetectionFrameProcessor(
-            'net/MobileNetSsd.proto', 'net/MobileNetSsd.caffemodel'
-        )
-    elif args.process_method == 'obj_tracker':
-        frame_processor = ObjectTrackerFrameProcessor('net/ObjectTracker.proto', 'net/ObjectTracker.caffemodel')
+    if args.min_change is None:
+        publish_policy = PublishPolicy()
     else:
-        print('unknown process method!')
-        exit()
+        publish_policy = ChangeThresholdPublishPolicy(args.min_change)
 
-    r = redis.StrictRedis(host='localhost', port=6379, db=0)
+    if args.max_fps is None:
+        scheduler = FrameScheduler()
+    else:
+        scheduler = AdaptiveFrameScheduler(args.max_fps, args.idle_fps, redis_client=r, viewer_key=viewer_key())
+
+    if args.record is None:
+        recorder = None
+    else:
+        recorder = EventRecorder(args.record, overlay=not options['overlay'])
+        recorder.start()
+
+    if args.log_detections:
+        detection_log = DetectionLog(r)
+        detection_log.start()
+    else:
+        detection_log = None
+
+    # the networks are loaded and warmed up by now, except those of the worker processes
+    metrics.observe('camera_startup_seconds', time.time() - metrics.created)
+    MetricsPublisher(r).start()
+
+    if process_pool is not None:
+        PooledCameraPipeline(
+            None, frame_provider, frame_processor, frame_publisher, publish_policy, scheduler, recorder, detection_log
+        ).start()
+        while True:
+            time.sleep(1)
+
+    if args.staged:
+        if args.camera_mode == 'queue':
+            stages = {'process': {'max_queue': 30, 'drop_policy': 'block'}}
+        else:
+            stages = {'process': {'max_queue': 1, 'drop_policy': 'drop_oldest'}}
+        pipeline = StagedPipeline(
+            None, frame_provider, frame_processor, frame_publisher, publish_policy, stages, scheduler, recorder,
+            detection_log
+        )
+        pipeline.start()
+        while True:
+            time.sleep(5)
+            print(pipeline.stats())
 
     # press q to exit
     while True:
-        img = cv2.imencode('.jpg', frame_processor.process(frame_provider.next_frame()))[1]
-        with redis_lock.Lock(r, "image"):
-            r.set('image', img.tobytes())
+        scheduler.wait()
+        frame = frame_provider.next_frame()
+        start = time.perf_counter()
+        with metrics.timer('camera_process_seconds', step='total'):
+            processed_frame = frame_processor.process(frame)
+        scheduler.update(frame_processor.change_score, frame_processor.detections, time.perf_counter() - start)
+        if recorder is not None:
+            recorder.submit(processed_frame, frame_processor.change_score, frame_processor.detections)
+        if detection_log is not None:
+            detection_log.submit(frame_processor.detections, frame_processor.track_events)
+        if publish_policy.should_publish(frame_processor.change_score):
+            frame_publisher.publish(processed_frame, frame_processor.detections)
@@ -0,0 +1,288 @@
+import json
+import queue
+import threading
+import time
+
+import argparse
+import redis
+
+from Camera import create_frame_provider, create_frame_processor, create_batched_inference, create_frame_publisher, \
+    overlay_targets
+from FrameTransport import Rendition, PublishPolicy, ChangeThresholdPublishPolicy, viewer_key
+from FrameScheduler import FrameScheduler, AdaptiveFrameScheduler, CpuBudget
+from EventRecorder import EventRecorder
+from DetectionLog import DetectionLog
+from StagedPipeline import StagedPipeline
+from ProcessPool import FrameProcessPool, PooledCameraPipeline
+from Metrics import metrics, MetricsPublisher
+
+
+class CameraPipeline:
+    """
+    Capture, process and publish the frames of one camera.
+
+    Capture runs in a thread of its own, so a slow source only delays its own frames. Processing and publishing
+    are done in `step`, which is called by the workers of `CameraSupervisor`.
+    """
+
+    def __init__(self, camera_id, frame_provider, frame_processor, frame_publisher, max_pending=1,
+                 publish_policy=None, scheduler=None, recorder=None, detection_log=None):
+        """
+        :param camera_id: Id of the camera.
+        :param frame_provider: Provider of the camera frames.
+        :param frame_processor: Processor applied to every frame.
+        :param frame_publisher: Publisher of the processed frames.
+        :param max_pending: Number of captured frames waiting for processing. When full, the capture thread waits
+            if it is larger than 1 (like `queue` mode), otherwise the pending frame is replaced (like `newest` mode).
+        :param publish_policy: `PublishPolicy` deciding which processed frames are published, all of them by default.
+        :param scheduler: `FrameScheduler` deciding when the next frame is taken, as soon as it comes by default.
+        :param recorder: `EventRecorder` the processed frames are handed to, nothing is recorded if not set.
+        :param detection_log: `DetectionLog` the detections and track events are handed to, nothing is logged if not
+            set.
+        """
+        self.camera_id = camera_id
+        self.frame_provider = frame_provider
+        self.frame_processor = frame_processor
+        self.frame_publisher = frame_publisher
+        self.publish_policy = publish_policy or PublishPolicy()
+        self.scheduler = scheduler or FrameScheduler()
+        self.recorder = recorder
+        self.detection_log = detection_log
+        self.max_pending = max_pending
+        self.pending_frames = queue.Queue(maxsize=max_pending)
+        self.on_frame_ready = None
+        self.scheduled = False
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self, on_frame_ready):
+        """
+        Start capturing frames.
+        :param on_frame_ready: Called with the pipeline when it has a frame to process and is not scheduled yet.
+        """
+        self.on_frame_ready = on_frame_ready
+        self.running = True
+        threading.Thread(target=self.capture, name=f'capture-{self.camera_id}', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def capture(self):
+        last_frame = None
+        with metrics.labels(camera=self.camera_id):
+            while self.running:
+                self.scheduler.wait()
+                frame = self.frame_provider.next_frame()
+                # `NewestFrameProvider` returns the same frame until the camera delivers a new one
+                if frame is None or frame is last_frame:
+                    time.sleep(0.005)
+                    continue
+                last_frame = frame
+
+                if self.max_pending > 1:
+                    self.pending_frames.put(frame)
+                else:
+                    try:
+                        self.pending_frames.get_nowait()
+                        metrics.inc('camera_dropped_frames_total', stage='process')
+                    except queue.Empty:
+                        pass
+                    self.pending_frames.put(frame)
+                self.schedule()
+
+    def schedule(self):
+        with self.lock:
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.on_frame_ready(self)
+
+    def step(self):
+        """
+        Process and publish one pending frame, an error is logged and the frame dropped.
+        :return: Whether there are still frames pending, in which case the pipeline stays scheduled.
+        """
+        try:
+            frame = self.pending_frames.get_nowait()
+        except queue.Empty:
+            frame = None
+        try:
+            if frame is not None:
+                with metrics.labels(camera=self.camera_id):
+                    start = time.perf_counter()
+                    with metrics.timer('camera_process_seconds', step='total'):
+                        processed_frame = self.frame_processor.process(frame)
+                    self.scheduler.update(
+                        self.frame_processor.change_score, self.frame_processor.detections, time.perf_counter() - start
+                    )
+                    if self.recorder is not None:
+                        self.recorder.submit(
+                            processed_frame, self.frame_processor.change_score, self.frame_processor.detections
+                        )
+                    if self.detection_log is not None:
+                        self.detection_log.submit(self.frame_processor.detections, self.frame_processor.track_events)
+                    if self.publish_policy.should_publish(self.frame_processor.change_score):
+                        self.frame_publisher.publish(processed_frame, self.frame_processor.detections)
+        except Exception as e:
+            print(f'camera {self.camera_id}: {e}')
+        with self.lock:
+            still_ready = not self.pending_frames.empty()
+            if not still_ready:
+                self.scheduled = False
+        return still_ready
+
+
+class CameraSupervisor:
+    """
+    Run the pipelines of several cameras on a shared pool of workers.
+
+    Ready pipelines wait in a FIFO queue and a worker runs one step of a pipeline at a time before putting it back
+    at the end of the queue. Cameras are therefore served round-robin: a camera with a heavy processor only ever
+    holds one worker, and a camera whose source is slow is simply not in the queue until it has a frame.
+    """
+
+    def __init__(self, pipelines, workers=4):
+        """
+        :param pipelines: Pipelines of the cameras.
+        :param workers: Number of worker threads shared by all the cameras.
+        """
+        self.pipelines = pipelines
+        self.workers = workers
+        self.ready_pipelines = queue.Queue()
+
+    def run(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+        for pipeline in self.pipelines:
+            if isinstance(pipeline, CameraPipeline):
+                pipeline.start(self.ready_pipelines.put)
+            else:
+                # staged and pooled pipelines run their own threads instead of the shared workers
+                pipeline.start()
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            for pipeline in self.pipelines:
+                pipeline.stop()
+
+    def work(self):
+        while True:
+            pipeline = self.ready_pipelines.get()
+            # only the worker running a step puts the pipeline back, so it is never in the queue twice
+            if pipeline.step():
+                self.ready_pipelines.put(pipeline)
+
+
+def load_pipelines(config, redis_client):
+    """
+    Create the pipelines of the cameras listed in the config.
+    :param config: Parsed config, see `cameras.json`.
+    :param redis_client: Connection to the Redis server.
+    :return: List of `CameraPipeline`, or `StagedPipeline` for the cameras with a `stages` entry, or
+        `PooledCameraPipeline` when the config has `processes`.
+    """
+    # without a budget in the config, the schedulers of the cameras share the CPUs of the machine
+    cpu_budget = CpuBudget(config.get('cpu_budget'))
+    # started before the capture threads, the workers load their own networks
+    process_pool = FrameProcessPool(config['processes']) if 'processes' in config else None
+    batched_inferences = {
+        process_method: create_batched_inference(process_method, **options)
+        for (process_method, options) in config.get('batching', {}).items()
+    }
+
+    pipelines = []
+    for camera in config['cameras']:
+        camera_id = str(camera['id'])
+        frame_provider = create_frame_provider(
+            camera['camera_mode'], camera['camera_source'], **camera.get('provider_options', {})
+        )
+        # gated processors share the inference stage of the detector they wrap
+        batched_inference = batched_inferences.get(camera['process_method'].replace('gated_', ''))
+        (processor_overlay, publisher_overlay) = overlay_targets(camera.get('overlay', 'processor'))
+        options = dict(camera.get('processor_options', {}), overlay=processor_overlay)
+        if process_pool is None:
+            frame_processor = create_frame_processor(
+                camera['process_method'], frame_provider, batched_inference, **options
+            )
+        else:
+            frame_processor = process_pool.frame_processor(camera_id, camera['process_method'], **options)
+        renditions = [Rendition.from_config(rendition) for rendition in camera.get('renditions', [])]
+        frame_publisher = create_frame_publisher(
+            config.get('transport', 'redis'), redis_client, camera_id, config.get('locking', True), renditions,
+            publisher_overlay
+        )
+        max_pending = camera.get('max_pending', 30 if camera['camera_mode'] == 'queue' else 1)
+        if 'min_change' in camera:
+            publish_policy = ChangeThresholdPublishPolicy(camera['min_change'], camera.get('max_publish_interval', 5.0))
+        else:
+            publish_policy = PublishPolicy()
+        if 'recording' in camera:
+            # the recorder draws the detections unless the processor already did
+            recorder = EventRecorder(
+                config.get('recordings', 'recordings'), camera_id, overlay=not processor_overlay, **camera['recording']
+            )
+            recorder.start()
+        else:
+            recorder = None
+        if camera.get('log_detections', False):
+            detection_log = DetectionLog(redis_client, camera_id)
+            detection_log.start()
+        else:
+            detection_log = None
+        if 'frame_rate' in camera:
+            scheduler = AdaptiveFrameScheduler(
+                redis_client=redis_client, viewer_key=viewer_key(camera_id), cpu_budget=cpu_budget,
+                **camera['frame_rate']
+            )
+        else:
+            scheduler = None
+        if process_pool is not None:
+            pipelines.append(PooledCameraPipeline(
+                camera_id, frame_provider, frame_processor, frame_publisher, publish_policy, scheduler, recorder,
+                detection_log
+            ))
+        elif 'stages' in camera:
+            # the process queue follows the camera mode unless configured otherwise
+            stages = dict(camera['stages'])
+            stages.setdefault('process', {
+                'max_queue': max_pending, 'drop_policy': 'block' if max_pending > 1 else 'drop_oldest'
+            })
+            pipelines.append(StagedPipeline(
+                camera_id, frame_provider, frame_processor, frame_publisher, publish_policy, stages, scheduler,
+                recorder, detection_log
+            ))
+        else:
+            pipelines.append(CameraPipeline(
+                camera_id, frame_provider, frame_processor, frame_publisher, max_pending, publish_policy, scheduler,
+                recorder, detection_log
+            ))
+    return pipelines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', metavar='config', type=str,
+                        help='path to the camera config, see cameras.json')
+
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    redis_config = config.get('redis', {})
+    r = redis.StrictRedis(
+        host=redis_config.get('host', 'localhost'), port=redis_config.get('port', 6379), db=redis_config.get('db', 0)
+    )
+
+    try:
+        pipelines = load_pipelines(config, r)
+    except ValueError as e:
+        print(e)
+        exit()
+
+    # the networks are loaded and warmed up by now, except those of the worker processes
+    metrics.observe('camera_startup_seconds', time.time() - metrics.created)
+    MetricsPublisher(r).start()
+    CameraSupervisor(pipelines, config.get('workers', 4)).run()
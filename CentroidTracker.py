@@ -1,10 +1,12 @@
 # import the necessary packages
 from scipy.spatial import distance as dist
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
 from collections import OrderedDict
 import numpy as np
 
 class CentroidTracker():
-	def __init__(self, maxDisappeared=50):
+	def __init__(self, maxDisappeared=50, onRegister=None, onDeregister=None):
 		# initialize the next unique object ID along with two ordered
 		# dictionaries used to keep track of mapping a given object
 		# ID to its centroid and number of consecutive frames it has
@@ -18,16 +20,25 @@ class CentroidTracker():
 		# need to deregister the object from tracking
 		self.maxDisappeared = maxDisappeared
 
+		# optional callbacks told about the lifecycle of the objects,
+		# called with the object ID and its last known centroid
+		self.onRegister = onRegister
+		self.onDeregister = onDeregister
+
 	def register(self, centroid):
 		# when registering an object we use the next available object
 		# ID to store the centroid
 		self.objects[self.nextObjectID] = centroid
 		self.disappeared[self.nextObjectID] = 0
+		if self.onRegister is not None:
+			self.onRegister(self.nextObjectID, centroid)
 		self.nextObjectID += 1
 
 	def deregister(self, objectID):
 		# to deregister an object ID we delete the object ID from
 		# both of our respective dictionaries
+		if self.onDeregister is not None:
+			self.onDeregister(objectID, self.objects[objectID])
 		del self.objects[objectID]
 		del self.disappeared[objectID]
 
@@ -150,4 +161,132 @@ class CentroidTracker():
 					self.register(inputCentroids[col])
 
 		# return the set of trackable objects
-		return self.objects
\ No newline at end of file
+		return self.objects
+
+class ArrayCentroidTracker():
+	def __init__(self, maxDisappeared=50, maxDistance=None, kdTreeThreshold=500, onRegister=None,
+			onDeregister=None):
+		# same API as `CentroidTracker`, but the IDs, centroids and
+		# disappeared counters are kept in NumPy arrays and every
+		# step of `update` is vectorized, so the per-object Python
+		# overhead does not grow with crowded scenes
+		#
+		# input centroids further than `maxDistance` from an object
+		# are never matched to it, and when more than
+		# `kdTreeThreshold` objects are tracked the matching uses a
+		# KD-tree instead of the optimal (Hungarian) assignment on
+		# the dense distance matrix
+		self.nextObjectID = 0
+		self.ids = np.zeros(0, dtype="int")
+		self.centroids = np.zeros((0, 2), dtype="int")
+		self.disappearedCounts = np.zeros(0, dtype="int")
+		self.maxDisappeared = maxDisappeared
+		self.maxDistance = maxDistance
+		self.kdTreeThreshold = kdTreeThreshold
+		self.onRegister = onRegister
+		self.onDeregister = onDeregister
+
+	@property
+	def objects(self):
+		# mapping of object ID to centroid, like `CentroidTracker`
+		return OrderedDict(zip(self.ids.tolist(), self.centroids))
+
+	@property
+	def disappeared(self):
+		return OrderedDict(zip(self.ids.tolist(), self.disappearedCounts.tolist()))
+
+	def register(self, centroids):
+		# register all the given centroids at once with consecutive IDs
+		count = len(centroids)
+		newIDs = np.arange(self.nextObjectID, self.nextObjectID + count)
+		self.ids = np.concatenate([self.ids, newIDs])
+		self.centroids = np.concatenate([self.centroids, centroids])
+		self.disappearedCounts = np.concatenate([self.disappearedCounts, np.zeros(count, dtype="int")])
+		self.nextObjectID += count
+		if self.onRegister is not None:
+			for (objectID, centroid) in zip(newIDs.tolist(), centroids):
+				self.onRegister(objectID, centroid)
+		return newIDs
+
+	def deregister(self, mask):
+		# drop the objects selected by the boolean mask
+		keep = ~mask
+		removedIDs = self.ids[mask]
+		if self.onDeregister is not None:
+			for (objectID, centroid) in zip(removedIDs.tolist(), self.centroids[mask]):
+				self.onDeregister(objectID, centroid)
+		self.ids = self.ids[keep]
+		self.centroids = self.centroids[keep]
+		self.disappearedCounts = self.disappearedCounts[keep]
+		return removedIDs
+
+	def match(self, inputCentroids):
+		# return the matched (object row, input column) index pairs
+		maxDistance = np.inf if self.maxDistance is None else self.maxDistance
+
+		if len(self.ids) <= self.kdTreeThreshold:
+			D = dist.cdist(self.centroids, inputCentroids)
+			# gated pairs get a cost no real pair can reach so the
+			# assignment always exists, they are filtered out below
+			gated = D > maxDistance
+			D[gated] = D[~gated].max(initial=0) * (len(D) + 1) + 1
+			(rows, cols) = linear_sum_assignment(D)
+			valid = ~gated[rows, cols]
+			return rows[valid], cols[valid]
+
+		# candidate pairs are the few nearest inputs of every object,
+		# sorted from the closest on
+		k = min(4, len(inputCentroids))
+		(distances, cols) = cKDTree(inputCentroids).query(
+			self.centroids, k=k, distance_upper_bound=maxDistance)
+		rows = np.repeat(np.arange(len(self.ids)), k)
+		(distances, cols) = (distances.reshape(-1), cols.reshape(-1))
+		valid = np.isfinite(distances)
+		order = np.argsort(distances[valid], kind="stable")
+		(rows, cols) = (rows[valid][order], cols[valid][order])
+
+		# in every round, accept the closest pair of each input when
+		# it is also the closest accepted pair of its object, then
+		# drop the pairs using a matched object or input; the closest
+		# remaining pair is always accepted so this terminates
+		matchedRows = []
+		matchedCols = []
+		while len(rows) > 0:
+			(_, firstOfCol) = np.unique(cols, return_index=True)
+			candidates = np.sort(firstOfCol)
+			(_, firstOfRow) = np.unique(rows[candidates], return_index=True)
+			accepted = candidates[firstOfRow]
+			matchedRows.append(rows[accepted])
+			matchedCols.append(cols[accepted])
+			keep = ~np.isin(rows, rows[accepted]) & ~np.isin(cols, cols[accepted])
+			(rows, cols) = (rows[keep], cols[keep])
+
+		if not matchedRows:
+			return np.zeros(0, dtype="int"), np.zeros(0, dtype="int")
+		return np.concatenate(matchedRows), np.concatenate(matchedCols)
+
+	def update(self, rects):
+		rects = np.asarray(rects, dtype="float").reshape(-1, 4)
+		# centroids are truncated like in `CentroidTracker`
+		inputCentroids = ((rects[:, :2] + rects[:, 2:]) / 2.0).astype("int")
+
+		matchedRows = np.zeros(0, dtype="int")
+		matchedCols = np.zeros(0, dtype="int")
+		if len(self.ids) > 0 and len(inputCentroids) > 0:
+			(matchedRows, matchedCols) = self.match(inputCentroids)
+			self.centroids[matchedRows] = inputCentroids[matchedCols]
+
+		# every object left unmatched counts as disappeared in this
+		# frame, every input left unmatched is a new object
+		missing = np.ones(len(self.ids), dtype="bool")
+		missing[matchedRows] = False
+		self.disappearedCounts[missing] += 1
+		self.disappearedCounts[matchedRows] = 0
+		self.deregister(self.disappearedCounts > self.maxDisappeared)
+
+		unmatched = np.ones(len(inputCentroids), dtype="bool")
+		unmatched[matchedCols] = False
+		if unmatched.any():
+			self.register(inputCentroids[unmatched])
+
+		return self.objects
@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+
+from Metrics import metrics
+
+
+class DetectionLog:
+    """
+    Send the detections and the track events of a camera to the event store of the web server.
+
+    Rows are buffered in memory and pushed to the `key` Redis list every `flush_interval` seconds with a single
+    `RPUSH`, the `ingest_detections` command of the web server moves them into the database in bulk. Track events are
+    all kept, detections are sampled every `sample_interval` seconds since most frames repeat the previous ones. A
+    detection appearing between two samples, i.e. whose label, or object id when tracked, is not in the previous
+    frame, is kept whatever the sampling, so that short appearances are not missed.
+    """
+
+    key = 'detections:log'
+
+    def __init__(self, redis_client, camera_id=None, sample_interval=1.0, flush_interval=1.0, max_buffer=10000):
+        """
+        :param redis_client: Connection to the Redis server.
+        :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+        :param sample_interval: Time in seconds between two frames whose detections are kept.
+        :param flush_interval: Time in seconds between two pushes to Redis.
+        :param max_buffer: Number of rows kept while Redis is unreachable, the oldest ones are dropped beyond.
+        """
+        self.redis_client = redis_client
+        self.camera_id = '' if camera_id is None else str(camera_id)
+        self.sample_interval = sample_interval
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.rows = []
+        self.lock = threading.Lock()
+        self.last_sample_time = 0
+        # labels and object ids of the detections of the previous frame
+        self.last_labels = set()
+        self.last_track_ids = set()
+
+    def start(self):
+        threading.Thread(target=self.run, name=f'detection-log-{self.camera_id}', daemon=True).start()
+
+    def submit(self, detections, track_events=()):
+        """
+        Hand over the results of a processed frame, returns at once.
+        :param detections: `FrameProcessor.detections` of the frame.
+        :param track_events: `FrameProcessor.track_events` of the frame.
+        """
+        now = time.time()
+        rows = [
+            {
+                'camera': self.camera_id, 'time': now, 'kind': f'track_{event.kind}', 'label': None,
+                'confidence': None, 'box': [int(value) for value in event.centroid] * 2,
+                'track_id': int(event.track_id),
+            }
+            for event in track_events
+        ]
+        if detections and now - self.last_sample_time >= self.sample_interval:
+            self.last_sample_time = now
+            kept = detections
+        else:
+            kept = [
+                detection for detection in detections
+                if (detection.label not in self.last_labels if detection.track_id is None
+                    else detection.track_id not in self.last_track_ids)
+            ]
+        self.last_labels = {detection.label for detection in detections}
+        self.last_track_ids = {detection.track_id for detection in detections if detection.track_id is not None}
+        if kept:
+            rows.extend(
+                {
+                    'camera': self.camera_id, 'time': now, 'kind': 'detection', 'label': detection.label,
+                    'confidence': None if detection.confidence is None else round(float(detection.confidence), 4),
+                    'box': [int(value) for value in detection.box],
+                    'track_id': None if detection.track_id is None else int(detection.track_id),
+                }
+                for detection in kept
+            )
+        if not rows:
+            return
+        with self.lock:
+            self.rows.extend(rows)
+            dropped = len(self.rows) - self.max_buffer
+            if dropped > 0:
+                del self.rows[:dropped]
+        if dropped > 0:
+            metrics.inc('camera_dropped_detections_total', dropped)
+
+    def flush(self):
+        with self.lock:
+            (rows, self.rows) = (self.rows, [])
+        if not rows:
+            return
+        try:
+            self.redis_client.rpush(self.key, *[json.dumps(row, separators=(',', ':')) for row in rows])
+        except Exception as e:
+            print(f'detection log: {e}')
+            # put them back for the next attempt, newer rows go after them
+            with self.lock:
+                self.rows[:0] = rows[-self.max_buffer:]
+
+    def run(self):
+        with metrics.labels(camera=self.camera_id or None):
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
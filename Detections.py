@@ -0,0 +1,57 @@
+import json
+from collections import namedtuple
+
+import cv2
+
+# Object found by a processor, `box` is (start x, start y, end x, end y) in pixels. `confidence` is `None` when the
+# processor does not measure it (motion, tracked boxes) and `track_id` is the id given by `CentroidTracker`.
+Detection = namedtuple('Detection', ['label', 'confidence', 'box', 'track_id'], defaults=(None,))
+
+# Start (`start`) or end (`end`) of an object tracked by `CentroidTracker`, `centroid` is its first or last known
+# centroid (x, y) in pixels.
+TrackEvent = namedtuple('TrackEvent', ['kind', 'track_id', 'centroid'])
+
+
+def detections_to_json(detections, frame_shape):
+    """
+    Serialize the detections of a frame for the web server and other consumers.
+    :param detections: List of `Detection`.
+    :param frame_shape: Shape of the frame the boxes refer to.
+    :return: Compact JSON text, e.g. `{"width":640,"height":480,"detections":[{"label":"person",...}]}`.
+    """
+    (height, width) = frame_shape[:2]
+    return json.dumps({
+        'width': width,
+        'height': height,
+        'detections': [
+            {
+                'label': detection.label,
+                'confidence': None if detection.confidence is None else round(float(detection.confidence), 4),
+                'box': [int(value) for value in detection.box],
+                'track_id': None if detection.track_id is None else int(detection.track_id),
+            }
+            for detection in detections
+        ],
+    }, separators=(',', ':'))
+
+
+def draw_detections(frame, detections, color=(0, 255, 0)):
+    """
+    Draw the boxes and captions of detections on a frame, in place.
+    :param frame: Frame in openCV format.
+    :param detections: List of `Detection`.
+    :param color: BGR color of the boxes and captions.
+    :return: The frame.
+    """
+    for detection in detections:
+        (start_x, start_y, end_x, end_y) = [int(value) for value in detection.box]
+        cv2.rectangle(frame, (start_x, start_y), (end_x, end_y), color, 2)
+
+        caption = detection.label
+        if detection.confidence is not None:
+            caption += f' {detection.confidence * 100:.0f}%'
+        if detection.track_id is not None:
+            caption += f' ID {detection.track_id}'
+        y = start_y - 8 if start_y - 8 > 8 else start_y + 16
+        cv2.putText(frame, caption, (start_x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+    return frame
@@ -0,0 +1,278 @@
+import collections
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from Detections import draw_detections
+from FrameTransport import FrameEncoder, Rendition
+from Metrics import metrics
+from StagedPipeline import BoundedQueue
+
+
+def recording_directory(directory, camera_id=None):
+    """
+    Get the directory the clips of a camera are recorded in.
+    :param directory: Root directory of the recordings.
+    :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+    :raise ValueError: If the camera id is not a directory name, the directory must stay under the root.
+    """
+    if camera_id is None:
+        return os.path.join(directory, 'default')
+    camera_id = str(camera_id)
+    if not camera_id or os.path.basename(camera_id) != camera_id or camera_id.startswith('.') or '\\' in camera_id:
+        raise ValueError(f'invalid camera: {camera_id}')
+    return os.path.join(directory, camera_id)
+
+
+class ClipIndex:
+    """
+    Index of a clip file: one fixed size record (timestamp, offset, length) per frame, appended along with the frame,
+    so any moment of the clip is found with a binary search instead of a scan of the clip.
+
+    Clips are plain concatenations of JPEG frames (MJPEG), which players such as ffplay and VLC read as they are.
+    """
+
+    record = struct.Struct('<dQI')
+    dtype = np.dtype([('timestamp', '<f8'), ('offset', '<u8'), ('length', '<u4')])
+
+    def __init__(self, path):
+        """
+        :param path: Path of the index file, `<clip>.idx`.
+        """
+        # records of a clip still being written may be incomplete at the end
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.records = np.frombuffer(data[:len(data) - len(data) % self.record.size], dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, timestamp):
+        """
+        :return: Position of the first frame taken at or after `timestamp`, the last frame if all are before it.
+        """
+        return min(int(np.searchsorted(self.records['timestamp'], timestamp)), len(self.records) - 1)
+
+    def frame(self, position):
+        """
+        :return: (timestamp, offset, length) of the frame at a position.
+        """
+        record = self.records[position]
+        return float(record['timestamp']), int(record['offset']), int(record['length'])
+
+
+class EventRecorder:
+    """
+    Record clips of a camera around motion and detections.
+
+    The processed frames are encoded to JPEG and kept for `pre_roll` seconds in a ring buffer. When a frame changes
+    by `min_change` or has detections, an event starts: the buffered frames and every following frame are appended to
+    a clip file, until nothing happened for `post_roll` seconds. Every clip gets a `ClipIndex`, and the finished
+    events are appended to `events.jsonl` in the directory of the camera with the labels detected during them.
+
+    Encoding and writing run in a thread of their own, frames are dropped rather than slowing the camera down.
+    """
+
+    def __init__(self, directory, camera_id=None, pre_roll=3.0, post_roll=5.0, max_event_length=300.0,
+                 min_change=0.001, width=None, quality=80, max_queue=30, overlay=False):
+        """
+        :param directory: Root directory of the recordings, see `recording_directory`.
+        :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+        :param pre_roll: Time in seconds recorded before the start of an event.
+        :param post_roll: Time in seconds recorded after the last active frame of an event.
+        :param max_event_length: Longest clip in seconds, longer events go on in a new clip.
+        :param min_change: Frames whose change score reaches this start or extend an event, as do frames with
+            detections.
+        :param width: Width the recorded frames are shrunk to, full size if not set.
+        :param quality: JPEG quality of the recorded frames.
+        :param max_queue: Number of frames waiting to be encoded, the oldest one is dropped when full.
+        :param overlay: Whether to draw the detections on the recorded frames, for processors that do not draw them.
+        """
+        self.directory = recording_directory(directory, camera_id)
+        os.makedirs(self.directory, exist_ok=True)
+        self.camera_id = camera_id
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.max_event_length = max_event_length
+        self.min_change = min_change
+        self.overlay = overlay
+        self.encoder = FrameEncoder([Rendition(Rendition.full, width, quality)])
+        self.queue = BoundedQueue(max_queue, 'drop_oldest', name='record')
+        self.ring = collections.deque()
+        self.event = None
+
+    def start(self):
+        threading.Thread(target=self.run, name=f'record-{self.camera_id}', daemon=True).start()
+
+    def submit(self, frame, change_score, detections):
+        """
+        Hand over a processed frame, returns at once.
+        :param frame: Processed frame in openCV format.
+        :param change_score: `FrameProcessor.change_score` of the frame.
+        :param detections: `FrameProcessor.detections` of the frame.
+        """
+        self.queue.put((time.time(), frame, change_score, detections))
+
+    def run(self):
+        with metrics.labels(camera=self.camera_id):
+            while True:
+                item = self.queue.get(timeout=self.post_roll)
+                if item is None:
+                    # the camera stopped sending frames, end the event anyway
+                    if self.event is not None and time.time() - self.event['last_active'] > self.post_roll:
+                        self.close_event()
+                    continue
+                try:
+                    with metrics.timer('camera_record_seconds'):
+                        self.record(*item)
+                except Exception as e:
+                    print(f'record: {e}')
+                    self.close_event()
+
+    def record(self, timestamp, frame, change_score, detections):
+        active = bool(detections) or (change_score is not None and change_score >= self.min_change)
+        if self.overlay and detections:
+            frame = draw_detections(frame.copy(), detections)
+        img = self.encoder.encode(frame)[Rendition.full]
+        labels = sorted({detection.label for detection in detections})
+
+        if self.event is not None and (
+                timestamp - self.event['last_active'] > self.post_roll or
+                timestamp - self.event['start'] > self.max_event_length):
+            self.close_event()
+
+        if self.event is None:
+            self.ring.append((timestamp, img, labels))
+            while self.ring and timestamp - self.ring[0][0] > self.pre_roll:
+                self.ring.popleft()
+            if active:
+                self.open_event(timestamp)
+        else:
+            self.write(timestamp, img, labels)
+        if active and self.event is not None:
+            self.event['last_active'] = timestamp
+
+    def open_event(self, timestamp):
+        (start, _, _) = self.ring[0]
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(start)) + f'-{int(start * 1000) % 1000:03d}'
+        self.event = {
+            'id': name,
+            'start': start,
+            'last_active': timestamp,
+            'labels': {},
+            'frames': 0,
+            'clip': open(os.path.join(self.directory, f'{name}.mjpeg'), 'ab'),
+            'index': open(os.path.join(self.directory, f'{name}.mjpeg.idx'), 'ab'),
+        }
+        while self.ring:
+            self.write(*self.ring.popleft())
+
+    def write(self, timestamp, img, labels):
+        event = self.event
+        offset = event['clip'].tell()
+        event['clip'].write(img)
+        event['index'].write(ClipIndex.record.pack(timestamp, offset, len(img)))
+        # both are flushed together so the index never points past the end of the clip
+        event['clip'].flush()
+        event['index'].flush()
+        event['frames'] += 1
+        event['end'] = timestamp
+        for label in labels:
+            event['labels'].setdefault(label, timestamp)
+
+    def close_event(self):
+        event = self.event
+        if event is None:
+            return
+        self.event = None
+        event['clip'].close()
+        event['index'].close()
+        entry = {
+            'id': event['id'], 'start': event['start'], 'end': event.get('end', event['start']),
+            'frames': event['frames'], 'labels': event['labels'],
+        }
+        with open(os.path.join(self.directory, 'events.jsonl'), 'a') as f:
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        metrics.inc('camera_recorded_events_total')
+
+
+def read_events(directory, camera_id=None, start=None, end=None, label=None):
+    """
+    List the finished events of a camera.
+    :param directory: Root directory of the recordings.
+    :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+    :param start: Only events ending after this timestamp.
+    :param end: Only events starting before this timestamp.
+    :param label: Only events where this label was detected.
+    :return: List of the entries of `events.jsonl`, oldest first.
+    :raise ValueError: If the camera id is not a directory name.
+    """
+    path = os.path.join(recording_directory(directory, camera_id), 'events.jsonl')
+    if not os.path.exists(path):
+        return []
+    events = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if start is not None and event['end'] < start:
+                continue
+            if end is not None and event['start'] > end:
+                continue
+            if label is not None and label not in event['labels']:
+                continue
+            events.append(event)
+    return events
+
+
+def clip_path(directory, camera_id, event_id):
+    """
+    Get the path of the clip of an event.
+    :raise ValueError: If the camera id is not a directory name or the event id is not a clip name.
+    """
+    if not event_id or os.path.basename(event_id) != event_id or event_id.startswith('.'):
+        raise ValueError(f'invalid event: {event_id}')
+    return os.path.join(recording_directory(directory, camera_id), f'{event_id}.mjpeg')
+
+
+def parse_range(header, size):
+    """
+    Parse a `Range` header asking for a single range of bytes.
+    :param header: Value of the header, e.g. `bytes=100-199`, `bytes=100-` or `bytes=-100`.
+    :param size: Size of the resource.
+    :return: (first byte, last byte) included, `None` if the header is missing or not understood.
+    :raise ValueError: If the range does not overlap the resource.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    (first, _, last) = header[len('bytes='):].strip().partition('-')
+    try:
+        if first == '':
+            (first, last) = (max(0, size - int(last)), size - 1)
+        else:
+            (first, last) = (int(first), size - 1 if last == '' else min(int(last), size - 1))
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        raise ValueError(f'unsatisfiable range: {header}')
+    return first, last
+
+
+def read_chunks(path, first, last, chunk_size=64 * 1024):
+    """
+    Generate the bytes of a file from `first` to `last` included.
+    """
+    with open(path, 'rb') as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
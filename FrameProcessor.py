@@ -1,13 +1,27 @@
+import threading
 import time
 
 import cv2
-from darkflow.net.build import TFNet
-from PIL import Image, ImageDraw, ImageFont
 import numpy as np
-from CentroidTracker import CentroidTracker
+from BatchedInference import BatchedInference
+from Metrics import metrics
+from InferenceBackend import OnnxRuntimeBackend, create_backend
+from ModelRegistry import caffe_model, darkflow_model, dnn_model
+from Detections import Detection, TrackEvent
+from MotionEngine import MotionEngine
+from OverlayRenderer import OverlayRenderer
 
 
 class FrameProcessor:
+    # Fraction of the pixels that changed in the last processed frame, `None` if the processor does not measure it.
+    change_score = None
+    # `Detection` list of the last processed frame, published next to the frame.
+    detections = []
+    # Whether `process` draws the detections on the frame, otherwise the frame is returned as is.
+    overlay = True
+    # `TrackEvent` list of the objects that started or stopped being tracked in the last processed frame.
+    track_events = []
+
     def process(self, frame):
         """
         Process the frame using certain method
@@ -22,44 +36,51 @@ class AbsoluteMotionDetectionFrameProcessor(FrameProcessor):
     Ref: https://www.pyimagesearch.com/2015/05/25/basic-motion-detection-and-tracking-with-python-and-opencv/
     """
 
-    def __init__(self, initial_frame, min_area=500, tolerance=50):
+    def __init__(self, initial_frame, min_area=500, tolerance=50, overlay=True, process_width=None,
+                 background_rate=0.0):
         """
         :param initial_frame: First frame of the sequence.
         :param min_area: A area, difference smaller than this will be ignored.
         :param tolerance: Used for threshold the the difference, the lower the more sensitive.
+        :param overlay: Whether to draw the moved areas on the frame.
+        :param process_width: Width the frames are shrunk to before looking for motion, full size if not set.
+        :param background_rate: Weight of every new frame in the background, 0 keeps the initial frame, see
+            `MotionEngine`.
         """
-        self.initial_gray_frame = None
+        self.engine = MotionEngine(process_width, min_area, tolerance, background_rate)
         self.reset_initial_frame(initial_frame)
-        self.min_area = min_area
-        self.tolerance = tolerance
+        self.overlay = overlay
 
     def reset_initial_frame(self, initial_frame):
         """
         Reset initial frame.
-        :param initial_frame: New initial frame.
+        :param initial_frame: New initial frame, `None` to take the next processed frame.
         """
-        if initial_frame is not None:
-            initial_gray_frame = cv2.cvtColor(initial_frame, cv2.COLOR_BGR2GRAY)
-            self.initial_gray_frame = cv2.GaussianBlur(initial_gray_frame, (21, 21), 0)
-        else:
-            self.initial_gray_frame = None
-
-    def process(self, frame):
-        frame_copy = frame.copy()
-        gray_frame = cv2.cvtColor(frame_copy, cv2.COLOR_BGR2GRAY)
-        gray_frame = cv2.GaussianBlur(gray_frame, (21, 21), 0)
+        self.engine.reset(initial_frame)
 
-        frame_delta = cv2.absdiff(self.initial_gray_frame, gray_frame)
-        threshold = cv2.threshold(frame_delta, self.tolerance, 255, cv2.THRESH_BINARY)[1]
-        threshold = cv2.dilate(threshold, None, iterations=2)
-        contours = cv2.findContours(threshold.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[1]
+    def detect_motion(self, frame):
+        """
+        Find the areas of the frame that differ from the initial frame.
+        :param frame: Frame in openCV format.
+        :return: List of bounding boxes (x, y, w, h) of the areas larger than `min_area`.
+        """
+        with metrics.timer('camera_process_seconds', step='preprocess'):
+            self.engine.prepare(frame)
 
-        for c in contours:
-            if cv2.contourArea(c) < self.min_area:
-                continue
+        with metrics.timer('camera_process_seconds', step='motion'):
+            boxes = self.engine.compare()
+            self.change_score = self.engine.change_score
+            return boxes
 
-            (x, y, w, h) = cv2.boundingRect(c)
-            cv2.rectangle(frame_copy, (x, y), (x + w, y + h), (0, 255, 0), 2)
+    def process(self, frame):
+        boxes = self.detect_motion(frame)
+        self.detections = [Detection('motion', None, (x, y, x + w, y + h)) for (x, y, w, h) in boxes]
+        if not self.overlay:
+            return frame
+        with metrics.timer('camera_process_seconds', step='draw'):
+            frame_copy = frame.copy()
+            for (x, y, w, h) in boxes:
+                cv2.rectangle(frame_copy, (x, y), (x + w, y + h), (0, 255, 0), 2)
         return frame_copy
 
 
@@ -68,81 +89,294 @@ class RelativeMotionDetectionFrameProcessor(FrameProcessor):
     Ref: https://www.pyimagesearch.com/2015/05/25/basic-motion-detection-and-tracking-with-python-and-opencv/
     """
 
-    def __init__(self, min_area=500, tolerance=50):
+    def __init__(self, min_area=500, tolerance=50, overlay=True, process_width=None, background_rate=1.0):
         """
         :param min_area: A area, difference smaller than this will be ignored.
         :param tolerance: Used for threshold the the difference, the lower the more sensitive.
+        :param overlay: Whether to draw the moving areas on the frame.
+        :param process_width: Width the frames are shrunk to before looking for motion, full size if not set.
+        :param background_rate: Weight of every new frame in the background, 1 compares every frame with the previous
+            one, lower values with a running average of the previous frames, see `MotionEngine`.
         """
-        self.internal_processor = AbsoluteMotionDetectionFrameProcessor(None, min_area, tolerance)
+        self.internal_processor = AbsoluteMotionDetectionFrameProcessor(
+            None, min_area, tolerance, overlay, process_width, background_rate
+        )
+        self.overlay = overlay
 
     def process(self, frame):
-        if self.internal_processor.initial_gray_frame is None:
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            self.internal_processor.initial_gray_frame = gray_frame
-            return frame
-        else:
-            ret = self.internal_processor.process(frame)
-            self.internal_processor.reset_initial_frame(frame)
-            return ret
+        # the first frame only becomes the background
+        ret = self.internal_processor.process(frame)
+        self.change_score = self.internal_processor.change_score
+        self.detections = self.internal_processor.detections
+        return ret
 
 
-class DarknetObjectDetectionFrameProcessor(FrameProcessor):
+def read_darknet_input_size(cfg):
     """
-    Ref: https://github.com/thtrieu/darkflow
+    Read the input size of a network from the `[net]` section of its darknet cfg.
+    :return: (width, height).
+    """
+    size = {}
+    with open(cfg) as f:
+        for line in f:
+            (name, _, value) = line.split('#', 1)[0].partition('=')
+            if name.strip() in ('width', 'height'):
+                size.setdefault(name.strip(), int(value))
+            if len(size) == 2:
+                break
+    return size['width'], size['height']
+
+
+class Letterbox:
+    """
+    Fit frames into the input of a network: the frame is resized to fit without being distorted, centered, and the
+    borders are filled with gray. The canvas and the blob live in buffers allocated once for the input size, and the
+    borders are only filled again when the size of the frames changes.
     """
 
-    @staticmethod
-    def draw_rect(drawing, topleft, bottomright, outline, width):
+    def __init__(self, input_size, keep_aspect=True, fill=128):
+        """
+        :param input_size: Input size of the network, (width, height).
+        :param keep_aspect: Whether to keep the aspect ratio of the frames, they are stretched to the input otherwise.
+        :param fill: Gray level of the borders.
+        """
+        (width, height) = input_size
+        self.input_size = (width, height)
+        self.keep_aspect = keep_aspect
+        self.fill = fill
+        self.canvas = np.empty((height, width, 3), dtype=np.uint8)
+        self.blob = np.empty((1, 3, height, width), dtype=np.float32)
+        self.frame_size = None
+
+    def fit(self, frame_size):
+        """
+        Place frames of a size, (width, height), on the canvas.
+        """
+        (frame_width, frame_height) = frame_size
+        (width, height) = self.input_size
+        if self.keep_aspect:
+            scale = min(width / frame_width, height / frame_height)
+            self.scale = (scale, scale)
+        else:
+            self.scale = (width / frame_width, height / frame_height)
+        self.size = (max(1, round(frame_width * self.scale[0])), max(1, round(frame_height * self.scale[1])))
+        self.offset = ((width - self.size[0]) // 2, (height - self.size[1]) // 2)
+        self.canvas[:] = self.fill
+        (x, y) = self.offset
+        # the frames are resized straight into this part of the canvas
+        self.window = self.canvas[y:y + self.size[1], x:x + self.size[0]]
+        self.frame_size = frame_size
+
+    def prepare(self, frame):
+        """
+        :param frame: Frame in openCV format.
+        :return: Blob of the frame, RGB scaled to [0, 1], overwritten by the next call.
         """
-        Draw a rectangle with line width on `ImageDraw` object.
+        if (frame.shape[1], frame.shape[0]) != self.frame_size:
+            self.fit((frame.shape[1], frame.shape[0]))
+        cv2.resize(frame, self.size, dst=self.window, interpolation=cv2.INTER_LINEAR)
+        np.copyto(self.blob[0], self.canvas[:, :, ::-1].transpose(2, 0, 1), casting='unsafe')
+        self.blob *= 1 / 255.0
+        return self.blob
+
+    def to_frame(self, boxes):
         """
-        top_left = topleft
-        bottom_right = bottomright
-        top_right = (bottomright[0], topleft[1])
-        bottom_left = (topleft[0], bottomright[1])
+        Map boxes found on the input of the network back to the last prepared frame.
+        :param boxes: Array of (center x, center y, width, height) relative to the input of the network.
+        :return: Array of (start x, start y, width, height) in pixels of the frame.
+        """
+        boxes = boxes * np.array(self.input_size * 2, dtype=np.float32)
+        boxes[:, :2] -= boxes[:, 2:] / 2
+        boxes[:, :2] -= self.offset
+        return boxes / np.array(self.scale * 2, dtype=np.float32)
+
+
+class DarknetObjectDetectionFrameProcessor(FrameProcessor):
+    """
+    Ref: https://github.com/thtrieu/darkflow
+
+    The network runs in darkflow unless a `backend` is given, which runs the darknet files themselves through
+    `cv2.dnn.readNetFromDarknet` (YOLOv2 `region` outputs) or their ONNX conversion, without TensorFlow. The frames
+    then go through a `Letterbox` sized for the network, whose input size can be chosen per camera.
 
-        drawing.line([top_left, top_right], fill=outline, width=width)
-        drawing.line([top_right, bottom_right], fill=outline, width=width)
-        drawing.line([bottom_right, bottom_left], fill=outline, width=width)
-        drawing.line([bottom_left, top_left], fill=outline, width=width)
+    With a `latency_budget`, a camera whose detections take longer than the budget on average switches to the
+    fallback network, e.g. `cfg/tiny-yolo.cfg`. It is loaded in the background while the current one keeps running.
+    The onnx backend runs its own model whatever the cfg, the fallback network then needs a `fallback_backend` with
+    the ONNX conversion of the fallback network.
+    """
+
+    # BGR
+    color = (111, 248, 95)
 
-    def __init__(self, model, weights, gpu_limit, threshold=0.1):
+    def __init__(self, model, weights, gpu_limit, threshold=0.1, overlay=True, backend=None, labels='cfg/coco.names',
+                 nms_threshold=0.4, input_size=None, letterbox=True, latency_budget=None,
+                 fallback_model='cfg/tiny-yolo.cfg', fallback_weights='net/tiny-yolo.weights',
+                 fallback_input_size=None, fallback_backend=None):
         """
         :param model: Path to the model (e.g. './darkflow/cfg/yolo.cfg')
         :param weights: Path to the weights file (e.g. './darkflow/bin/yolo.weights')
         :param gpu_limit: Limitation of GPU, set to 0 to run on CPU only.
         :param threshold: Threshold of recognition.
+        :param overlay: Whether to draw the detections on the frame.
+        :param backend: Keyword arguments of `create_backend`, the network runs in darkflow if not set.
+        :param labels: Path to the names of the classes of the network, one per line.
+        :param nms_threshold: Overlap above which the less confident of two boxes is dropped, darkflow applies its
+            own.
+        :param input_size: Input size of the network, (width, height) multiples of 32, the size in the cfg if not set.
+            Only with a `backend`, darkflow always uses the size in the cfg.
+        :param letterbox: Whether to keep the aspect ratio of the frames, they are stretched to the input otherwise.
+        :param latency_budget: Time in seconds the detection of a frame may take on average before switching to the
+            fallback network.
+        :param fallback_model: Path to the model of the fallback network.
+        :param fallback_weights: Path to the weights of the fallback network.
+        :param fallback_input_size: Input size of the fallback network, the size in its cfg if not set.
+        :param fallback_backend: Keyword arguments of `create_backend` for the fallback network, `backend` if not set.
+            Required with an onnx `backend`.
         """
-        self.tf_net = TFNet({
-            'model': model, 'load': weights, 'threshold': threshold, 'gpu': gpu_limit, 'labels': 'cfg/coco.names'
-        })
-
-    def process(self, frame):
-        now = time.time()
-        image = Image.fromarray(frame[:, :, ::-1])
-        results = self.tf_net.return_predict(frame)
-        draw = ImageDraw.ImageDraw(image)
-        font = ImageFont.truetype('Consolas.ttf', 15)
-
-        for result in results:
-            if result['confidence'] < 0.5:
+        self.overlay = overlay
+        self.renderer = OverlayRenderer('Consolas.ttf', 15)
+        self.gpu_limit = gpu_limit
+        self.threshold = threshold
+        self.nms_threshold = nms_threshold
+        self.labels_path = labels
+        self.letterbox = letterbox
+        self.backend = None if backend is None else create_backend(**backend)
+        self.fallback = None
+        if latency_budget is not None:
+            if fallback_backend is None and isinstance(self.backend, OnnxRuntimeBackend):
+                raise ValueError('the onnx backend always runs its own model, latency_budget needs a fallback_backend '
+                                 'with the ONNX model of the fallback network')
+            fallback_backend = self.backend if fallback_backend is None else create_backend(**fallback_backend)
+            self.fallback = (fallback_model, fallback_weights, fallback_input_size, fallback_backend)
+        if self.backend is not None or (self.fallback is not None and self.fallback[3] is not None):
+            with open(labels) as f:
+                self.labels = [line.strip() for line in f if line.strip()]
+        # (SharedModel, Letterbox) replaced at once when switching to the fallback network
+        self.network = self.load_network(model, weights, input_size, self.backend)
+        self.latency_budget = latency_budget
+        self.latency = None
+        self.latency_frames = 0
+
+    def load_network(self, model, weights, input_size=None, backend=None):
+        """
+        :param backend: `InferenceBackend` running the network, darkflow if not set.
+        :return: (`SharedModel`, `Letterbox` or `None` for darkflow).
+        """
+        if backend is None:
+            if input_size is not None:
+                raise ValueError('darkflow takes the input size from the cfg, set a backend to choose it')
+            return darkflow_model(model, weights, self.gpu_limit, self.threshold, self.labels_path), None
+        input_size = read_darknet_input_size(model) if input_size is None else tuple(input_size)
+        if input_size[0] % 32 or input_size[1] % 32:
+            raise ValueError(f'input size of darknet networks must be multiples of 32: {input_size}')
+        return dnn_model('darknet', (model, weights), input_size, backend), Letterbox(input_size, self.letterbox)
+
+    def detect(self, frame):
+        """
+        Run the network on a frame.
+        :param frame: Frame in openCV format.
+        :return: List of `Detection`.
+        """
+        (model, letterbox) = self.network
+        start = time.perf_counter()
+        if letterbox is None:
+            detections = self.detect_darkflow(model, frame)
+        else:
+            detections = self.detect_dnn(model, letterbox, frame)
+        if self.fallback is not None:
+            self.check_latency(time.perf_counter() - start)
+        return detections
+
+    def detect_darkflow(self, model, frame):
+        # darkflow resizes and normalizes the frame inside `return_predict`
+        with metrics.timer('camera_process_seconds', step='inference'):
+            with model.lock:
+                results = model.net.return_predict(frame)
+        with metrics.timer('camera_process_seconds', step='postprocess'):
+            return [
+                Detection(
+                    result['label'], result['confidence'],
+                    (result['topleft']['x'], result['topleft']['y'],
+                     result['bottomright']['x'], result['bottomright']['y'])
+                )
+                for result in results
+            ]
+
+    def detect_dnn(self, model, letterbox, frame):
+        (height, width) = frame.shape[:2]
+        with metrics.timer('camera_process_seconds', step='preprocess'):
+            blob = letterbox.prepare(frame)
+        with metrics.timer('camera_process_seconds', step='inference'):
+            output = model.forward(blob)
+
+        with metrics.timer('camera_process_seconds', step='postprocess'):
+            # one row per anchor of every cell: center x, center y, width, height relative to the input, objectness,
+            # then the probability of each class, already multiplied by the objectness
+            scores = output[:, 5:]
+            classes = scores.argmax(axis=1)
+            confidences = scores[np.arange(len(scores)), classes]
+            keep = np.flatnonzero(confidences > self.threshold)
+            rects = letterbox.to_frame(output[keep, :4]).astype(int).tolist()
+            results = []
+            for i in np.array(cv2.dnn.NMSBoxes(rects, confidences[keep].tolist(), self.threshold,
+                                               self.nms_threshold)).flatten():
+                (x, y, w, h) = rects[i]
+                results.append(Detection(
+                    self.labels[classes[keep[i]]], float(confidences[keep[i]]),
+                    (max(x, 0), max(y, 0), min(x + w, width - 1), min(y + h, height - 1))
+                ))
+            return results
+
+    def check_latency(self, duration):
+        """
+        Switch to the fallback network once the detections take longer than the budget on average.
+        :param duration: Time in seconds the detection of the last frame took.
+        """
+        # averaged over the last 20 frames or so, a single slow frame does not switch
+        self.latency = duration if self.latency is None else self.latency * 0.95 + duration * 0.05
+        self.latency_frames += 1
+        if self.latency_frames < 20 or self.latency <= self.latency_budget:
+            return
+        (model, weights, input_size, backend) = self.fallback
+        self.fallback = None
+        print(f'darknet: {self.latency * 1000:.0f} ms per frame, over the budget of '
+              f'{self.latency_budget * 1000:.0f} ms, switching to {model}')
+        metrics.inc('camera_model_switches_total')
+        threading.Thread(
+            target=self.switch_network, args=(model, weights, input_size, backend), daemon=True
+        ).start()
+
+    def switch_network(self, model, weights, input_size, backend):
+        try:
+            self.network = self.load_network(model, weights, input_size, backend)
+        except Exception as e:
+            print(f'darknet: cannot load {model}: {e}')
+
+    def draw(self, frame, detections):
+        """
+        Draw the detections on a frame, in place. The more confident a detection, the more opaque it is drawn.
+        :param frame: Frame in openCV format.
+        :param detections: List of `Detection` from `detect`.
+        :return: The frame.
+        """
+        for detection in detections:
+            if detection.confidence < 0.5:
                 continue
 
-            alpha = int((result['confidence'] * 2 - 1) * 125 + 100)
+            alpha = int((detection.confidence * 2 - 1) * 125 + 100)
+            (start_x, start_y) = detection.box[:2]
 
-            DarknetObjectDetectionFrameProcessor.draw_rect(
-                draw,
-                (result['topleft']['x'], result['topleft']['y']),
-                (result['bottomright']['x'], result['bottomright']['y']),
-                (95, 248, 111, alpha), 4
-            )
-            text = f'{result["label"]} - {"%.2f" % (100 * result["confidence"])}%'
-            draw.text(
-                (result['topleft']['x'], result['topleft']['y'] - 18),
-                text, fill=(95, 258, 111, alpha), font=font
-            )
-        print(f'process takes {time.time() - now} sec')
-        return np.array(image)[:, :, ::-1]
+            self.renderer.rectangle(frame, detection.box, self.color, alpha, 4)
+            text = f'{detection.label} - {"%.2f" % (100 * detection.confidence)}%'
+            self.renderer.text(frame, (start_x, start_y - 18), text, self.color, alpha)
+        return frame
+
+    def process(self, frame):
+        self.detections = self.detect(frame)
+        if not self.overlay:
+            return frame
+        with metrics.timer('camera_process_seconds', step='draw'):
+            return self.draw(frame, self.detections)
 
 
 class MobileNetSsdObjectDetectionFrameProcessor(FrameProcessor):
@@ -150,80 +384,398 @@ class MobileNetSsdObjectDetectionFrameProcessor(FrameProcessor):
     Ref: https://www.pyimagesearch.com/2017/09/18/real-time-object-detection-with-deep-learning-and-opencv/
     """
 
-    def __init__(self, proto, model, confidence_threshold=0.2):
+    input_size = (300, 300)
+    scale_factor = 0.007843
+    mean = 127.5
+
+    @staticmethod
+    def create_batched_inference(proto, model, max_batch_size=8, max_wait=0.01, backend=None):
+        """
+        Load the network once for several processors, their frames are batched into one forward pass.
+        :param proto: Path to the prototxt.
+        :param model: Path to the caffe model.
+        :param max_batch_size: Maximum number of frames in one forward pass.
+        :param max_wait: Maximum time in seconds a frame waits for the batch to fill.
+        :param backend: Keyword arguments of `create_backend`, OpenCV DNN with its defaults if not set.
+        """
+        cls = MobileNetSsdObjectDetectionFrameProcessor
+        return BatchedInference(
+            caffe_model(proto, model, cls.input_size, create_backend(**(backend or {}))), cls.scale_factor,
+            cls.input_size, cls.mean, max_batch_size, max_wait
+        )
+
+    def __init__(self, proto, model, confidence_threshold=0.2, batched_inference=None, overlay=True, backend=None):
         """
         :param proto: Path to the prototxt (e.g. MobileNetSSD_deploy.prototxt.txt)
         :param model: Path to the caffe model (e.g. MobileNetSSD_deploy.caffemodel)
         :param confidence_threshold: Threshold of the confidence to filter less confident detections.
+        :param batched_inference: Shared `BatchedInference` from `create_batched_inference`, the network is not
+            loaded by this processor when set.
+        :param overlay: Whether to draw the detections on the frame.
+        :param backend: Keyword arguments of `create_backend`, OpenCV DNN with its defaults if not set.
         """
+        self.overlay = overlay
         self.classes = ["background", "aeroplane", "bicycle", "bird", "boat",
                         "bottle", "bus", "car", "cat", "chair", "cow", "diningtable",
                         "dog", "horse", "motorbike", "person", "pottedplant", "sheep",
                         "sofa", "train", "tvmonitor"]
         self.colors = np.random.uniform(0, 255, size=(len(self.classes), 3))
-        self.net = cv2.dnn.readNetFromCaffe(proto, model)
+        self.batched_inference = batched_inference
+        if batched_inference is None:
+            self.model = caffe_model(proto, model, self.input_size, create_backend(**(backend or {})))
+        else:
+            self.model = None
         self.confidence_threshold = confidence_threshold
 
-    def process(self, frame):
+    def detect(self, frame):
+        """
+        Run the network on a frame.
+        :param frame: Frame in openCV format.
+        :return: List of `Detection` more confident than the threshold.
+        """
         (height, width) = frame.shape[:2]
-        blob = cv2.dnn.blobFromImage(cv2.resize(frame, (300, 300)), 0.007843, (300, 300), 127.5)
-        self.net.setInput(blob)
-        detections = self.net.forward()
-
-        for i in np.arange(0, detections.shape[2]):
-            confidence = detections[0, 0, i, 2]
-
-            if confidence > self.confidence_threshold:
-                idx = int(detections[0, 0, i, 1])
-                box = detections[0, 0, i, 3:7] * np.array([width, height, width, height])
-                (startX, startY, endX, endY) = box.astype("int")
+        with metrics.timer('camera_process_seconds', step='preprocess'):
+            image = cv2.resize(frame, self.input_size)
+            if self.batched_inference is None:
+                blob = cv2.dnn.blobFromImage(image, self.scale_factor, self.input_size, self.mean)
+        with metrics.timer('camera_process_seconds', step='inference'):
+            if self.batched_inference is not None:
+                detections = self.batched_inference.infer(image)
+            else:
+                detections = self.model.forward(blob)
+
+        with metrics.timer('camera_process_seconds', step='postprocess'):
+            results = []
+            for i in np.arange(0, detections.shape[2]):
+                confidence = detections[0, 0, i, 2]
+
+                if confidence > self.confidence_threshold:
+                    idx = int(detections[0, 0, i, 1])
+                    box = detections[0, 0, i, 3:7] * np.array([width, height, width, height])
+                    results.append(Detection(self.classes[idx], float(confidence), tuple(box.astype("int"))))
+            return results
+
+    def draw(self, frame, detections):
+        """
+        Draw the detections on a frame, in place.
+        :param frame: Frame in openCV format.
+        :param detections: List of `Detection` from `detect`.
+        :return: The frame.
+        """
+        for detection in detections:
+            color = self.colors[self.classes.index(detection.label)]
+            (startX, startY, endX, endY) = detection.box
 
-                label = "{}: {:.2f}%".format(self.classes[idx], confidence * 100)
-                cv2.rectangle(frame, (startX, startY), (endX, endY), self.colors[idx], 2)
-                y = startY - 15 if startY - 15 > 15 else startY + 15
-                cv2.putText(frame, label, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, self.colors[idx], 2)
+            label = "{}: {:.2f}%".format(detection.label, detection.confidence * 100)
+            cv2.rectangle(frame, (startX, startY), (endX, endY), color, 2)
+            y = startY - 15 if startY - 15 > 15 else startY + 15
+            cv2.putText(frame, label, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
 
         return frame
 
+    def process(self, frame):
+        self.detections = self.detect(frame)
+        if not self.overlay:
+            return frame
+        with metrics.timer('camera_process_seconds', step='draw'):
+            return self.draw(frame, self.detections)
+
 
 class ObjectTrackerFrameProcessor(FrameProcessor):
     """
     Ref: https://www.pyimagesearch.com/2018/07/23/simple-object-tracking-with-opencv/
     """
 
-    def __init__(self, proto, model, confidence_threshold=0.5):
+    mean = (104.0, 177.0, 123.0)
+
+    @staticmethod
+    def create_batched_inference(proto, model, input_size=(300, 300), max_batch_size=8, max_wait=0.01,
+                                 backend=None):
+        """
+        Load the network once for several processors, their frames are batched into one forward pass.
+        :param proto: Path to the prototxt.
+        :param model: Path to the caffe model.
+        :param input_size: Size the frames are resized to, frames of a batch must share the same input size.
+        :param max_batch_size: Maximum number of frames in one forward pass.
+        :param max_wait: Maximum time in seconds a frame waits for the batch to fill.
+        :param backend: Keyword arguments of `create_backend`, OpenCV DNN with its defaults if not set.
+        """
+        return BatchedInference(
+            caffe_model(proto, model, input_size, create_backend(**(backend or {}))), 1.0, input_size,
+            ObjectTrackerFrameProcessor.mean, max_batch_size, max_wait
+        )
+
+    tracker_factories = {
+        'kcf': 'TrackerKCF_create',
+        'mosse': 'TrackerMOSSE_create',
+        'csrt': 'TrackerCSRT_create',
+        'mil': 'TrackerMIL_create',
+    }
+
+    @staticmethod
+    def create_tracker(tracker_type):
+        """
+        Create a single object tracker of OpenCV.
+        :param tracker_type: One of `kcf`, `mosse`, `csrt` and `mil`. All but `mil` need opencv-contrib-python.
+        """
+        factory = ObjectTrackerFrameProcessor.tracker_factories[tracker_type]
+        # OpenCV 4.5 moved the trackers of the old API to `cv2.legacy`
+        for module in (getattr(cv2, 'legacy', None), cv2):
+            if module is not None and hasattr(module, factory):
+                return getattr(module, factory)()
+        raise ValueError(f'tracker {tracker_type} is not available in this build of OpenCV')
+
+    def __init__(self, proto, model, confidence_threshold=0.5, batched_inference=None, detect_every=1,
+                 tracker_type='kcf', input_size=None, centroid_tracker='dict', max_distance=None, overlay=True,
+                 backend=None):
         """
         :param proto: Path to the prototxt
         :param model: Path to the caffe model
         :param confidence_threshold: Threshold of the confidence to filter less confident detections.
+        :param batched_inference: Shared `BatchedInference` from `create_batched_inference`, the network is not
+            loaded by this processor when set.
+        :param detect_every: Run the detector every `detect_every` frames. The boxes of the frames in between are
+            followed by a cheap single object tracker, and the detector runs again as soon as one of them is lost.
+        :param tracker_type: Single object tracker used between detections, see `create_tracker`.
+        :param input_size: Size the frames are resized to before detection, (width, height). The full frame size is
+            used if not set.
+        :param centroid_tracker: `dict` for `CentroidTracker`, `array` for the vectorized `ArrayCentroidTracker`
+            which scales to crowded scenes.
+        :param max_distance: Farthest a centroid may move between two frames, only for the `array` tracker.
+        :param overlay: Whether to draw the boxes and the ids of the objects on the frame.
+        :param backend: Keyword arguments of `create_backend`, OpenCV DNN with its defaults if not set.
         """
-        self.centroidTracker = CentroidTracker()
-        self.net = cv2.dnn.readNetFromCaffe(proto, model)
+        # scipy takes a while to import, only the cameras tracking objects need it
+        from CentroidTracker import CentroidTracker, ArrayCentroidTracker
+
+        self.overlay = overlay
+        if centroid_tracker == 'array':
+            self.centroidTracker = ArrayCentroidTracker(
+                maxDistance=max_distance, onRegister=self.on_track_start, onDeregister=self.on_track_end
+            )
+        else:
+            self.centroidTracker = CentroidTracker(onRegister=self.on_track_start, onDeregister=self.on_track_end)
+        self.track_events = []
+        self.batched_inference = batched_inference
+        self.input_size = None if input_size is None else tuple(input_size)
+        if batched_inference is None:
+            self.model = caffe_model(proto, model, self.input_size or (300, 300), create_backend(**(backend or {})))
+        else:
+            self.model = None
         self.confidence_threshold = confidence_threshold
+        self.detect_every = detect_every
+        self.tracker_type = tracker_type
+        self.trackers = []
+        self.frames_since_detection = 0
+        self.tracking_lost = True
 
-    def process(self, frame):
+    def detect_rects(self, frame):
+        """
+        Run the detector on a frame.
+        :return: List of boxes (start x, start y, end x, end y).
+        """
         (height, width) = frame.shape[:2]
 
-        blob = cv2.dnn.blobFromImage(frame, 1.0, (width, height), (104.0, 177.0, 123.0))
-        self.net.setInput(blob)
-        detections = self.net.forward()
+        if self.batched_inference is not None:
+            with metrics.timer('camera_process_seconds', step='inference'):
+                detections = self.batched_inference.infer(frame)
+        else:
+            with metrics.timer('camera_process_seconds', step='preprocess'):
+                input_size = self.input_size or (width, height)
+                blob = cv2.dnn.blobFromImage(frame, 1.0, input_size, self.mean)
+            with metrics.timer('camera_process_seconds', step='inference'):
+                detections = self.model.forward(blob)
         rects = []
 
-        for i in range(0, detections.shape[2]):
-            if detections[0, 0, i, 2] > self.confidence_threshold:
-                box = detections[0, 0, i, 3:7] * np.array([width, height, width, height])
-                rects.append(box.astype("int"))
+        with metrics.timer('camera_process_seconds', step='postprocess'):
+            for i in range(0, detections.shape[2]):
+                if detections[0, 0, i, 2] > self.confidence_threshold:
+                    box = detections[0, 0, i, 3:7] * np.array([width, height, width, height])
+                    rects.append(box.astype("int"))
+        return rects
+
+    def start_trackers(self, frame, rects):
+        self.trackers = []
+        for (startX, startY, endX, endY) in rects:
+            tracker = self.create_tracker(self.tracker_type)
+            tracker.init(frame, (int(startX), int(startY), int(endX - startX), int(endY - startY)))
+            self.trackers.append(tracker)
+        self.tracking_lost = False
+
+    def track_rects(self, frame):
+        """
+        Follow the last detected boxes on a frame.
+        :return: List of boxes (start x, start y, end x, end y) of the objects still tracked.
+        """
+        rects = []
+        for tracker in self.trackers:
+            (ok, (x, y, w, h)) = tracker.update(frame)
+            if not ok:
+                self.tracking_lost = True
+                continue
+            rects.append(np.array([x, y, x + w, y + h], dtype="int"))
+        return rects
 
-                (startX, startY, endX, endY) = box.astype("int")
-                cv2.rectangle(frame, (startX, startY), (endX, endY), (0, 255, 0), 2)
+    def on_track_start(self, object_id, centroid):
+        self.track_events.append(TrackEvent('start', object_id, (int(centroid[0]), int(centroid[1]))))
 
-        objects = self.centroidTracker.update(rects)
+    def on_track_end(self, object_id, centroid):
+        self.track_events.append(TrackEvent('end', object_id, (int(centroid[0]), int(centroid[1]))))
 
-        for (objectID, centroid) in objects.items():
-            text = "ID {}".format(objectID)
-            cv2.putText(
-                frame, text, (centroid[0] - 10, centroid[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2
-            )
-            cv2.circle(frame, (centroid[0], centroid[1]), 4, (0, 255, 0), -1)
+    def track_detections(self, rects, objects):
+        """
+        Give the boxes of a frame the ids the centroid tracker assigned to them.
+        :param rects: Boxes passed to the centroid tracker.
+        :param objects: Objects returned by the centroid tracker, id -> centroid.
+        :return: List of `Detection`.
+        """
+        disappeared = self.centroidTracker.disappeared
+        # objects seen in this frame sit exactly on the centroid of their box
+        ids = {
+            tuple(int(value) for value in centroid): object_id
+            for (object_id, centroid) in objects.items() if disappeared[object_id] == 0
+        }
+        return [
+            Detection('object', None, tuple(int(value) for value in rect),
+                      ids.get((int((rect[0] + rect[2]) / 2.0), int((rect[1] + rect[3]) / 2.0))))
+            for rect in rects
+        ]
+
+    def process(self, frame):
+        if self.detect_every <= 1:
+            rects = self.detect_rects(frame)
+        elif self.tracking_lost or self.frames_since_detection + 1 >= self.detect_every:
+            rects = self.detect_rects(frame)
+            self.start_trackers(frame, rects)
+            self.frames_since_detection = 0
+        else:
+            with metrics.timer('camera_process_seconds', step='track'):
+                rects = self.track_rects(frame)
+            self.frames_since_detection += 1
+
+        with metrics.timer('camera_process_seconds', step='postprocess'):
+            self.track_events = []
+            objects = self.centroidTracker.update(rects)
+            self.detections = self.track_detections(rects, objects)
+
+        if not self.overlay:
+            return frame
+
+        with metrics.timer('camera_process_seconds', step='draw'):
+            for (startX, startY, endX, endY) in rects:
+                cv2.rectangle(frame, (startX, startY), (endX, endY), (0, 255, 0), 2)
+
+            for (objectID, centroid) in objects.items():
+                text = "ID {}".format(objectID)
+                cv2.putText(
+                    frame, text, (centroid[0] - 10, centroid[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2
+                )
+                cv2.circle(frame, (centroid[0], centroid[1]), 4, (0, 255, 0), -1)
 
         return frame
+
+
+class MotionGatedFrameProcessor(FrameProcessor):
+    """
+    Run an expensive detector only where something moved.
+
+    Every frame first goes through the cheap motion stage of `AbsoluteMotionDetectionFrameProcessor`, compared with
+    the previous frame. The detector only runs when an area larger than `min_area` moved, and then only on the moved
+    areas, padded and cropped. Detections outside of the moved areas are kept from the previous frames.
+    """
+
+    def __init__(self, detector, min_area=500, tolerance=50, padding=32, max_roi_fraction=0.5, report_interval=100,
+                 process_width=None):
+        """
+        :param detector: Processor with `detect` and `draw`, e.g. `MobileNetSsdObjectDetectionFrameProcessor`. Its
+            `overlay` decides whether the detections are drawn.
+        :param min_area: A area, difference smaller than this will be ignored.
+        :param tolerance: Used for threshold the the difference, the lower the more sensitive.
+        :param padding: Pixels added around the moved areas before cropping, so that objects are not cut.
+        :param max_roi_fraction: When the moved areas cover more than this fraction of the frame, the detector runs
+            once on the whole frame instead.
+        :param report_interval: Print the number of skipped inferences every `report_interval` frames.
+        :param process_width: Width the frames are shrunk to before looking for motion, full size if not set.
+        """
+        self.detector = detector
+        self.overlay = detector.overlay
+        self.motion_detector = AbsoluteMotionDetectionFrameProcessor(
+            None, min_area, tolerance, process_width=process_width, background_rate=1.0
+        )
+        self.padding = padding
+        self.max_roi_fraction = max_roi_fraction
+        self.report_interval = report_interval
+        self.detections = []
+        self.frames = 0
+        self.inferences = 0
+        self.skipped_inferences = 0
+
+    def regions_of_interest(self, motion_boxes, frame_shape):
+        """
+        Pad the moved areas and merge the overlapping ones.
+        :return: List of (start x, start y, end x, end y).
+        """
+        (height, width) = frame_shape[:2]
+        rois = [
+            (max(0, x - self.padding), max(0, y - self.padding),
+             min(width, x + w + self.padding), min(height, y + h + self.padding))
+            for (x, y, w, h) in motion_boxes
+        ]
+
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(rois)):
+                for j in range(i + 1, len(rois)):
+                    (a, b) = (rois[i], rois[j])
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        rois[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                        del rois[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        if sum((x1 - x0) * (y1 - y0) for (x0, y0, x1, y1) in rois) > self.max_roi_fraction * width * height:
+            return [(0, 0, width, height)]
+        return rois
+
+    def process(self, frame):
+        (height, width) = frame.shape[:2]
+        first_frame = self.motion_detector.engine.background is None
+        # the frame becomes the background for the next one
+        motion_boxes = self.motion_detector.detect_motion(frame)
+        self.change_score = self.motion_detector.change_score
+        if first_frame:
+            rois = [(0, 0, width, height)]
+        else:
+            rois = self.regions_of_interest(motion_boxes, frame.shape)
+
+        if rois:
+            # keep what was detected where nothing moved
+            detections = [
+                detection for detection in self.detections
+                if not any(
+                    x0 <= (detection.box[0] + detection.box[2]) / 2 < x1 and
+                    y0 <= (detection.box[1] + detection.box[3]) / 2 < y1
+                    for (x0, y0, x1, y1) in rois
+                )
+            ]
+            for (x0, y0, x1, y1) in rois:
+                for detection in self.detector.detect(frame[y0:y1, x0:x1]):
+                    (start_x, start_y, end_x, end_y) = detection.box
+                    detections.append(detection._replace(box=(start_x + x0, start_y + y0, end_x + x0, end_y + y0)))
+            self.detections = detections
+            self.inferences += len(rois)
+        else:
+            self.skipped_inferences += 1
+            metrics.inc('camera_skipped_inferences_total')
+
+        self.frames += 1
+        if self.frames % self.report_interval == 0:
+            print(f'motion gate: {self.skipped_inferences} of {self.frames} frames skipped the detector, '
+                  f'{self.inferences} inferences run')
+        if not self.overlay:
+            return frame
+        with metrics.timer('camera_process_seconds', step='draw'):
+            return self.detector.draw(frame, self.detections)
@@ -1,6 +1,11 @@
+import threading
+import time
+
 import cv2
 from imutils.video import videostream
 
+from Metrics import metrics
+
 
 class FrameProvider:
     def next_frame(self):
@@ -24,7 +29,8 @@ class QueueFrameProvider(FrameProvider):
             self.source = cv2.VideoCapture(url)
 
     def next_frame(self):
-        frame = self.source.read()[1]
+        with metrics.timer('camera_capture_seconds'):
+            frame = self.source.read()[1]
         return frame
 
 
@@ -41,5 +47,107 @@ class NewestFrameProvider(FrameProvider):
             self.source = videostream.VideoStream(url).start()
 
     def next_frame(self):
-        frame = self.source.read()
+        with metrics.timer('camera_capture_seconds'):
+            frame = self.source.read()
+        return frame
+
+
+class FastFrameProvider(FrameProvider):
+    """
+    Hand out the most recent frame of a source while decoding only the frames that are asked for.
+
+    A thread keeps calling `grab`, so the stream is drained and never lags behind, but only calls `retrieve`, which
+    converts the frame and copies it out of the decoder, once `next_frame` waits for a frame and the frame interval
+    of `target_fps` has passed. The decoding cost thus follows the rate the frames are processed at rather than the
+    frame rate of the source. The stream is reopened, waiting longer after every failed attempt, when it is lost.
+    """
+
+    def __init__(self, use_local_camera=True, url=None, target_fps=None, max_width=None, hw_acceleration=True,
+                 min_backoff=0.5, max_backoff=30.0):
+        """
+        Initialize the frame provider.
+        :param use_local_camera: If using camera of the computer, set to `True`.
+        :param url: If using video over RTSP/HTTP, set this parameter. Ignored when `use_local_camera` is `True`.
+        :param target_fps: Most frames per second handed out, as many as asked for if not set.
+        :param max_width: Frames wider than this are shrunk. Local cameras are asked for frames of this size, other
+            sources are shrunk after decoding.
+        :param hw_acceleration: Let OpenCV decode on whatever hardware decoder is available, if it supports it.
+        :param min_backoff: Time in seconds before the first attempt to reopen a lost stream.
+        :param max_backoff: Longest time in seconds between two attempts to reopen the stream.
+        """
+        self.source_name = 0 if use_local_camera else url
+        self.frame_interval = 1 / target_fps if target_fps else 0
+        self.max_width = max_width
+        self.hw_acceleration = hw_acceleration
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_number = 0
+        self.waiting = False
+        self.skipped_frames = 0
+        threading.Thread(target=self.run, name='capture', daemon=True).start()
+
+    def open(self):
+        """
+        :return: `cv2.VideoCapture` of the source, opened or not.
+        """
+        if self.hw_acceleration and hasattr(cv2, 'CAP_PROP_HW_ACCELERATION'):
+            source = cv2.VideoCapture(
+                self.source_name, cv2.CAP_ANY, [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+            )
+        else:
+            source = cv2.VideoCapture(self.source_name)
+        if source.isOpened() and self.max_width is not None and isinstance(self.source_name, int):
+            # the camera may or may not support the size, frames are shrunk after decoding otherwise
+            width = source.get(cv2.CAP_PROP_FRAME_WIDTH)
+            height = source.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            if width > self.max_width:
+                source.set(cv2.CAP_PROP_FRAME_WIDTH, self.max_width)
+                source.set(cv2.CAP_PROP_FRAME_HEIGHT, round(height * self.max_width / width))
+        return source
+
+    def run(self):
+        backoff = self.min_backoff
+        source = self.open()
+        next_retrieve = 0
+        while True:
+            if not source.isOpened() or not source.grab():
+                source.release()
+                print(f'capture: cannot read {self.source_name}, retrying in {backoff:.1f}s')
+                time.sleep(backoff)
+                backoff = min(self.max_backoff, backoff * 2)
+                source = self.open()
+                continue
+            backoff = self.min_backoff
+
+            now = time.monotonic()
+            with self.condition:
+                wanted = self.waiting and now >= next_retrieve
+                if not wanted:
+                    self.skipped_frames += 1
+                    continue
+            (ok, frame) = source.retrieve()
+            if not ok:
+                continue
+            if self.max_width is not None and frame.shape[1] > self.max_width:
+                height = round(frame.shape[0] * self.max_width / frame.shape[1])
+                frame = cv2.resize(frame, (self.max_width, height), interpolation=cv2.INTER_AREA)
+            # keep the cadence of `target_fps` without catching up on the frames nobody asked for
+            next_retrieve = max(next_retrieve, now - self.frame_interval) + self.frame_interval
+            with self.condition:
+                self.frame = frame
+                self.frame_number += 1
+                self.condition.notify_all()
+
+    def next_frame(self):
+        with metrics.timer('camera_capture_seconds'):
+            with self.condition:
+                frame_number = self.frame_number
+                self.waiting = True
+                self.condition.wait_for(lambda: self.frame_number != frame_number)
+                self.waiting = False
+                (frame, skipped_frames) = (self.frame, self.skipped_frames)
+                self.skipped_frames = 0
+        metrics.inc('camera_skipped_decodes_total', skipped_frames)
         return frame
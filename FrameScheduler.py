@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+
+
+class FrameScheduler:
+    def wait(self):
+        """
+        Block until the next frame of the camera is due, called before every `FrameProvider.next_frame`. Frames are
+        taken as fast as they come by default.
+        """
+
+    def update(self, change_score, detections, process_time=None):
+        """
+        Report a processed frame.
+        :param change_score: `FrameProcessor.change_score` of the frame.
+        :param detections: `FrameProcessor.detections` of the frame.
+        :param process_time: Time in seconds spent processing the frame, `None` if unknown.
+        """
+
+
+class CpuBudget:
+    """
+    Processing time shared by the cameras of a process. Each camera declares how much processing time per second its
+    frame rate costs, and when all of them together ask for more than the budget, every camera is slowed down in the
+    same proportion.
+    """
+
+    def __init__(self, budget=None):
+        """
+        :param budget: Seconds of processing per second the cameras may use together, e.g. 2.0 for two cores. The
+            number of CPUs by default.
+        """
+        self.budget = budget or os.cpu_count()
+        self.demands = {}
+        self.lock = threading.Lock()
+
+    def request(self, owner, demand):
+        """
+        Declare the processing time per second a camera needs.
+        :param owner: Key of the camera, e.g. its scheduler.
+        :param demand: Seconds of processing per second at the frame rate the camera wants.
+        :return: Fraction of its frame rate the camera may run at, from 0 to 1.
+        """
+        with self.lock:
+            self.demands[owner] = demand
+            total = sum(self.demands.values())
+        return 1.0 if total <= self.budget else self.budget / total
+
+
+class AdaptiveFrameScheduler(FrameScheduler):
+    """
+    Take frames at `max_fps` while something is going on in front of the camera, and at `idle_fps` once nothing has
+    moved or been detected for `idle_after` seconds. Cameras nobody is watching run at most at `unwatched_fps`, the
+    web server marks the cameras being watched under their `viewer_key`.
+
+    The frame rate goes up on the first active frame and down only after the scene has been idle for a while, so a
+    short pause does not make the camera miss the next movement. With a `CpuBudget`, the rate is further scaled down
+    when the cameras together would need more processing time than the budget.
+    """
+
+    def __init__(self, max_fps=15.0, idle_fps=2.0, unwatched_fps=None, min_fps=0.5, min_change=0.001, idle_after=5.0,
+                 redis_client=None, viewer_key=None, viewer_check_interval=1.0, cpu_budget=None):
+        """
+        :param max_fps: Frame rate while the scene is active.
+        :param idle_fps: Frame rate while the scene is idle.
+        :param unwatched_fps: Highest frame rate while nobody is watching, `idle_fps` by default.
+        :param min_fps: Lowest frame rate the `cpu_budget` may slow the camera down to.
+        :param min_change: Frames whose change score reaches this are active, as are frames with detections.
+        :param idle_after: Time in seconds without an active frame before the frame rate goes down.
+        :param redis_client: Connection to the Redis server, the camera is always taken as watched if not set.
+        :param viewer_key: Key set by the web server while the camera is being watched, see `viewer_key`.
+        :param viewer_check_interval: Time in seconds between two checks of `viewer_key`.
+        :param cpu_budget: `CpuBudget` shared with the other cameras of the process.
+        """
+        self.max_fps = max_fps
+        self.idle_fps = idle_fps
+        self.unwatched_fps = idle_fps if unwatched_fps is None else unwatched_fps
+        self.min_fps = min_fps
+        self.min_change = min_change
+        self.idle_after = idle_after
+        self.redis_client = redis_client
+        self.viewer_key = viewer_key
+        self.viewer_check_interval = viewer_check_interval
+        self.cpu_budget = cpu_budget
+
+        self.watched = True
+        self.last_viewer_check = 0
+        self.last_active_time = time.monotonic()
+        self.process_time = None
+        self.fps = max_fps
+        self.next_frame_time = 0
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next_frame_time:
+            time.sleep(self.next_frame_time - now)
+            now = self.next_frame_time
+        # keep the cadence without catching up on the frames that were late
+        self.next_frame_time = max(self.next_frame_time, now - 1 / self.fps) + 1 / self.fps
+
+    def check_viewers(self, now):
+        if self.redis_client is None or now - self.last_viewer_check < self.viewer_check_interval:
+            return
+        self.last_viewer_check = now
+        try:
+            self.watched = bool(self.redis_client.exists(self.viewer_key))
+        except Exception as e:
+            # keep the camera at full speed while the viewers are unknown
+            print(f'scheduler: {e}')
+            self.watched = True
+
+    def update(self, change_score, detections, process_time=None):
+        now = time.monotonic()
+        if detections or (change_score is not None and change_score >= self.min_change):
+            self.last_active_time = now
+        self.check_viewers(now)
+
+        fps = self.max_fps if now - self.last_active_time < self.idle_after else self.idle_fps
+        if not self.watched:
+            fps = min(fps, self.unwatched_fps)
+
+        if process_time is not None:
+            # smoothed, a single slow frame should not slow the camera down
+            self.process_time = process_time if self.process_time is None else \
+                0.9 * self.process_time + 0.1 * process_time
+        if self.cpu_budget is not None and self.process_time is not None:
+            fps = max(min(fps, self.min_fps), fps * self.cpu_budget.request(self, fps * self.process_time))
+
+        self.fps = fps
@@ -0,0 +1,489 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import redis_lock
+
+from Metrics import metrics
+from Detections import detections_to_json, draw_detections
+
+
+def frame_key(camera_id=None):
+    """
+    Get the Redis key the frames of a camera are published under.
+    :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+    :return: `image` for the single camera, `image:<camera_id>` otherwise.
+    """
+    return 'image' if camera_id is None else f'image:{camera_id}'
+
+
+def rendition_key(key, rendition=None):
+    """
+    Get the Redis key a rendition of the frames is published under.
+    :param key: Key of the camera, see `frame_key`.
+    :param rendition: Name of the rendition, `None` or `full` for the full resolution frames.
+    :return: `key` for the full resolution frames, `<key>@<rendition>` otherwise.
+    """
+    return key if rendition is None or rendition == Rendition.full else f'{key}@{rendition}'
+
+
+def viewer_key(camera_id=None):
+    """
+    Get the Redis key the web server sets, with a short expiry, while someone is watching a camera.
+    :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+    :return: `<frame key>:viewed`, see `frame_key`.
+    """
+    return f'{frame_key(camera_id)}:viewed'
+
+
+def shared_frame_path(camera_id=None):
+    """
+    Get the path of the file backing the `SharedFrameRing` of a camera.
+    :param camera_id: Id of the camera, `None` for the single camera started by `Camera.py`.
+    """
+    return os.path.join(tempfile.gettempdir(), 'webartamenster-' + frame_key(camera_id).replace(':', '-'))
+
+
+class Rendition:
+    """
+    Size and JPEG quality a frame is encoded at, e.g. a small low quality one for thumbnails.
+    """
+
+    full = 'full'
+
+    def __init__(self, name=full, width=None, quality=95):
+        """
+        :param name: Name of the rendition, selected by `?size=<name>` on the `jpg` endpoint.
+        :param width: Width of the encoded frame, the height keeps the aspect ratio. `None` to keep the processed size,
+            frames are never enlarged.
+        :param quality: JPEG quality from 0 to 100, 95 is the default of OpenCV.
+        """
+        self.name = name
+        self.width = width
+        self.quality = quality
+
+    @staticmethod
+    def from_config(config):
+        """
+        :param config: Dict with `name` and optionally `width` and `quality`.
+        """
+        return Rendition(config['name'], config.get('width'), config.get('quality', 95))
+
+    def encode(self, frame):
+        """
+        Resize and encode a frame.
+        :param frame: Frame in openCV format.
+        :return: JPEG data.
+        """
+        (height, width) = frame.shape[:2]
+        if self.width is not None and self.width < width:
+            size = (self.width, max(1, round(height * self.width / width)))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tobytes()
+
+
+class FrameEncoder:
+    """
+    Encode a frame into several renditions at once. Renditions are encoded in parallel threads, OpenCV releases the
+    GIL while resizing and encoding.
+    """
+
+    def __init__(self, renditions=None):
+        """
+        :param renditions: List of `Rendition`, only the full resolution one by default.
+        """
+        self.renditions = renditions or [Rendition()]
+        self.executor = ThreadPoolExecutor(len(self.renditions)) if len(self.renditions) > 1 else None
+
+    def encode(self, frame):
+        """
+        :param frame: Frame in openCV format.
+        :return: Dict from the rendition names to the JPEG data.
+        """
+        if self.executor is None:
+            return {rendition.name: rendition.encode(frame) for rendition in self.renditions}
+        imgs = self.executor.map(lambda rendition: rendition.encode(frame), self.renditions)
+        return {rendition.name: img for (rendition, img) in zip(self.renditions, imgs)}
+
+
+class PublishPolicy:
+    def should_publish(self, change_score):
+        """
+        Decide whether a processed frame is worth encoding and publishing, every frame is by default.
+        :param change_score: `FrameProcessor.change_score` of the frame.
+        """
+        return True
+
+
+class ChangeThresholdPublishPolicy(PublishPolicy):
+    """
+    Skip the frames that barely differ from the previous one, so that an idle camera costs almost nothing to encode
+    and serve. Processors that do not measure changes get all their frames published.
+    """
+
+    def __init__(self, min_change, max_interval=5.0):
+        """
+        :param min_change: Frames whose change score is below this are skipped.
+        :param max_interval: A frame is published at least every `max_interval` seconds anyway.
+        """
+        self.min_change = min_change
+        self.max_interval = max_interval
+        self.last_publish_time = 0
+
+    def should_publish(self, change_score):
+        now = time.time()
+        changed = change_score is None or change_score >= self.min_change
+        if changed or now - self.last_publish_time >= self.max_interval:
+            self.last_publish_time = now
+            return True
+        return False
+
+
+class FramePublisher:
+    # Whether `encode` draws the detections on the frame, for processors that do not draw them.
+    overlay = False
+
+    def render(self, frame, detections):
+        """
+        :return: The frame with the detections drawn on a copy of it if `overlay` is set, the frame itself otherwise.
+        """
+        if self.overlay and detections:
+            with metrics.timer('camera_render_seconds'):
+                return draw_detections(frame.copy(), detections)
+        return frame
+
+    def encode(self, frame, detections=None):
+        """
+        Prepare a processed frame for `publish_encoded`, e.g. encode it to JPEG. May run in another thread than
+        `publish_encoded`. The frame is kept as is by default, see `render`.
+        :param frame: Frame to be published, openCV format (unencoded).
+        :param detections: `FrameProcessor.detections` of the frame.
+        """
+        return self.render(frame, detections)
+
+    def publish_encoded(self, data):
+        """
+        Publish a frame prepared by `encode`.
+        """
+        raise NotImplementedError
+
+    def publish(self, frame, detections=None):
+        """
+        Publish a processed frame so that the web server can show it.
+        :param frame: Frame to be published, openCV format (unencoded).
+        :param detections: `FrameProcessor.detections` of the frame.
+        """
+        self.publish_encoded(self.encode(frame, detections))
+
+
+class FrameReader:
+    def read(self):
+        """
+        Get the most recently published frame.
+        :return: (sequence number, JPEG data), the sequence number is `None` if the transport has none and the data
+            is `None` if nothing has been published yet.
+        """
+        raise NotImplementedError
+
+
+class RedisFramePublisher(FramePublisher):
+    """
+    Publish JPEG frames in Redis. Each rendition of the frame is stored under its `rendition_key`, the detections as
+    JSON under `<key>:detections` and the sequence number under `<key>:seq`, and an empty message is published on the
+    `<key>:notify` channel so that subscribers know a new frame is there.
+
+    All of them are written in one `MULTI` transaction and read back with one `MGET`, which Redis runs atomically, so
+    the `redis_lock` around them is not needed to keep them consistent. It is kept as the default for compatibility
+    with readers that still take the lock, set `locking` to `False` once all of them are lock-free.
+    """
+
+    def __init__(self, redis_client, key='image', locking=True, renditions=None, overlay=False):
+        """
+        :param redis_client: Connection to the Redis server.
+        :param key: Key to store the encoded frame in, see `frame_key`.
+        :param locking: Whether to hold a `redis_lock` on `key` while publishing.
+        :param renditions: List of `Rendition` to publish, only the full resolution one by default.
+        :param overlay: Whether to draw the detections on the frames before encoding them.
+        """
+        self.redis_client = redis_client
+        self.key = key
+        self.seq_key = f'{key}:seq'
+        self.detections_key = f'{key}:detections'
+        self.notify_channel = f'{key}:notify'
+        self.locking = locking
+        self.overlay = overlay
+        self.encoder = FrameEncoder(renditions)
+
+    def encode(self, frame, detections=None):
+        with metrics.timer('camera_encode_seconds'):
+            imgs = self.encoder.encode(self.render(frame, detections))
+        return imgs, None if detections is None else detections_to_json(detections, frame.shape)
+
+    def publish_encoded(self, data):
+        (imgs, detections) = data
+        pipeline = self.redis_client.pipeline(transaction=True)
+        for (name, img) in imgs.items():
+            pipeline.set(rendition_key(self.key, name), img)
+        if detections is not None:
+            pipeline.set(self.detections_key, detections)
+        pipeline.incr(self.seq_key)
+        pipeline.publish(self.notify_channel, b'')
+        with metrics.timer('camera_publish_seconds'):
+            if self.locking:
+                with redis_lock.Lock(self.redis_client, self.key):
+                    pipeline.execute()
+            else:
+                pipeline.execute()
+
+
+class RedisFrameReader(FrameReader):
+    def __init__(self, redis_client, key='image', locking=True, rendition=None):
+        """
+        :param redis_client: Connection to the Redis server.
+        :param key: Key the frames are published under, see `frame_key`.
+        :param locking: Whether to hold a `redis_lock` on `key` while reading, see `RedisFramePublisher`.
+        :param rendition: Name of the rendition to read, the full resolution one by default.
+        """
+        self.redis_client = redis_client
+        self.key = key
+        self.img_key = rendition_key(key, rendition)
+        self.seq_key = f'{key}:seq'
+        self.detections_key = f'{key}:detections'
+        self.locking = locking
+
+    def read(self):
+        if self.locking:
+            with redis_lock.Lock(self.redis_client, self.key):
+                (img, seq) = self.redis_client.mget(self.img_key, self.seq_key)
+        else:
+            (img, seq) = self.redis_client.mget(self.img_key, self.seq_key)
+        return (None if seq is None else int(seq)), img
+
+    def read_with_detections(self):
+        """
+        Get the most recently published frame together with its detections, read at once so that they match.
+        :return: (sequence number, JPEG data, JSON data from `Detections.detections_to_json` or `None`)
+        """
+        if self.locking:
+            with redis_lock.Lock(self.redis_client, self.key):
+                (img, seq, detections) = self.redis_client.mget(self.img_key, self.seq_key, self.detections_key)
+        else:
+            (img, seq, detections) = self.redis_client.mget(self.img_key, self.seq_key, self.detections_key)
+        return (None if seq is None else int(seq)), img, detections
+
+    def read_detections(self):
+        """
+        Get the detections of the most recently published frame, without the frame.
+        :return: (sequence number, JSON data from `Detections.detections_to_json`), `None` for the data if the
+            publisher did not send detections.
+        """
+        if self.locking:
+            with redis_lock.Lock(self.redis_client, self.key):
+                (detections, seq) = self.redis_client.mget(self.detections_key, self.seq_key)
+        else:
+            (detections, seq) = self.redis_client.mget(self.detections_key, self.seq_key)
+        return (None if seq is None else int(seq)), detections
+
+
+class SharedFrameRing:
+    """
+    Ring buffer of raw frames in a memory mapped file, shared by one writer process and any number of readers.
+
+    Every slot carries the sequence number of the frame in it. The writer clears it before overwriting the slot and
+    sets it once the frame is complete, so a reader knows the frame it copied or encoded is intact if the sequence
+    number is the same before and after.
+    """
+
+    magic = b'WAFR'
+    # magic, slot count, slot size, latest sequence number
+    header = struct.Struct('<4sIQQ')
+    latest_seq_offset = 16
+    # sequence number, height, width, channels
+    slot_header = struct.Struct('<QIII')
+    data_offset = 64
+
+    def __init__(self, path, mm, slots, slot_size):
+        self.path = path
+        self.mm = mm
+        self.slots = slots
+        self.slot_size = slot_size
+
+    @staticmethod
+    def create(path, slots, slot_size, latest_seq=0):
+        """
+        Create the ring, an existing ring at `path` is atomically replaced.
+        :param path: Path of the backing file, see `shared_frame_path`.
+        :param slots: Number of frames kept in the ring.
+        :param slot_size: Maximum size of a frame in bytes.
+        :param latest_seq: Sequence number the frames of the ring follow, to go on from a replaced ring.
+        """
+        cls = SharedFrameRing
+        size = cls.data_offset + slots * (cls.slot_header.size + slot_size)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w+b') as f:
+            f.truncate(size)
+            mm = mmap.mmap(f.fileno(), size)
+        cls.header.pack_into(mm, 0, cls.magic, slots, slot_size, latest_seq)
+        os.replace(tmp_path, path)
+        return SharedFrameRing(path, mm, slots, slot_size)
+
+    @staticmethod
+    def open(path):
+        """
+        Open a ring created by another process.
+        :return: The ring, `None` if it does not exist yet.
+        """
+        cls = SharedFrameRing
+        try:
+            with open(path, 'r+b') as f:
+                mm = mmap.mmap(f.fileno(), 0)
+        except (FileNotFoundError, ValueError):
+            return None
+        (magic, slots, slot_size, _) = cls.header.unpack_from(mm, 0)
+        if magic != cls.magic:
+            mm.close()
+            return None
+        return SharedFrameRing(path, mm, slots, slot_size)
+
+    def slot_offset(self, seq):
+        return self.data_offset + (seq % self.slots) * (self.slot_header.size + self.slot_size)
+
+    def latest_seq(self):
+        return self.header.unpack_from(self.mm, 0)[3]
+
+    def slot_seq(self, seq):
+        return self.slot_header.unpack_from(self.mm, self.slot_offset(seq))[0]
+
+    def write(self, frame):
+        """
+        Copy a frame into the next slot.
+        :param frame: Frame in openCV format.
+        :return: Sequence number of the frame.
+        """
+        if frame.nbytes > self.slot_size:
+            raise ValueError(f'frame of {frame.nbytes} bytes does not fit in slots of {self.slot_size} bytes')
+
+        seq = self.latest_seq() + 1
+        offset = self.slot_offset(seq)
+        (height, width) = frame.shape[:2]
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+
+        self.slot_header.pack_into(self.mm, offset, 0, height, width, channels)
+        data = np.ndarray(frame.shape, np.uint8, self.mm, offset + self.slot_header.size)
+        np.copyto(data, frame)
+        self.slot_header.pack_into(self.mm, offset, seq, height, width, channels)
+        struct.pack_into('<Q', self.mm, self.latest_seq_offset, seq)
+        return seq
+
+    def view(self, seq):
+        """
+        Get the frame of a sequence number without copying it. Check `slot_seq(seq) == seq` once done with the view
+        to make sure the writer did not overwrite it meanwhile.
+        :return: The frame, `None` if the slot no longer holds it.
+        """
+        offset = self.slot_offset(seq)
+        (slot_seq, height, width, channels) = self.slot_header.unpack_from(self.mm, offset)
+        if slot_seq != seq:
+            return None
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        return np.ndarray(shape, np.uint8, self.mm, offset + self.slot_header.size)
+
+    def close(self):
+        self.mm.close()
+
+
+class SharedMemoryFramePublisher(FramePublisher):
+    """
+    Publish raw frames in a `SharedFrameRing`. Detections are not published, only drawn if `overlay` is set.
+
+    A frame larger than the slots, e.g. after the camera reconnects at a higher resolution, replaces the ring with one
+    whose slots fit it; readers reopen the file when it is replaced.
+    """
+
+    def __init__(self, path, slots=4, slot_size=None, overlay=False):
+        """
+        :param path: Path of the ring, see `shared_frame_path`.
+        :param slots: Number of frames kept in the ring.
+        :param slot_size: Size of the slots in bytes, the size of the first frame if not set or smaller.
+        :param overlay: Whether to draw the detections on the frames.
+        """
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.overlay = overlay
+        self.ring = None
+
+    def publish_encoded(self, frame):
+        if self.ring is None or frame.nbytes > self.ring.slot_size:
+            latest_seq = 0
+            if self.ring is not None:
+                latest_seq = self.ring.latest_seq()
+                self.ring.close()
+            self.ring = SharedFrameRing.create(
+                self.path, self.slots, max(self.slot_size or 0, frame.nbytes), latest_seq
+            )
+        with metrics.timer('camera_publish_seconds'):
+            self.ring.write(frame)
+
+
+class SharedMemoryFrameReader(FrameReader):
+    """
+    Read frames from a `SharedFrameRing`. Frames are encoded on demand, and only once however many viewers ask for
+    the same frame.
+    """
+
+    def __init__(self, path, retries=3, rendition=None):
+        """
+        :param path: Path of the ring, see `shared_frame_path`.
+        :param retries: Number of attempts when the writer overwrites a frame while it is being encoded.
+        :param rendition: `Rendition` the frames are encoded at, full resolution by default.
+        """
+        self.path = path
+        self.retries = retries
+        self.rendition = rendition or Rendition()
+        self.ring = None
+        self.ring_inode = None
+        self.lock = threading.Lock()
+        self.cached_seq = None
+        self.cached_img = None
+
+    def open_ring(self):
+        # the writer replaces the file when it restarts, reopen it then
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+        if self.ring is None or inode != self.ring_inode:
+            if self.ring is not None:
+                self.ring.close()
+            self.ring = SharedFrameRing.open(self.path)
+            self.ring_inode = inode
+            self.cached_seq = None
+            self.cached_img = None
+        return self.ring
+
+    def read(self):
+        with self.lock:
+            ring = self.open_ring()
+            if ring is None:
+                return None, None
+
+            for _ in range(self.retries):
+                seq = ring.latest_seq()
+                if seq == 0 or seq == self.cached_seq:
+                    break
+                frame = ring.view(seq)
+                if frame is None:
+                    continue
+                img = self.rendition.encode(frame)
+                if ring.slot_seq(seq) == seq:
+                    self.cached_seq = seq
+                    self.cached_img = img
+                    break
+            return self.cached_seq, self.cached_img
@@ -0,0 +1,169 @@
+import argparse
+
+import cv2
+
+
+class InferenceBackend:
+    """
+    The way networks are run: loads the files of a network and runs forward passes on blobs made by
+    `cv2.dnn.blobFromImage(s)`. Networks are loaded through `ModelRegistry`, keyed by the files and `key` of the
+    backend, so that cameras running the same network the same way share it.
+    """
+
+    def key(self):
+        """
+        :return: Hashable description of the backend and its options.
+        """
+        raise NotImplementedError
+
+    def load(self, kind, *paths):
+        """
+        Load a network.
+        :param kind: `caffe` for (prototxt, caffe model), `darknet` for (cfg, weights).
+        :param paths: Paths to the files of the network.
+        :return: The loaded network, only handed to `forward` of the same backend.
+        """
+        raise NotImplementedError
+
+    def forward(self, net, blob):
+        """
+        Run a forward pass.
+        :param net: Network from `load`.
+        :param blob: Input blob, (batch, channels, height, width) float32.
+        :return: Output of the network, as `cv2.dnn.Net.forward` returns it.
+        """
+        raise NotImplementedError
+
+
+class OpenCvBackend(InferenceBackend):
+    """
+    OpenCV DNN with an explicit backend and target, e.g. `openvino` on `cpu`, or the `cpu_fp16` target for half
+    precision on CPUs supporting it. The names not available in the installed build of OpenCV are left out.
+    """
+
+    backends = {
+        name: getattr(cv2.dnn, constant)
+        for (name, constant) in (
+            ('default', 'DNN_BACKEND_DEFAULT'), ('opencv', 'DNN_BACKEND_OPENCV'),
+            ('openvino', 'DNN_BACKEND_INFERENCE_ENGINE'), ('cuda', 'DNN_BACKEND_CUDA'),
+        )
+        if hasattr(cv2.dnn, constant)
+    }
+    targets = {
+        name: getattr(cv2.dnn, constant)
+        for (name, constant) in (
+            ('cpu', 'DNN_TARGET_CPU'), ('cpu_fp16', 'DNN_TARGET_CPU_FP16'), ('opencl', 'DNN_TARGET_OPENCL'),
+            ('opencl_fp16', 'DNN_TARGET_OPENCL_FP16'), ('cuda', 'DNN_TARGET_CUDA'),
+            ('cuda_fp16', 'DNN_TARGET_CUDA_FP16'),
+        )
+        if hasattr(cv2.dnn, constant)
+    }
+    readers = {
+        'caffe': 'readNetFromCaffe',
+        'darknet': 'readNetFromDarknet',
+    }
+
+    def __init__(self, backend='default', target='cpu', threads=None):
+        """
+        :param backend: One of `backends`.
+        :param target: One of `targets`.
+        :param threads: Number of threads of OpenCV, all the OpenCV networks of the process share them, so the last
+            loaded network sets it. OpenCV picks it if not set.
+        """
+        if backend not in self.backends:
+            raise ValueError(f'unknown OpenCV DNN backend: {backend}, available: {", ".join(self.backends)}')
+        if target not in self.targets:
+            raise ValueError(f'unknown OpenCV DNN target: {target}, available: {", ".join(self.targets)}')
+        self.backend = backend
+        self.target = target
+        self.threads = threads
+
+    def key(self):
+        return 'opencv', self.backend, self.target, self.threads
+
+    def load(self, kind, *paths):
+        if kind not in self.readers:
+            raise ValueError(f'OpenCV DNN does not read {kind} networks')
+        if self.threads is not None:
+            cv2.setNumThreads(self.threads)
+        net = getattr(cv2.dnn, self.readers[kind])(*paths)
+        net.setPreferableBackend(self.backends[self.backend])
+        net.setPreferableTarget(self.targets[self.target])
+        return net
+
+    def forward(self, net, blob):
+        net.setInput(blob)
+        return net.forward()
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """
+    ONNX Runtime on CPU, for networks converted to ONNX and usually quantized to INT8 with `quantize_model`.
+
+    The files of the network given to `load` only name it, the weights come from `model`, whose output must be laid
+    out like the output of the original network in OpenCV, e.g. (1, 1, N, 7) for SSD. onnxruntime is imported on
+    the first load, so it is only needed by the cameras using it.
+    """
+
+    def __init__(self, model=None, threads=None):
+        """
+        :param model: Path to the ONNX model.
+        :param threads: Number of threads of a forward pass, ONNX Runtime picks it if not set.
+        """
+        if not model:
+            raise ValueError('the onnx backend needs the path to an ONNX model')
+        self.model = model
+        self.threads = threads
+
+    def key(self):
+        return 'onnx', self.model, self.threads
+
+    def load(self, kind, *paths):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if self.threads is not None:
+            options.intra_op_num_threads = self.threads
+        return onnxruntime.InferenceSession(self.model, options, providers=['CPUExecutionProvider'])
+
+    def forward(self, net, blob):
+        return net.run(None, {net.get_inputs()[0].name: blob})[0]
+
+
+def create_backend(type='opencv', **options):
+    """
+    Create an inference backend.
+    :param type: `opencv` or `onnx`.
+    :param options: Keyword arguments of `OpenCvBackend` or `OnnxRuntimeBackend`, e.g. `target`, `threads` or
+        `model`.
+    :return: The `InferenceBackend`.
+    """
+    if type == 'opencv':
+        return OpenCvBackend(**options)
+    elif type == 'onnx':
+        return OnnxRuntimeBackend(**options)
+    else:
+        raise ValueError(f'unknown inference backend: {type}')
+
+
+def quantize_model(source, destination):
+    """
+    Quantize the weights of an ONNX model to INT8, activations are quantized on the fly when the model runs.
+    :param source: Path to the float ONNX model.
+    :param destination: Path the quantized model is written to.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(source, destination, weight_type=QuantType.QInt8)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='quantize an ONNX model to INT8 for the onnx backend')
+    parser.add_argument('source', metavar='source', type=str,
+                        help='path to the float ONNX model')
+    parser.add_argument('destination', metavar='destination', type=str,
+                        help='path to write the quantized model to')
+
+    args = parser.parse_args()
+
+    quantize_model(args.source, args.destination)
@@ -0,0 +1,233 @@
+import collections
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+
+class RollingHistogram:
+    """
+    Latencies of the most recent observations of a metric, along with the total count and sum of all of them.
+    """
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=1000):
+        """
+        :param window: Number of recent observations the quantiles and the rate are computed over.
+        """
+        self.samples = collections.deque(maxlen=window)
+        self.times = collections.deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.times.append(time.time())
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """
+        :return: Dict with the quantiles, count, sum and rate per second of the observations.
+        """
+        samples = list(self.samples)
+        times = list(self.times)
+        if samples:
+            values = np.percentile(samples, [q * 100 for q in self.quantiles])
+            quantiles = {str(q): float(value) for (q, value) in zip(self.quantiles, values)}
+        else:
+            quantiles = {}
+        # observations within the window, counted from the oldest one up to now
+        elapsed = time.time() - times[0] if times else 0
+        rate = (len(times) - 1) / elapsed if len(times) > 1 and elapsed > 0 else 0.0
+        return {'quantiles': quantiles, 'count': self.count, 'sum': self.sum, 'rate': rate}
+
+
+class MetricsRegistry:
+    """
+    Latency histograms and counters of a process, labelled e.g. by camera and processing step.
+
+    Labels set with `labels` apply to everything the current thread records until the block ends, so that the
+    processors and publishers do not need to know which camera they are working for.
+    """
+
+    def __init__(self, window=1000):
+        """
+        :param window: Number of recent observations kept per histogram.
+        """
+        self.window = window
+        # the registry of the module is created on the first import of `Metrics`, early in the start of a process
+        self.created = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def labels(self, **labels):
+        """
+        Add labels to the metrics recorded by the current thread within the block, labels set to `None` are left out.
+        """
+        previous = getattr(self.local, 'labels', {})
+        self.local.labels = dict(previous, **{
+            name: str(value) for (name, value) in labels.items() if value is not None
+        })
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    def key(self, name, labels):
+        labels = dict(getattr(self.local, 'labels', {}), **{
+            name: str(value) for (name, value) in labels.items() if value is not None
+        })
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        """
+        Record an observation of a histogram, e.g. a latency in seconds.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = RollingHistogram(self.window)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Record the time spent in the block in seconds.
+        """
+        now = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - now, **labels)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self):
+        """
+        :return: JSON serializable state of the metrics, see `render`.
+        """
+        with self.lock:
+            histograms = list(self.histograms.items())
+            counters = list(self.counters.items())
+        return {
+            'histograms': [[name, dict(labels), histogram.snapshot()] for ((name, labels), histogram) in histograms],
+            'counters': [[name, dict(labels), value] for ((name, labels), value) in counters],
+        }
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = {name: value.replace('\\', '\\\\').replace('"', '\\"') for (name, value) in labels.items()}
+    return '{' + ','.join(f'{name}="{value}"' for (name, value) in sorted(escaped.items())) + '}'
+
+
+def render(snapshots):
+    """
+    Render metrics in the Prometheus text format.
+    :param snapshots: List of `MetricsRegistry.snapshot`, e.g. of the web server and of every camera process. The
+        series of snapshots with a `process` entry, see `read_published_snapshots`, get it as a label, so that two
+        processes recording the same series do not render duplicate samples.
+    :return: The text.
+    """
+    summaries = collections.defaultdict(list)
+    rates = collections.defaultdict(list)
+    counters = collections.defaultdict(list)
+    for snapshot in snapshots:
+        if 'process' in snapshot:
+            snapshot = dict(snapshot, **{
+                kind: [[name, dict(labels, process=snapshot['process'])] + rest for (name, labels, *rest) in series]
+                for (kind, series) in (('histograms', snapshot['histograms']), ('counters', snapshot['counters']))
+            })
+        for (name, labels, histogram) in snapshot['histograms']:
+            summaries[name].append((labels, histogram))
+            # e.g. `camera_publish_seconds` -> `camera_publish_fps`
+            rates[name[:-len('_seconds')] + '_fps' if name.endswith('_seconds') else name + '_rate'].append(
+                (labels, histogram['rate'])
+            )
+        for (name, labels, value) in snapshot['counters']:
+            counters[name].append((labels, value))
+
+    lines = []
+    for (name, series) in sorted(summaries.items()):
+        lines.append(f'# TYPE {name} summary')
+        for (labels, histogram) in series:
+            for (quantile, value) in histogram['quantiles'].items():
+                lines.append(f'{name}{format_labels(dict(labels, quantile=quantile))} {value}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+    for (name, series) in sorted(rates.items()):
+        lines.append(f'# TYPE {name} gauge')
+        for (labels, value) in series:
+            lines.append(f'{name}{format_labels(labels)} {value}')
+    for (name, series) in sorted(counters.items()):
+        lines.append(f'# TYPE {name} counter')
+        for (labels, value) in series:
+            lines.append(f'{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsPublisher:
+    """
+    Store the snapshot of the metrics of a camera process in Redis every few seconds, for the `metrics` endpoint of
+    the web server. The key expires when the process stops.
+    """
+
+    key_prefix = 'metrics:'
+
+    def __init__(self, redis_client, registry=None, interval=5.0):
+        """
+        :param redis_client: Connection to the Redis server.
+        :param registry: `MetricsRegistry` to publish, the one of the process by default.
+        :param interval: Time in seconds between two snapshots.
+        """
+        self.redis_client = redis_client
+        self.registry = registry or metrics
+        self.interval = interval
+        self.key = f'{self.key_prefix}{socket.gethostname()}:{os.getpid()}'
+
+    def start(self):
+        threading.Thread(target=self.run, name='metrics', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                self.redis_client.set(
+                    self.key, json.dumps(self.registry.snapshot()), ex=max(1, int(self.interval * 3))
+                )
+            except Exception as e:
+                print(f'metrics: {e}')
+            time.sleep(self.interval)
+
+
+def read_published_snapshots(redis_client):
+    """
+    :return: List of the snapshots stored by the `MetricsPublisher` of the running camera processes, each with a
+        `process` entry, `<host>:<pid>` from its key.
+    """
+    keys = list(redis_client.scan_iter(f'{MetricsPublisher.key_prefix}*'))
+    if not keys:
+        return []
+    return [
+        dict(json.loads(value), process=key.decode()[len(MetricsPublisher.key_prefix):])
+        for (key, value) in zip(keys, redis_client.mget(keys)) if value is not None
+    ]
+
+
+# metrics of the current process
+metrics = MetricsRegistry()
@@ -0,0 +1,136 @@
+import threading
+import time
+
+import numpy as np
+
+from InferenceBackend import OpenCvBackend
+from Metrics import metrics
+
+
+class SharedModel:
+    """
+    A network loaded by `ModelRegistry`, with the lock its users hold around a forward pass: OpenCV networks keep
+    their input and outputs in the network itself, so two threads must not run the same one at once.
+    """
+
+    def __init__(self, name, net, backend=None):
+        """
+        :param name: Name of the network in the metrics, e.g. the name of its weights file.
+        :param net: The loaded network.
+        :param backend: `InferenceBackend` that loaded the network, `None` for networks run by their own library.
+        """
+        self.name = name
+        self.net = net
+        self.backend = backend
+        self.lock = threading.Lock()
+
+    def forward(self, blob):
+        """
+        Run a forward pass through the backend of the network, holding the lock.
+        :param blob: Input blob, (batch, channels, height, width) float32.
+        :return: Output of the network.
+        """
+        with self.lock:
+            return self.backend.forward(self.net, blob)
+
+
+class ModelRegistry:
+    """
+    Networks of a process, each loaded once and shared by all the cameras and threads using it.
+
+    A network is loaded by the first processor asking for it, the others wait for it instead of loading their own
+    copy. It then goes through a warm-up forward pass on a blank input, which allocates its buffers and picks its
+    kernels before the first real frame comes. The load and warm-up times are recorded in
+    `camera_model_load_seconds` and `camera_model_warmup_seconds`, labelled by model.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, name, load, warm_up=None, backend=None):
+        """
+        Get a network, loading it if no one did yet.
+        :param key: Hashable key of the network, e.g. the paths of its files and the options it is loaded with.
+        :param name: Name of the network in the metrics.
+        :param load: Function returning the loaded network.
+        :param warm_up: Function running a forward pass on the loaded network, or `None` to skip the warm-up.
+        :param backend: `InferenceBackend` of the network, see `SharedModel`.
+        :return: The `SharedModel`.
+        """
+        with self.lock:
+            if key in self.models:
+                return self.models[key]
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        # networks are loaded in parallel, only the processors waiting for the same one block each other
+        with key_lock:
+            if key in self.models:
+                return self.models[key]
+            start = time.perf_counter()
+            net = load()
+            metrics.observe('camera_model_load_seconds', time.perf_counter() - start, model=name)
+            if warm_up is not None:
+                start = time.perf_counter()
+                warm_up(net)
+                metrics.observe('camera_model_warmup_seconds', time.perf_counter() - start, model=name)
+            model = SharedModel(name, net, backend)
+            with self.lock:
+                self.models[key] = model
+                del self.loading[key]
+            return model
+
+
+models = ModelRegistry()
+
+
+def dnn_model(kind, paths, input_size=(300, 300), backend=None):
+    """
+    Get the network shared by the processors running the same files with the same backend.
+    :param kind: `caffe` for (prototxt, caffe model), `darknet` for (cfg, weights).
+    :param paths: Paths to the files of the network.
+    :param input_size: Input size of the warm-up pass, (width, height).
+    :param backend: `InferenceBackend` running the network, OpenCV DNN with its defaults if not set.
+    :return: The `SharedModel`.
+    """
+    backend = OpenCvBackend() if backend is None else backend
+
+    def warm_up(net):
+        backend.forward(net, np.zeros((1, 3, input_size[1], input_size[0]), dtype=np.float32))
+
+    return models.get(
+        (kind,) + tuple(paths) + backend.key(), paths[-1].rsplit('/', 1)[-1], lambda: backend.load(kind, *paths),
+        warm_up, backend
+    )
+
+
+def caffe_model(proto, model, input_size=(300, 300), backend=None):
+    """
+    Get the Caffe network shared by the processors using the same files, see `dnn_model`.
+    :param proto: Path to the prototxt.
+    :param model: Path to the caffe model.
+    """
+    return dnn_model('caffe', (proto, model), input_size, backend)
+
+
+def darkflow_model(model, weights, gpu_limit, threshold, labels='cfg/coco.names'):
+    """
+    Get the darkflow network shared by the processors using the same files and options.
+    :param model: Path to the model.
+    :param weights: Path to the weights file.
+    :param gpu_limit: Limitation of GPU, set to 0 to run on CPU only.
+    :param threshold: Threshold of recognition, part of the network in darkflow.
+    :param labels: Path to the names of the classes of the network.
+    :return: The `SharedModel`.
+    """
+    def load():
+        # TensorFlow takes seconds to import, only the cameras running darkflow pay for it
+        from darkflow.net.build import TFNet
+        return TFNet({'model': model, 'load': weights, 'threshold': threshold, 'gpu': gpu_limit, 'labels': labels})
+
+    def warm_up(net):
+        net.return_predict(np.zeros((416, 416, 3), dtype=np.uint8))
+
+    return models.get(
+        ('darkflow', model, weights, gpu_limit, threshold, labels), weights.rsplit('/', 1)[-1], load, warm_up
+    )
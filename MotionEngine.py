@@ -0,0 +1,137 @@
+import cv2
+import imutils
+import numpy as np
+
+
+class MotionEngine:
+    """
+    Find the areas of frames that differ from a background, on a small blurred grayscale copy of the frames.
+
+    The frames are shrunk to `process_width` before anything else, so the conversion, the blur and the comparison
+    work on a fraction of the pixels, and the boxes found are scaled back to the size of the frames. Every
+    intermediate image lives in a buffer allocated once for the size of the frames, and the blurred frame computed for
+    the comparison is the one that goes into the background.
+
+    The background is an exponentially weighted running average of the blurred frames
+    (`cv2.accumulateWeighted`): `background_rate` 0 keeps the first frame forever, 1 compares every frame with the
+    previous one, and values in between let the background adapt to slow changes like daylight.
+    """
+
+    def __init__(self, process_width=None, min_area=500, tolerance=50, background_rate=0.0, blur_size=21,
+                 dilate_iterations=2):
+        """
+        :param process_width: Width the frames are shrunk to, the frames are processed at full size if not set.
+        :param min_area: A area of the full size frame, difference smaller than this will be ignored.
+        :param tolerance: Used for threshold the the difference, the lower the more sensitive.
+        :param background_rate: Weight of every new frame in the background, from 0 to 1.
+        :param blur_size: Size of the Gaussian blur on full size frames, scaled down with the frames.
+        :param dilate_iterations: Number of dilations joining the nearby changed pixels.
+        """
+        self.process_width = process_width
+        self.min_area = min_area
+        self.tolerance = tolerance
+        self.background_rate = background_rate
+        self.blur_size = blur_size
+        self.dilate_iterations = dilate_iterations
+        self.frame_shape = None
+        self.background = None
+        # fraction of the pixels that changed in the last compared frame
+        self.change_score = None
+
+    def allocate(self, frame_shape):
+        """
+        Allocate the buffers for frames of a shape, the background is dropped.
+        """
+        (height, width) = frame_shape[:2]
+        if self.process_width is None or self.process_width >= width:
+            (small_width, small_height) = (width, height)
+        else:
+            (small_width, small_height) = (self.process_width, max(1, round(height * self.process_width / width)))
+        self.frame_shape = frame_shape
+        self.size = (small_width, small_height)
+        self.scale = (width / small_width, height / small_height)
+        # odd kernel, shrunk with the frames
+        self.kernel_size = max(3, int(self.blur_size / self.scale[0]) | 1)
+        self.min_small_area = self.min_area / (self.scale[0] * self.scale[1])
+
+        self.small = np.empty((small_height, small_width) + tuple(frame_shape[2:]), dtype=np.uint8)
+        self.gray = np.empty((small_height, small_width), dtype=np.uint8)
+        self.blurred = np.empty_like(self.gray)
+        self.delta = np.empty_like(self.gray)
+        self.threshold = np.empty_like(self.gray)
+        self.dilated = np.empty_like(self.gray)
+        self.background_image = np.empty_like(self.gray)
+        self.background_average = np.empty((small_height, small_width), dtype=np.float32)
+        self.background = None
+
+    def prepare(self, frame):
+        """
+        Shrink, convert to grayscale and blur a frame into `blurred`.
+        :param frame: Frame in openCV format.
+        :return: The blurred frame, overwritten by the next call.
+        """
+        if frame.shape != self.frame_shape:
+            self.allocate(frame.shape)
+        if self.size == (frame.shape[1], frame.shape[0]):
+            small = frame
+        else:
+            small = cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        else:
+            np.copyto(self.gray, small)
+        cv2.GaussianBlur(self.gray, (self.kernel_size, self.kernel_size), 0, dst=self.blurred)
+        return self.blurred
+
+    def reset(self, frame=None):
+        """
+        Make a frame the background.
+        :param frame: New background, `None` to wait for the next frame, which then becomes the background.
+        """
+        if frame is None:
+            self.background = None
+            return
+        self.prepare(frame)
+        self.set_background()
+
+    def set_background(self):
+        """
+        Make the last prepared frame the background.
+        """
+        np.copyto(self.background_average, self.blurred)
+        np.copyto(self.background_image, self.blurred)
+        self.background = self.background_image
+
+    def compare(self):
+        """
+        Compare the last prepared frame with the background, then blend the frame into the background. The frame
+        becomes the background if there is none yet.
+        :return: List of bounding boxes (x, y, w, h) in the full size frame of the areas larger than `min_area`.
+        """
+        if self.background is None:
+            self.set_background()
+            self.change_score = 1.0
+            return []
+
+        cv2.absdiff(self.background_image, self.blurred, dst=self.delta)
+        cv2.threshold(self.delta, self.tolerance, 255, cv2.THRESH_BINARY, dst=self.threshold)
+        self.change_score = cv2.countNonZero(self.threshold) / self.threshold.size
+        cv2.dilate(self.threshold, None, dst=self.dilated, iterations=self.dilate_iterations)
+        contours = imutils.grab_contours(
+            cv2.findContours(self.dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        )
+
+        (scale_x, scale_y) = self.scale
+        boxes = []
+        for contour in contours:
+            if cv2.contourArea(contour) < self.min_small_area:
+                continue
+            (x, y, w, h) = cv2.boundingRect(contour)
+            boxes.append((int(x * scale_x), int(y * scale_y), int(round(w * scale_x)), int(round(h * scale_y))))
+
+        if self.background_rate >= 1:
+            self.set_background()
+        elif self.background_rate > 0:
+            cv2.accumulateWeighted(self.blurred, self.background_average, self.background_rate)
+            cv2.convertScaleAbs(self.background_average, dst=self.background_image)
+        return boxes
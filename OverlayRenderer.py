@@ -0,0 +1,94 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+class OverlayRenderer:
+    """
+    Draw translucent boxes and captions straight into a frame in openCV format.
+
+    The font is loaded once per process and every character is rasterized once into an alpha mask, captions are
+    assembled from these masks. Drawing blends the color into the pixels under the boxes and captions only, in place
+    and in BGR order, so the frame is never copied or converted.
+    """
+
+    fonts = {}
+
+    def __init__(self, font_path='Consolas.ttf', font_size=15, max_cached_captions=256):
+        """
+        :param font_path: Path to a TrueType font.
+        :param font_size: Size of the font in pixels.
+        :param max_cached_captions: Number of assembled caption masks kept, captions change with the confidence.
+        """
+        if (font_path, font_size) not in self.fonts:
+            self.fonts[(font_path, font_size)] = ImageFont.truetype(font_path, font_size)
+        self.font = self.fonts[(font_path, font_size)]
+        (ascent, descent) = self.font.getmetrics()
+        self.line_height = ascent + descent
+        self.glyphs = {}
+        self.captions = {}
+        self.max_cached_captions = max_cached_captions
+
+    def glyph(self, char):
+        """
+        :return: Alpha mask of a character, as wide as the advance of the character.
+        """
+        if char not in self.glyphs:
+            width = max(1, int(round(self.font.getlength(char))))
+            image = Image.new('L', (width, self.line_height))
+            ImageDraw.Draw(image).text((0, 0), char, fill=255, font=self.font)
+            self.glyphs[char] = np.asarray(image)
+        return self.glyphs[char]
+
+    def caption(self, text):
+        """
+        :return: Alpha mask of a caption.
+        """
+        if text not in self.captions:
+            if len(self.captions) >= self.max_cached_captions:
+                self.captions.clear()
+            self.captions[text] = np.hstack([self.glyph(char) for char in text])
+        return self.captions[text]
+
+    @staticmethod
+    def blend(frame, x, y, width, height, color, alpha, mask=None):
+        """
+        Blend a color into a region of the frame, in place. Parts of the region outside of the frame are skipped.
+        :param color: BGR color.
+        :param alpha: Opacity from 0 to 255.
+        :param mask: Alpha mask of the region, scaled by `alpha`, the whole region is covered if not set.
+        """
+        (frame_height, frame_width) = frame.shape[:2]
+        (x0, y0) = (max(0, x), max(0, y))
+        (x1, y1) = (min(frame_width, x + width), min(frame_height, y + height))
+        if x0 >= x1 or y0 >= y1:
+            return
+        region = frame[y0:y1, x0:x1]
+        if mask is None:
+            weight = np.float32(alpha / 255)
+        else:
+            weight = mask[y0 - y:y1 - y, x0 - x:x1 - x, None] * np.float32(alpha / 255 / 255)
+        blended = region + (np.asarray(color, dtype=np.float32) - region) * weight
+        np.copyto(region, blended, casting='unsafe')
+
+    def rectangle(self, frame, box, color, alpha, line_width=4):
+        """
+        Draw the outline of a box, the line is centered on the edges of the box.
+        :param box: (start x, start y, end x, end y).
+        """
+        (start_x, start_y, end_x, end_y) = [int(value) for value in box]
+        half = line_width // 2
+        (outer_x, outer_y) = (start_x - half, start_y - half)
+        (outer_width, outer_height) = (end_x - start_x + line_width, end_y - start_y + line_width)
+        # top and bottom edges span the corners, left and right edges fit in between
+        self.blend(frame, outer_x, outer_y, outer_width, line_width, color, alpha)
+        self.blend(frame, outer_x, end_y - half, outer_width, line_width, color, alpha)
+        self.blend(frame, outer_x, outer_y + line_width, line_width, outer_height - 2 * line_width, color, alpha)
+        self.blend(frame, end_x - half, outer_y + line_width, line_width, outer_height - 2 * line_width, color, alpha)
+
+    def text(self, frame, position, text, color, alpha):
+        """
+        Draw a caption with its top left corner at `position`.
+        """
+        mask = self.caption(text)
+        (x, y) = (int(position[0]), int(position[1]))
+        self.blend(frame, x, y, mask.shape[1], mask.shape[0], color, alpha, mask)
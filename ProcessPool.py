@@ -0,0 +1,377 @@
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from FrameTransport import PublishPolicy
+from FrameScheduler import FrameScheduler
+from Metrics import metrics
+
+# processors that keep state from one frame to the next, all the frames of a camera must go to the same worker
+stateful_process_methods = ('abs_motion', 'rel_motion', 'obj_tracker', 'gated_darknet', 'gated_ssd_obj')
+
+
+def is_stateful(process_method, options):
+    """
+    :return: Whether the processor keeps state from one frame to the next, e.g. a darknet processor with a
+        `latency_budget` measures the latency of its camera and switches to the fallback network on its own.
+    """
+    return process_method in stateful_process_methods or options.get('latency_budget') is not None
+
+
+class InitialFrameProvider:
+    """
+    Hand the first frame a worker gets to `AbsoluteMotionDetectionFrameProcessor` as its initial frame.
+    """
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    def next_frame(self):
+        return self.frame
+
+
+def work(tasks, results):
+    """
+    Body of the worker processes: process the frames found in shared memory and write the results back in place.
+    :param tasks: Queue of (camera id, sequence number, process method, options, slot, shared memory name, shape).
+    :param results: Queue of (camera id, sequence number, frame if it does not fit in place, change score,
+        detections, processing time in seconds, error).
+    """
+    # imported here, the workers load their own networks and the parent does not need this import
+    from Camera import create_frame_processor
+
+    processors = {}
+    slots = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (camera_id, seq, process_method, options, slot, name, shape) = task
+        if (camera_id, slot) in slots and slots[(camera_id, slot)].name != name:
+            # the pool grew the slot and unlinked the old segment, unmap it unless a processor still holds a view
+            (frame, processed_frame) = (None, None)
+            try:
+                slots.pop((camera_id, slot)).close()
+            except BufferError:
+                pass
+        if (camera_id, slot) not in slots:
+            slots[(camera_id, slot)] = shared_memory.SharedMemory(name)
+        frame = np.ndarray(shape, np.uint8, slots[(camera_id, slot)].buf)
+
+        if is_stateful(process_method, options):
+            key = camera_id
+        else:
+            # stateless processors are shared by all the cameras using the same method and options
+            key = (process_method, json.dumps(options, sort_keys=True))
+        try:
+            if key not in processors:
+                processors[key] = create_frame_processor(process_method, InitialFrameProvider(frame.copy()), **options)
+            processor = processors[key]
+            now = time.perf_counter()
+            processed_frame = processor.process(frame)
+            duration = time.perf_counter() - now
+            if processed_frame.shape == frame.shape and processed_frame.dtype == frame.dtype:
+                if processed_frame is not frame:
+                    np.copyto(frame, processed_frame)
+                processed_frame = None
+            results.put(
+                (camera_id, seq, processed_frame, processor.change_score, processor.detections, duration, None)
+            )
+        except Exception as e:
+            results.put((camera_id, seq, None, None, None, None, str(e)))
+
+    for slot in slots.values():
+        slot.close()
+
+
+class FrameProcessPool:
+    """
+    Process frames in a pool of worker processes, each of them loading its own networks, so that processing is not
+    limited to the one core the GIL allows a process.
+
+    Frames are handed to the workers through shared memory, only their slot and sequence number are pickled. Frames
+    of stateless processors (`darknet`, `ssd_obj`) go to the least busy worker. Frames of stateful processors go to
+    the worker the camera is pinned to, a single camera with a stateful processor therefore does not run faster, but
+    several of them are spread over the workers. A `darknet` processor with a `latency_budget` counts as stateful, see
+    `is_stateful`.
+
+    A worker process that dies is restarted, the frames it was processing fail and the cameras go on with the next
+    ones. Restarts are counted in `camera_pool_worker_restarts_total`.
+    """
+
+    def __init__(self, workers=4):
+        """
+        :param workers: Number of worker processes.
+        """
+        # spawned workers do not inherit the capture threads and network libraries of the parent
+        self.context = multiprocessing.get_context('spawn')
+        self.result_queue = self.context.Queue()
+        self.task_queues = [None] * workers
+        self.processes = [None] * workers
+        self.in_flight = [0] * workers
+        self.pinned_cameras = [0] * workers
+        self.processors = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+        for worker in range(workers):
+            self.start_worker(worker)
+        threading.Thread(target=self.collect, name='process-pool-results', daemon=True).start()
+
+    def start_worker(self, worker):
+        self.task_queues[worker] = self.context.Queue()
+        self.processes[worker] = self.context.Process(
+            target=work, args=(self.task_queues[worker], self.result_queue), daemon=True
+        )
+        self.processes[worker].start()
+
+    def frame_processor(self, camera_id, process_method, slots=None, **options):
+        """
+        Create the processor of a camera running in the pool.
+        :param camera_id: Id of the camera.
+        :param process_method: Process method of the camera, see `Camera.create_frame_processor`.
+        :param slots: Number of frames of the camera in flight, twice the number of workers by default.
+        :param options: Extra keyword arguments of the processor.
+        :return: The `PooledFrameProcessor`.
+        """
+        with self.lock:
+            if is_stateful(process_method, options):
+                worker = self.pinned_cameras.index(min(self.pinned_cameras))
+                self.pinned_cameras[worker] += 1
+            else:
+                worker = None
+            processor = PooledFrameProcessor(
+                self, camera_id, process_method, options, slots or 2 * len(self.processes), worker
+            )
+            self.processors[camera_id] = processor
+        return processor
+
+    def submit(self, processor, seq, task):
+        with self.lock:
+            worker = processor.worker
+            if worker is None:
+                worker = self.in_flight.index(min(self.in_flight))
+            self.in_flight[worker] += 1
+            # recorded before the task is sent, the result may come back right away
+            processor.workers[seq] = worker
+            # sent holding the lock, so that the task does not go to the queue of a worker being restarted
+            self.task_queues[worker].put(task)
+
+    def restart_dead_workers(self):
+        failed = []
+        with self.lock:
+            for (worker, process) in enumerate(self.processes):
+                if self.closed or process.is_alive():
+                    continue
+                print(f'process pool: worker {worker} stopped with exit code {process.exitcode}, restarting it')
+                metrics.inc('camera_pool_worker_restarts_total')
+                for processor in self.processors.values():
+                    for (seq, seq_worker) in list(processor.workers.items()):
+                        if seq_worker == worker:
+                            del processor.workers[seq]
+                            failed.append((processor, seq, worker))
+                # the tasks left in the queue are among the failed ones
+                self.task_queues[worker].cancel_join_thread()
+                self.task_queues[worker].close()
+                self.in_flight[worker] = 0
+                self.start_worker(worker)
+        for (processor, seq, worker) in failed:
+            processor.complete(seq, None, None, None, f'worker {worker} stopped while processing the frame')
+
+    def collect(self):
+        last_check = time.monotonic()
+        while True:
+            if time.monotonic() - last_check >= 1:
+                last_check = time.monotonic()
+                self.restart_dead_workers()
+            try:
+                result = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            (camera_id, seq, processed_frame, change_score, detections, duration, error) = result
+            processor = self.processors[camera_id]
+            with self.lock:
+                worker = processor.workers.pop(seq, None)
+                if worker is None:
+                    # failed already, its worker died after sending the result
+                    continue
+                self.in_flight[worker] -= 1
+            if duration is not None:
+                # the metrics of the workers stay in their processes, only the total processing time is reported
+                with metrics.labels(camera=camera_id):
+                    metrics.observe('camera_process_seconds', duration, step='total')
+            processor.complete(seq, processed_frame, change_score, detections, error)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for processor in self.processors.values():
+            processor.close()
+
+
+class PooledFrameProcessor:
+    """
+    Frames of one camera processed by a `FrameProcessPool`. Frames are submitted in capture order and the results come
+    out in the same order, whichever worker finishes first.
+    """
+
+    def __init__(self, pool, camera_id, process_method, options, slots, worker=None):
+        """
+        :param pool: The `FrameProcessPool`.
+        :param camera_id: Id of the camera.
+        :param process_method: Process method of the camera.
+        :param options: Extra keyword arguments of the processor.
+        :param slots: Number of frames in flight, `submit` waits when all of them are.
+        :param worker: Worker the camera is pinned to, `None` to use the least busy one.
+        """
+        self.pool = pool
+        self.camera_id = camera_id
+        self.process_method = process_method
+        self.options = options
+        self.worker = worker
+        self.slots = [None] * slots
+        self.free_slots = list(range(slots))
+        self.next_submit_seq = 0
+        self.next_result_seq = 0
+        # sequence number -> (slot, shape) of the frames in flight, and the worker they went to
+        self.submitted = {}
+        self.workers = {}
+        self.completed = {}
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def submit(self, frame):
+        """
+        Copy a frame into shared memory and hand it to a worker, waits while all the slots are in flight.
+        :param frame: Frame in openCV format.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.free_slots or self.closed)
+            if self.closed:
+                return
+            slot = self.free_slots.pop()
+            seq = self.next_submit_seq
+            self.next_submit_seq += 1
+
+        if self.slots[slot] is not None and self.slots[slot].size < frame.nbytes:
+            # e.g. the camera reconnected at a higher resolution, no worker uses a free slot
+            self.slots[slot].close()
+            self.slots[slot].unlink()
+            self.slots[slot] = None
+        if self.slots[slot] is None:
+            self.slots[slot] = shared_memory.SharedMemory(create=True, size=frame.nbytes)
+        np.copyto(np.ndarray(frame.shape, np.uint8, self.slots[slot].buf), frame)
+        with self.condition:
+            self.submitted[seq] = (slot, frame.shape)
+        task = (self.camera_id, seq, self.process_method, self.options, slot, self.slots[slot].name, frame.shape)
+        self.pool.submit(self, seq, task)
+
+    def complete(self, seq, processed_frame, change_score, detections, error):
+        with self.condition:
+            self.completed[seq] = (processed_frame, change_score, detections, error)
+            self.condition.notify_all()
+
+    def results(self):
+        """
+        Generate the processed frames in the order they were submitted, until the processor is closed.
+        :return: Generator of (processed frame, change score, detections).
+        """
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.next_result_seq in self.completed or self.closed, 0.1):
+                    continue
+                if self.closed:
+                    return
+                seq = self.next_result_seq
+                self.next_result_seq += 1
+                (processed_frame, change_score, detections, error) = self.completed.pop(seq)
+                (slot, shape) = self.submitted.pop(seq)
+                if processed_frame is None and error is None:
+                    processed_frame = np.ndarray(shape, np.uint8, self.slots[slot].buf).copy()
+                self.free_slots.append(slot)
+                self.condition.notify_all()
+
+            if error is not None:
+                print(f'camera {self.camera_id}: {error}')
+                continue
+            yield processed_frame, change_score, detections
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for slot in self.slots:
+            if slot is not None:
+                slot.close()
+                slot.unlink()
+
+
+class PooledCameraPipeline:
+    """
+    Capture, process and publish the frames of one camera, processing them in a `FrameProcessPool`. Frames are
+    submitted by the capture thread and published in capture order by a thread of their own.
+    """
+
+    def __init__(self, camera_id, frame_provider, frame_processor, frame_publisher, publish_policy=None,
+                 scheduler=None, recorder=None, detection_log=None):
+        """
+        :param camera_id: Id of the camera.
+        :param frame_provider: Provider of the camera frames.
+        :param frame_processor: `PooledFrameProcessor` of the camera.
+        :param frame_publisher: Publisher of the processed frames.
+        :param publish_policy: `PublishPolicy` deciding which processed frames are published, all of them by default.
+        :param scheduler: `FrameScheduler` deciding when the next frame is taken, as soon as it comes by default. The
+            workers share the processors, so no processing time is reported to it.
+        :param recorder: `EventRecorder` the processed frames are handed to, nothing is recorded if not set.
+        :param detection_log: `DetectionLog` the detections are handed to, nothing is logged if not set. The track
+            events stay in the workers.
+        """
+        self.camera_id = camera_id
+        self.frame_provider = frame_provider
+        self.frame_processor = frame_processor
+        self.frame_publisher = frame_publisher
+        self.publish_policy = publish_policy or PublishPolicy()
+        self.scheduler = scheduler or FrameScheduler()
+        self.recorder = recorder
+        self.detection_log = detection_log
+        self.running = False
+
+    def capture(self):
+        last_frame = None
+        with metrics.labels(camera=self.camera_id):
+            while self.running:
+                self.scheduler.wait()
+                frame = self.frame_provider.next_frame()
+                # `NewestFrameProvider` returns the same frame until the camera delivers a new one
+                if frame is None or frame is last_frame:
+                    time.sleep(0.005)
+                    continue
+                last_frame = frame
+                self.frame_processor.submit(frame)
+
+    def publish(self):
+        with metrics.labels(camera=self.camera_id):
+            for (processed_frame, change_score, detections) in self.frame_processor.results():
+                self.scheduler.update(change_score, detections)
+                if self.recorder is not None:
+                    self.recorder.submit(processed_frame, change_score, detections)
+                if self.detection_log is not None:
+                    self.detection_log.submit(detections)
+                if self.publish_policy.should_publish(change_score):
+                    self.frame_publisher.publish(processed_frame, detections)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.capture, name=f'capture-{self.camera_id}', daemon=True).start()
+        threading.Thread(target=self.publish, name=f'publish-{self.camera_id}', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.frame_processor.close()
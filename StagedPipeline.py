@@ -0,0 +1,237 @@
+import collections
+import threading
+import time
+
+from FrameTransport import PublishPolicy
+from FrameScheduler import FrameScheduler
+from Metrics import metrics
+
+
+class BoundedQueue:
+    """
+    Queue between two stages, what happens when it is full depends on the drop policy:
+
+    - `block`: the producer waits, no frame is lost (like `QueueFrameProvider`).
+    - `drop_oldest`: the oldest waiting frame is dropped, the consumer always gets the most recent ones (like
+      `NewestFrameProvider`).
+    - `drop_newest`: the incoming frame is dropped, the frames already waiting are kept.
+    """
+
+    drop_policies = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, max_size=1, drop_policy='drop_oldest', name=None):
+        """
+        :param max_size: Number of frames the queue can hold.
+        :param drop_policy: One of `block`, `drop_oldest` and `drop_newest`.
+        :param name: Name of the stage the queue feeds, labels the dropped frames in the metrics.
+        """
+        if drop_policy not in self.drop_policies:
+            raise ValueError(f'unknown drop policy: {drop_policy}')
+        self.name = name
+        self.max_size = max_size
+        self.drop_policy = drop_policy
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) >= self.max_size:
+                if self.drop_policy == 'block':
+                    self.condition.wait_for(lambda: len(self.items) < self.max_size)
+                elif self.drop_policy == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                    metrics.inc('camera_dropped_frames_total', stage=self.name)
+                else:
+                    self.dropped += 1
+                    metrics.inc('camera_dropped_frames_total', stage=self.name)
+                    return
+            self.items.append(item)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        :return: The oldest frame of the queue, `None` after `timeout` seconds without any.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0, timeout):
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Stage:
+    """
+    A step of the pipeline, running in a thread of its own and fed through a `BoundedQueue`.
+    """
+
+    def __init__(self, name, function, max_queue=1, drop_policy='drop_oldest', latency_window=100, camera_id=None):
+        """
+        :param name: Name of the stage in the stats.
+        :param function: Called with each frame of the queue, returns the frame for the next stage or `None` to stop
+            the frame here.
+        :param max_queue: Size of the input queue.
+        :param drop_policy: Drop policy of the input queue, see `BoundedQueue`.
+        :param latency_window: Number of frames the latency is averaged over.
+        :param camera_id: Id of the camera, labels the metrics recorded by the stage.
+        """
+        self.name = name
+        self.function = function
+        self.camera_id = camera_id
+        self.queue = BoundedQueue(max_queue, drop_policy, name)
+        self.next_stage = None
+        self.running = False
+        self.processed = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=latency_window)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, name=self.name, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        with metrics.labels(camera=self.camera_id):
+            while self.running:
+                item = self.queue.get(timeout=0.1)
+                if item is None:
+                    continue
+                now = time.perf_counter()
+                try:
+                    result = self.function(item)
+                except Exception as e:
+                    # the frame is lost, the stage goes on with the next one rather than stalling the camera
+                    print(f'camera {self.camera_id} {self.name}: {e}')
+                    self.errors += 1
+                    metrics.inc('camera_stage_errors_total', stage=self.name)
+                    continue
+                latency = time.perf_counter() - now
+                self.latencies.append(latency)
+                metrics.observe('camera_stage_seconds', latency, stage=self.name)
+                self.processed += 1
+                if result is not None and self.next_stage is not None:
+                    self.next_stage.queue.put(result)
+
+    def stats(self):
+        """
+        :return: Dict with the queue depth, the number of processed, dropped and failed frames and the mean latency
+            in seconds of the stage.
+        """
+        latencies = list(self.latencies)
+        return {
+            'queue_depth': len(self.queue),
+            'processed': self.processed,
+            'dropped': self.queue.dropped,
+            'errors': self.errors,
+            'latency': sum(latencies) / len(latencies) if latencies else 0.0,
+        }
+
+
+class StagedPipeline:
+    """
+    Capture, process, encode and publish the frames of one camera in four concurrent stages.
+
+    Each stage runs in its own thread and hands its frames to the next one through a bounded queue, so capture goes
+    on while the network runs and the network goes on while the previous frame is encoded. OpenCV releases the GIL in
+    decoding, inference and encoding, so the stages really overlap.
+    """
+
+    default_stages = {
+        'process': {'max_queue': 1, 'drop_policy': 'drop_oldest'},
+        'encode': {'max_queue': 2, 'drop_policy': 'drop_oldest'},
+        'publish': {'max_queue': 2, 'drop_policy': 'drop_oldest'},
+    }
+
+    def __init__(self, camera_id, frame_provider, frame_processor, frame_publisher, publish_policy=None,
+                 stages=None, scheduler=None, recorder=None, detection_log=None):
+        """
+        :param camera_id: Id of the camera.
+        :param frame_provider: Provider of the camera frames.
+        :param frame_processor: Processor applied to every frame.
+        :param frame_publisher: Publisher of the processed frames.
+        :param publish_policy: `PublishPolicy` deciding which processed frames are published, all of them by default.
+        :param stages: Dict from the stage names (`process`, `encode`, `publish`) to the `max_queue` and
+            `drop_policy` of their input queue, missing ones are taken from `default_stages`.
+        :param scheduler: `FrameScheduler` deciding when the next frame is taken, as soon as it comes by default.
+        :param recorder: `EventRecorder` the processed frames are handed to, nothing is recorded if not set.
+        :param detection_log: `DetectionLog` the detections and track events are handed to, nothing is logged if not
+            set.
+        """
+        self.camera_id = camera_id
+        self.frame_provider = frame_provider
+        self.frame_processor = frame_processor
+        self.frame_publisher = frame_publisher
+        self.publish_policy = publish_policy or PublishPolicy()
+        self.scheduler = scheduler or FrameScheduler()
+        self.recorder = recorder
+        self.detection_log = detection_log
+        self.running = False
+        self.captured = 0
+
+        stages = dict(self.default_stages, **(stages or {}))
+        self.stages = [
+            Stage('process', self.process, camera_id=camera_id, **stages['process']),
+            Stage('encode', self.encode, camera_id=camera_id, **stages['encode']),
+            Stage('publish', self.frame_publisher.publish_encoded, camera_id=camera_id, **stages['publish']),
+        ]
+        for (stage, next_stage) in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+
+    def process(self, frame):
+        start = time.perf_counter()
+        with metrics.timer('camera_process_seconds', step='total'):
+            processed_frame = self.frame_processor.process(frame)
+        self.scheduler.update(
+            self.frame_processor.change_score, self.frame_processor.detections, time.perf_counter() - start
+        )
+        if self.recorder is not None:
+            self.recorder.submit(processed_frame, self.frame_processor.change_score, self.frame_processor.detections)
+        if self.detection_log is not None:
+            self.detection_log.submit(self.frame_processor.detections, self.frame_processor.track_events)
+        if self.publish_policy.should_publish(self.frame_processor.change_score):
+            return processed_frame, self.frame_processor.detections
+        return None
+
+    def encode(self, item):
+        (processed_frame, detections) = item
+        return self.frame_publisher.encode(processed_frame, detections)
+
+    def capture(self):
+        last_frame = None
+        with metrics.labels(camera=self.camera_id):
+            while self.running:
+                self.scheduler.wait()
+                frame = self.frame_provider.next_frame()
+                # `NewestFrameProvider` returns the same frame until the camera delivers a new one
+                if frame is None or frame is last_frame:
+                    time.sleep(0.005)
+                    continue
+                last_frame = frame
+                self.captured += 1
+                self.stages[0].queue.put(frame)
+
+    def start(self):
+        self.running = True
+        for stage in self.stages:
+            stage.start()
+        threading.Thread(target=self.capture, name=f'capture-{self.camera_id}', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self):
+        """
+        :return: Dict from the stage names to their `Stage.stats`, plus the number of captured frames.
+        """
+        stats = {stage.name: stage.stats() for stage in self.stages}
+        stats['captured'] = self.captured
+        return stats
@@ -0,0 +1,186 @@
+"""
+Compare the inference backends of a detector on CPU: throughput, latency, and how far their detections are from the
+ones of the first backend, which serves as the reference.
+
+Backends are given as `type[:option=value,...]`, e.g. `opencv`, `opencv:target=cpu_fp16,threads=4` or
+`onnx:model=net/MobileNetSsd.int8.onnx`, see `InferenceBackend.create_backend`. `darkflow` runs `darknet` in darkflow
+as it does without a backend. Every backend runs in a fresh process, so that thread settings do not leak from one to
+the next. Run from the root of the repository:
+
+    python -m benchmark.InferenceBenchmark ssd_obj --video street.mp4 --backends opencv opencv:target=cpu_fp16 \\
+        onnx:model=net/MobileNetSsd.int8.onnx,threads=4
+
+A detection matches a reference detection of the same frame and label whose box overlaps it by at least `--iou`.
+Precision is the fraction of the detections of a backend matching the reference, recall the fraction of the reference
+detections they match. `obj_tracker` detections have no label.
+"""
+import json
+import multiprocessing
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import argparse
+import cv2
+import numpy as np
+
+from benchmark.ProcessorBenchmark import ReplayFrameProvider, percentiles, synthetic_frames, video_frames
+
+
+def parse_backend(text):
+    """
+    :return: Keyword arguments of `create_backend`, `None` for `darkflow`.
+    """
+    (backend_type, _, options) = text.partition(':')
+    if backend_type == 'darkflow':
+        return None
+    backend = {'type': backend_type}
+    for option in filter(None, options.split(',')):
+        (name, _, value) = option.partition('=')
+        backend[name] = int(value) if value.isdigit() else value
+    return backend
+
+
+def run_backend(method, backend, frames_config, warmup):
+    """
+    Run the detector of a process method on every frame, in its own process.
+    :return: Dict with the throughput, the latency percentiles and the detections of every frame as
+        [label, confidence, box] lists.
+    """
+    from Camera import create_frame_processor
+
+    (video, count, width, height, seed) = frames_config
+    frames = video_frames(video, count, width, height) if video else synthetic_frames(count, width, height, seed)
+    options = {'overlay': False}
+    if backend is not None:
+        options['backend'] = backend
+    start = time.perf_counter()
+    processor = create_frame_processor(method, ReplayFrameProvider(frames), **options)
+    load_time = time.perf_counter() - start
+
+    if method == 'obj_tracker':
+        def detect(frame):
+            return [[None, None, [int(value) for value in rect]] for rect in processor.detect_rects(frame)]
+    else:
+        def detect(frame):
+            return [
+                [detection.label, float(detection.confidence), [int(value) for value in detection.box]]
+                for detection in processor.detect(frame)
+            ]
+
+    for frame in frames[:warmup]:
+        detect(frame)
+    detections = []
+    latencies = []
+    start = time.perf_counter()
+    for frame in frames:
+        now = time.perf_counter()
+        detections.append(detect(frame))
+        latencies.append(time.perf_counter() - now)
+    elapsed = time.perf_counter() - start
+    return dict(load_seconds=load_time, fps=len(frames) / elapsed, **percentiles(latencies), detections=detections)
+
+
+def iou(a, b):
+    (width, height) = (min(a[2], b[2]) - max(a[0], b[0]), min(a[3], b[3]) - max(a[1], b[1]))
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def compare(detections, reference, min_iou):
+    """
+    Match the detections of a backend with the reference detections, frame by frame.
+    :return: Dict with the precision, the recall and the mean overlap of the matches.
+    """
+    (matched, overlaps) = (0, [])
+    for (frame_detections, frame_reference) in zip(detections, reference):
+        unmatched = list(frame_reference)
+        # most confident first, each reference detection matches at most once
+        for (label, confidence, box) in sorted(frame_detections, key=lambda detection: -(detection[1] or 0)):
+            candidates = [(iou(box, other[2]), i) for (i, other) in enumerate(unmatched) if other[0] == label]
+            if not candidates:
+                continue
+            (overlap, i) = max(candidates)
+            if overlap >= min_iou:
+                matched += 1
+                overlaps.append(overlap)
+                del unmatched[i]
+    total = sum(len(frame_detections) for frame_detections in detections)
+    total_reference = sum(len(frame_reference) for frame_reference in reference)
+    return {
+        'precision': matched / total if total else 1.0,
+        'recall': matched / total_reference if total_reference else 1.0,
+        'mean_iou': float(np.mean(overlaps)) if overlaps else None,
+    }
+
+
+def run(method, backends, frames_config, warmup, min_iou):
+    results = []
+    reference = None
+    context = multiprocessing.get_context('spawn')
+    for text in backends:
+        entry = {'backend': text}
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            try:
+                entry.update(executor.submit(run_backend, method, parse_backend(text), frames_config, warmup).result())
+            except Exception as e:
+                entry['error'] = f'{type(e).__name__}: {e}'
+        if 'error' in entry:
+            print(f'{text}: {entry["error"]}', file=sys.stderr)
+        else:
+            detections = entry.pop('detections')
+            if reference is None:
+                reference = detections
+            entry.update(compare(detections, reference, min_iou))
+            print(f'{text}: {entry["fps"]:.1f} frames/s, p99 {entry["p99_ms"]:.2f} ms, '
+                  f'precision {entry["precision"]:.3f}, recall {entry["recall"]:.3f}', file=sys.stderr)
+        results.append(entry)
+    return results
+
+
+if __name__ == '__main__':
+    from Camera import parse_size
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('method', metavar='method', type=str,
+                        help='< ssd_obj | obj_tracker | darknet >')
+    parser.add_argument('--backends', type=str, nargs='+', default=None,
+                        help='backends to compare, the first one is the reference; `darkflow opencv` for darknet, '
+                             '`opencv opencv:target=cpu_fp16` for the others if not set')
+    parser.add_argument('--video', type=str, default=None, help='recorded video to replay, synthetic frames if not set')
+    parser.add_argument('--frames', type=int, default=100, help='number of frames per backend')
+    parser.add_argument('--resolution', type=parse_size, default=(1280, 720))
+    parser.add_argument('--warmup', type=int, default=5, help='frames run before measuring')
+    parser.add_argument('--iou', type=float, default=0.5, help='overlap for a detection to match the reference')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the JSON there instead of stdout')
+
+    args = parser.parse_args()
+
+    if args.backends is None:
+        args.backends = ['darkflow', 'opencv'] if args.method == 'darknet' else ['opencv', 'opencv:target=cpu_fp16']
+    (width, height) = args.resolution
+    report = {
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'method': args.method,
+        'video': args.video,
+        'frames': args.frames,
+        'width': width,
+        'height': height,
+        'results': run(args.method, args.backends, (args.video, args.frames, width, height, args.seed), args.warmup,
+                       args.iou),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,104 @@
+"""
+Compare drawing the detections of `DarknetObjectDetectionFrameProcessor` through PIL, as it used to, with drawing them
+in place with `OverlayRenderer`.
+
+The PIL path loads the font, converts the frame to RGB and wraps it into an image for every frame, then converts it
+back. Run from the root of the repository:
+
+    python -m benchmark.OverlayBenchmark --resolutions 640x360 1280x720 1920x1080 --detections 5 20
+"""
+import time
+
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from Detections import Detection
+from OverlayRenderer import OverlayRenderer
+
+
+def draw_with_pil(frame, detections):
+    """
+    The drawing of `DarknetObjectDetectionFrameProcessor` before `OverlayRenderer`.
+    :return: New frame with the detections drawn.
+    """
+    image = Image.fromarray(frame[:, :, ::-1])
+    draw = ImageDraw.ImageDraw(image)
+    font = ImageFont.truetype('Consolas.ttf', 15)
+
+    for detection in detections:
+        if detection.confidence < 0.5:
+            continue
+
+        alpha = int((detection.confidence * 2 - 1) * 125 + 100)
+        (start_x, start_y, end_x, end_y) = detection.box
+        outline = (95, 248, 111, alpha)
+        corners = [(start_x, start_y), (end_x, start_y), (end_x, end_y), (start_x, end_y), (start_x, start_y)]
+        for (a, b) in zip(corners, corners[1:]):
+            draw.line([a, b], fill=outline, width=4)
+        text = f'{detection.label} - {"%.2f" % (100 * detection.confidence)}%'
+        draw.text((start_x, start_y - 18), text, fill=(95, 258, 111, alpha), font=font)
+    return np.array(image)[:, :, ::-1]
+
+
+def draw_with_renderer(renderer, frame, detections):
+    for detection in detections:
+        if detection.confidence < 0.5:
+            continue
+
+        alpha = int((detection.confidence * 2 - 1) * 125 + 100)
+        renderer.rectangle(frame, detection.box, (111, 248, 95), alpha, 4)
+        text = f'{detection.label} - {"%.2f" % (100 * detection.confidence)}%'
+        renderer.text(frame, (detection.box[0], detection.box[1] - 18), text, (111, 248, 95), alpha)
+    return frame
+
+
+def make_detections(count, width, height, rng):
+    labels = ['person', 'car', 'dog', 'bicycle', 'traffic light']
+    detections = []
+    for i in range(count):
+        (x, y) = (rng.randint(0, width - 100), rng.randint(20, height - 100))
+        (w, h) = (rng.randint(40, 100), rng.randint(40, 100))
+        detections.append(Detection(labels[i % len(labels)], rng.uniform(0.5, 1.0), (x, y, x + w, y + h)))
+    return detections
+
+
+def run(draw, frames, detections):
+    """
+    :return: Latencies in seconds.
+    """
+    latencies = []
+    for (frame, frame_detections) in zip(frames, detections):
+        now = time.perf_counter()
+        draw(frame, frame_detections)
+        latencies.append(time.perf_counter() - now)
+    return latencies
+
+
+if __name__ == '__main__':
+    from Camera import parse_size
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolutions', type=parse_size, nargs='+',
+                        default=[(640, 360), (1280, 720), (1920, 1080)])
+    parser.add_argument('--detections', type=int, nargs='+', default=[5, 20])
+    parser.add_argument('--frames', type=int, default=200)
+
+    args = parser.parse_args()
+
+    renderer = OverlayRenderer('Consolas.ttf', 15)
+    paths = [
+        ('PIL', draw_with_pil),
+        ('OverlayRenderer', lambda frame, detections: draw_with_renderer(renderer, frame, detections)),
+    ]
+
+    print(f'{"resolution":>11}{"boxes":>7}  {"path":<17}{"mean ms":>10}{"p99 ms":>10}')
+    for (width, height) in args.resolutions:
+        for count in args.detections:
+            rng = np.random.RandomState(0)
+            detections = [make_detections(count, width, height, rng) for _ in range(args.frames)]
+            for (name, draw) in paths:
+                frames = [np.full((height, width, 3), 64, dtype=np.uint8) for _ in range(args.frames)]
+                latencies = np.array(run(draw, frames, detections)) * 1000
+                print(f'{f"{width}x{height}":>11}{count:>7}  {name:<17}{latencies.mean():>10.3f}'
+                      f'{np.percentile(latencies, 99):>10.3f}')
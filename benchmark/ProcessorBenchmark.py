@@ -0,0 +1,252 @@
+"""
+Replay frames through every process method and through the encode/publish path, without a camera or a Redis server.
+
+Frames come from a recorded video (`--video`) or are synthesized: a noisy background with a few moving boxes, so that
+the motion processors have something to find. Every case runs in a fresh process, so that its peak RSS is its own,
+and the results are printed as JSON to compare releases. Run from the root of the repository:
+
+    python -m benchmark.ProcessorBenchmark --resolutions 640x360 1280x720 --output results.json
+
+Process methods whose network files are missing from `net/` are reported with their error instead of results.
+"""
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import argparse
+import cv2
+import numpy as np
+
+process_methods = ['abs_motion', 'rel_motion', 'darknet', 'ssd_obj', 'obj_tracker', 'gated_darknet', 'gated_ssd_obj']
+
+
+class InProcessRedis:
+    """
+    Stand-in for the few Redis commands `RedisFramePublisher` and `RedisFrameReader` use, kept in a dict.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, *keys):
+        return [self.values.get(key) for key in keys]
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+    def publish(self, channel, message):
+        return 0
+
+    def pipeline(self, transaction=True):
+        return InProcessRedisPipeline(self)
+
+
+class InProcessRedisPipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        return [getattr(self.redis_client, name)(*args, **kwargs) for (name, args, kwargs) in self.commands]
+
+
+class ReplayFrameProvider:
+    """
+    Frame provider handing out recorded frames in a loop.
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def next_frame(self):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return frame
+
+
+def synthetic_frames(count, width, height, seed=0):
+    """
+    :return: List of frames with a few boxes moving over a noisy background.
+    """
+    rng = np.random.RandomState(seed)
+    background = rng.randint(0, 64, (height, width, 3), dtype=np.uint8)
+    positions = rng.uniform([0, 0], [width, height], size=(4, 2))
+    speeds = rng.uniform(-0.01, 0.01, size=(4, 2)) * [width, height]
+    size = (max(8, width // 10), max(8, height // 10))
+    frames = []
+    for _ in range(count):
+        frame = background.copy()
+        positions = (positions + speeds) % [width, height]
+        for (i, (x, y)) in enumerate(positions.astype(int)):
+            cv2.rectangle(frame, (x, y), (x + size[0], y + size[1]), (80 + 40 * i, 255 - 40 * i, 160), -1)
+        frames.append(frame)
+    return frames
+
+
+def video_frames(path, count, width, height):
+    """
+    :return: List of the first `count` frames of a video resized to `width` x `height`, the video loops if shorter.
+    """
+    source = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < count:
+        (ok, frame) = source.read()
+        if not ok:
+            if not frames:
+                raise ValueError(f'cannot read video: {path}')
+            source.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            continue
+        frames.append(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA))
+    source.release()
+    return frames
+
+
+def percentiles(latencies):
+    values = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {'p50_ms': float(values[0]), 'p95_ms': float(values[1]), 'p99_ms': float(values[2])}
+
+
+def measure(step, frames, warmup, allocation_frames):
+    """
+    Run `step` on every frame, then again on a few frames with `tracemalloc` on.
+    :return: Dict with the throughput, the latency percentiles and the allocations per frame.
+    """
+    for frame in frames[:warmup]:
+        step(frame)
+
+    latencies = []
+    start = time.perf_counter()
+    for frame in frames:
+        now = time.perf_counter()
+        step(frame)
+        latencies.append(time.perf_counter() - now)
+    elapsed = time.perf_counter() - start
+
+    # separate pass, tracing allocations slows everything down
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    for frame in frames[:allocation_frames]:
+        step(frame)
+    statistics = tracemalloc.take_snapshot().compare_to(snapshot, 'filename')
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated = sum(max(0, stat.size_diff) for stat in statistics)
+    blocks = sum(max(0, stat.count_diff) for stat in statistics)
+
+    return dict(
+        fps=len(frames) / elapsed,
+        **percentiles(latencies),
+        allocated_bytes_per_frame=allocated / allocation_frames,
+        allocated_blocks_per_frame=blocks / allocation_frames,
+        traced_peak_bytes=peak,
+    )
+
+
+def run_case(case, frames_config):
+    """
+    Run one case, in its own process.
+    :param case: Process method, or `publish` for the encode/publish path.
+    :param frames_config: (video path or `None`, number of frames, width, height, seed).
+    """
+    from Camera import create_frame_processor, create_frame_publisher
+    from FrameTransport import Rendition
+    from Metrics import metrics
+
+    (video, count, width, height, seed) = frames_config
+    frames = video_frames(video, count, width, height) if video else synthetic_frames(count, width, height, seed)
+
+    if case == 'publish':
+        renditions = [Rendition('full', None, 90), Rendition('medium', 640, 80), Rendition('thumb', 160, 60)]
+        publisher = create_frame_publisher('redis', InProcessRedis(), locking=False, renditions=renditions)
+        step = publisher.publish
+    else:
+        processor = create_frame_processor(case, ReplayFrameProvider(frames))
+
+        def step(frame):
+            # processors draw on their input, keep the recorded frames intact
+            processor.process(frame.copy())
+
+    result = measure(step, frames, warmup=min(5, count), allocation_frames=min(10, count))
+    result['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    # per step latencies recorded by the processors, see Metrics.py
+    result['steps'] = {
+        labels.get('step', name): {
+            'p50_ms': histogram['quantiles']['0.5'] * 1000,
+            'p95_ms': histogram['quantiles']['0.95'] * 1000,
+            'p99_ms': histogram['quantiles']['0.99'] * 1000,
+        }
+        for (name, labels, histogram) in metrics.snapshot()['histograms']
+        if histogram['quantiles'] and name != 'camera_capture_seconds'
+    }
+    return result
+
+
+def run(cases, resolutions, video, count, seed):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for (width, height) in resolutions:
+        for case in cases:
+            entry = {'case': case, 'width': width, 'height': height}
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                try:
+                    entry.update(executor.submit(run_case, case, (video, count, width, height, seed)).result())
+                except Exception as e:
+                    entry['error'] = f'{type(e).__name__}: {e}'
+            print(f'{case} {width}x{height}: ' + (
+                entry['error'] if 'error' in entry else f'{entry["fps"]:.1f} frames/s, p99 {entry["p99_ms"]:.2f} ms'
+            ), file=sys.stderr)
+            results.append(entry)
+    return results
+
+
+if __name__ == '__main__':
+    from Camera import parse_size
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video', type=str, default=None, help='recorded video to replay, synthetic frames if not set')
+    parser.add_argument('--frames', type=int, default=100, help='number of frames per case')
+    parser.add_argument('--resolutions', type=parse_size, nargs='+',
+                        default=[(640, 360), (1280, 720), (1920, 1080)])
+    parser.add_argument('--cases', type=str, nargs='+', default=process_methods + ['publish'],
+                        help='process methods to run, and `publish` for the encode/publish path')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the JSON there instead of stdout')
+
+    args = parser.parse_args()
+
+    report = {
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'video': args.video,
+        'frames': args.frames,
+        'seed': args.seed,
+        'results': run(args.cases, args.resolutions, args.video, args.frames, args.seed),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
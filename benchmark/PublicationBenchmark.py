@@ -0,0 +1,82 @@
+"""
+Compare publishing frames to Redis with and without `redis_lock`.
+
+A writer thread publishes frames as fast as it can while reader threads fetch the latest frame the way the `jpg`
+view does. Run from the root of the repository with a Redis server up:
+
+    python -m benchmark.PublicationBenchmark --readers 16 --duration 10
+"""
+import threading
+import time
+
+import argparse
+import numpy as np
+import redis
+
+from FrameTransport import RedisFramePublisher, RedisFrameReader
+
+
+def percentile(samples, p):
+    return float(np.percentile(samples, p)) if samples else float('nan')
+
+
+def run(redis_client, locking, frame, readers, duration, read_interval):
+    """
+    Run one round of the benchmark.
+    :return: (published frames per second, read latencies in seconds)
+    """
+    key = 'benchmark:image'
+    publisher = RedisFramePublisher(redis_client, key, locking)
+    publisher.publish(frame)
+    stop = threading.Event()
+    published = [0]
+    latencies = []
+
+    def write():
+        while not stop.is_set():
+            publisher.publish(frame)
+            published[0] += 1
+
+    def read():
+        reader = RedisFrameReader(redis.StrictRedis(connection_pool=redis_client.connection_pool), key, locking)
+        samples = []
+        while not stop.is_set():
+            now = time.perf_counter()
+            reader.read()
+            samples.append(time.perf_counter() - now)
+            time.sleep(read_interval)
+        latencies.extend(samples)
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    redis_client.delete(key, f'{key}:seq')
+    return published[0] / duration, latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--readers', type=int, default=16, help='number of concurrent viewers')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per round')
+    parser.add_argument('--read-interval', type=float, default=0.05,
+                        help='pause between two reads of a viewer, the page refreshes every 50ms')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+
+    args = parser.parse_args()
+
+    r = redis.StrictRedis(host=args.host, port=args.port, db=0)
+    frame = np.random.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+
+    print(f'{"mode":<10}{"frames/s":>10}{"reads":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for (mode, locking) in [('lock', True), ('lock-free', False)]:
+        (fps, latencies) = run(r, locking, frame, args.readers, args.duration, args.read_interval)
+        print(f'{mode:<10}{fps:>10.1f}{len(latencies):>10}'
+              f'{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}')
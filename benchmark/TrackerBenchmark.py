@@ -0,0 +1,62 @@
+"""
+Compare `CentroidTracker` with `ArrayCentroidTracker` on synthetic scenes.
+
+Objects drift a few pixels per frame over a 1920x1080 frame, and a few of them are missed by the detector in every
+frame. Run from the root of the repository:
+
+    python -m benchmark.TrackerBenchmark --objects 10 100 1000
+"""
+import time
+
+import argparse
+import numpy as np
+
+from CentroidTracker import CentroidTracker, ArrayCentroidTracker
+
+
+def make_scene(objects, frames, miss_rate, seed=0):
+    """
+    :return: List of the rects seen in every frame.
+    """
+    rng = np.random.RandomState(seed)
+    positions = rng.uniform([0, 0], [1920, 1080], size=(objects, 2))
+    scene = []
+    for _ in range(frames):
+        positions += rng.normal(0, 3, size=positions.shape)
+        seen = positions[rng.uniform(size=objects) >= miss_rate]
+        scene.append(np.hstack([seen - 20, seen + 20]).astype("int"))
+    return scene
+
+
+def run(tracker, scene):
+    """
+    :return: Update latencies in seconds.
+    """
+    latencies = []
+    for rects in scene:
+        now = time.perf_counter()
+        tracker.update(list(rects))
+        latencies.append(time.perf_counter() - now)
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--miss-rate', type=float, default=0.05, help='fraction of the objects missed per frame')
+    parser.add_argument('--max-distance', type=float, default=50)
+
+    args = parser.parse_args()
+
+    print(f'{"objects":>8}  {"tracker":<22}{"mean ms":>10}{"p99 ms":>10}{"ids":>8}')
+    for objects in args.objects:
+        scene = make_scene(objects, args.frames, args.miss_rate)
+        trackers = [
+            ('CentroidTracker', CentroidTracker()),
+            ('ArrayCentroidTracker', ArrayCentroidTracker(maxDistance=args.max_distance)),
+        ]
+        for (name, tracker) in trackers:
+            latencies = np.array(run(tracker, scene)) * 1000
+            print(f'{objects:>8}  {name:<22}{latencies.mean():>10.3f}{np.percentile(latencies, 99):>10.3f}'
+                  f'{tracker.nextObjectID:>8}')
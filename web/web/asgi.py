@@ -0,0 +1,127 @@
+"""
+ASGI config for web project.
+
+Frames (`jpg` and `stream.mjpg`) are served by asyncio handlers sharing one Redis subscription per process, so a
+viewer does not hold a worker thread. Every other request goes to the Django WSGI application.
+
+Run it with an ASGI server from the `web` directory, e.g. ``uvicorn web.asgi:application``. The camera process must
+publish to Redis (the default transport of Camera.py).
+"""
+
+import asyncio
+import os
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from django.core.wsgi import get_wsgi_application
+import redis.asyncio
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
+
+# loading the Django application puts the repository root on `sys.path`, see settings.py
+django_application = WsgiToAsgi(get_wsgi_application())
+
+from django.conf import settings
+
+from FrameTransport import frame_key, rendition_key
+from Metrics import metrics
+from webweb.streaming import AsyncFrameHub, ViewerMarks, detection_headers, mjpeg_part
+
+frame_hub = None
+# same as `views.mark_viewed`, the cameras lower their frame rate when nobody watches them
+viewer_marks = ViewerMarks(settings.FRAME_VIEWER_TIMEOUT)
+
+
+def get_frame_hub():
+    # created on first use so that it is bound to the event loop of the server
+    global frame_hub
+    if frame_hub is None:
+        frame_hub = AsyncFrameHub(redis.asyncio.Redis(host='localhost', port=6379, db=0))
+    return frame_hub
+
+
+def get_query(scope, name):
+    value = parse_qs(scope['query_string'].decode()).get(name)
+    return None if value is None else value[0]
+
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def frame_published(scope):
+    # same as `views.frame_published`, the hub only keeps the frames of cameras publishing them
+    (key, rendition) = (frame_key(get_query(scope, 'camera')), get_query(scope, 'size'))
+    if (key, rendition) in get_frame_hub().cameras:
+        return True
+    return bool(await get_frame_hub().redis_client.exists(rendition_key(key, rendition)))
+
+
+async def send_not_found(send):
+    await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b'Not Found'})
+
+
+async def send_image(scope, send):
+    if not await frame_published(scope):
+        await send_not_found(send)
+        return
+    await viewer_marks.mark_async(get_frame_hub().redis_client, get_query(scope, 'camera'))
+    with metrics.timer('web_read_seconds', camera=get_query(scope, 'camera')):
+        (seq, img) = await get_frame_hub().latest_frame(
+            frame_key(get_query(scope, 'camera')), get_query(scope, 'size')
+        )
+    headers = [(b'content-type', b'image/jpg')]
+    status = 200
+    if seq is not None:
+        # same as `views.my_image`, idle cameras are answered with 304
+        etag = f'"{seq}"'.encode()
+        if_none_match = dict(scope['headers']).get(b'if-none-match', b'')
+        if etag in [tag.strip() for tag in if_none_match.split(b',')]:
+            (status, img) = (304, None)
+            metrics.inc('web_not_modified_total', camera=get_query(scope, 'camera'))
+        headers += [(b'etag', etag), (b'cache-control', b'no-cache')]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': img or b''})
+
+
+async def send_stream(scope, receive, send):
+    if not await frame_published(scope):
+        await send_not_found(send)
+        return
+    await send({
+        'type': 'http.response.start', 'status': 200,
+        'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame'), (b'cache-control', b'no-cache')]
+    })
+
+    # same as `views.my_stream`, `?detections=1` adds the detections of each frame to its part
+    with_detections = get_query(scope, 'detections') is not None
+
+    async def send_frames():
+        updates = get_frame_hub().updates(frame_key(get_query(scope, 'camera')), get_query(scope, 'size'))
+        async for (seq, img, detections) in updates:
+            part = mjpeg_part(img, headers=detection_headers(seq, detections) if with_detections else None)
+            await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+            metrics.inc('web_stream_frames_total', camera=get_query(scope, 'camera'))
+
+    # stop pushing frames as soon as the viewer goes away, the camera is marked as watched until then
+    sending = asyncio.ensure_future(send_frames())
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    marking = asyncio.ensure_future(
+        viewer_marks.keep_marked(get_frame_hub().redis_client, get_query(scope, 'camera'))
+    )
+    await asyncio.wait([sending, disconnected], return_when=asyncio.FIRST_COMPLETED)
+    for task in (sending, disconnected, marking):
+        task.cancel()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == '/stream.mjpg':
+        await send_stream(scope, receive, send)
+    elif scope['type'] == 'http' and 'jpg' in scope['path']:
+        # same as the `jpg` pattern in urls.py
+        with metrics.timer('web_request_seconds', view='jpg'):
+            await send_image(scope, send)
+    else:
+        await django_application(scope, receive, send)
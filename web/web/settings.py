@@ -11,10 +11,14 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# The modules shared with the camera process (e.g. FrameTransport) live at the root of the repository
+sys.path.insert(0, os.path.dirname(BASE_DIR))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.1/howto/deployment/checklist/
@@ -119,3 +123,30 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# How frames get from the camera process to the web server, must match the transport of Camera.py:
+# 'redis' for JPEG frames in Redis, 'shm' for raw frames in shared memory encoded on demand
+FRAME_TRANSPORT = 'redis'
+
+# Whether 'redis' frames are read under a redis_lock, set to False together with `--lock-free` of Camera.py
+FRAME_LOCKING = True
+
+# Renditions selectable by `jpg?size=<name>` when frames are encoded by the web server ('shm' transport), the
+# 'redis' transport serves the renditions configured for the camera in CameraSupervisor.py
+FRAME_RENDITIONS = [
+    {'name': 'full'},
+    {'name': 'medium', 'width': 640, 'quality': 80},
+    {'name': 'thumb', 'width': 160, 'quality': 60},
+]
+
+# Whether the page draws the detections over the video, set to True together with `--overlay client` of Camera.py
+FRAME_CLIENT_OVERLAY = False
+
+# Seconds a camera counts as watched after its last `jpg` request or streamed frame, cameras with an adaptive frame
+# rate slow down once nobody has watched them for that long
+FRAME_VIEWER_TIMEOUT = 10
+
+# Directory the camera processes record their clips in, see `--record` of Camera.py and `recordings` of
+# CameraSupervisor.py (relative paths there are relative to the directory the camera process is started in)
+FRAME_RECORDINGS = os.path.join(os.path.dirname(BASE_DIR), 'recordings')
+
@@ -16,7 +16,8 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from django.conf.urls import url
-from webweb.views import index, user_logout, user_login, user_register, my_image, user_reset
+from webweb.views import index, user_logout, user_login, user_register, my_image, user_reset, my_stream, my_metrics, \
+    my_detections, my_events, my_clip, my_clip_frame, my_detection_history
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
@@ -25,5 +26,13 @@ urlpatterns = [
     url(r'^login$', user_login),
     url(r'^register$', user_register),
     url(r'^reset$', user_reset),
+    url(r'^metrics$', my_metrics),
+    url(r'^detections$', my_detections),
+    url(r'^detections/history$', my_detection_history),
+    url(r'^events$', my_events),
+    url(r'^clip$', my_clip),
+    url(r'^clip/frame$', my_clip_frame),
+    # must come before `jpg`, which matches any path containing it
+    url(r'^stream\.mjpg$', my_stream),
     url(r'jpg', my_image),
 ]
@@ -0,0 +1,73 @@
+import json
+import time
+
+import redis
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from DetectionLog import DetectionLog
+from webweb.models import DetectionEvent
+
+
+class Command(BaseCommand):
+    help = 'Move the detections pushed by the camera processes (DetectionLog) from Redis into the database.'
+
+    # rows taken from `DetectionLog.key`, removed from here batch by batch once stored
+    processing_key = DetectionLog.key + ':processing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='rows taken from Redis per transaction')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to wait when there are no rows')
+        parser.add_argument('--once', action='store_true', help='stop once there are no rows left')
+
+    def handle(self, *args, **options):
+        r = redis.StrictRedis(host='localhost', port=6379, db=0)
+        batch_size = options['batch_size']
+        # a previous run stopped before clearing its last batch, which may be stored already
+        recovering = bool(r.exists(self.processing_key))
+        while True:
+            if not r.exists(self.processing_key) and not self.take_rows(r):
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            rows = r.lrange(self.processing_key, 0, batch_size - 1)
+            events = []
+            for row in rows:
+                try:
+                    events.append(DetectionEvent.from_row(json.loads(row)))
+                except (ValueError, TypeError, KeyError) as e:
+                    self.stderr.write(f'skipped malformed detection {row[:200]!r}: {e}')
+            if recovering and events and self.stored(events[-1]):
+                self.stdout.write(f'skipped {len(events)} detections stored before the last stop')
+            elif events:
+                with transaction.atomic():
+                    DetectionEvent.objects.bulk_create(events, batch_size=500)
+                self.stdout.write(f'ingested {len(events)} detections')
+            recovering = False
+            # the list is deleted by Redis once empty
+            r.ltrim(self.processing_key, len(rows), -1)
+
+    def take_rows(self, r):
+        """
+        Take all the rows pushed so far at once, the camera processes go on appending to a new list. Only one
+        instance of the command may run.
+        :return: Whether there were rows.
+        """
+        try:
+            return r.renamenx(DetectionLog.key, self.processing_key)
+        except redis.ResponseError:
+            # no such key, nothing was pushed
+            return False
+
+    @staticmethod
+    def stored(event):
+        """
+        :return: Whether the batch ending with an event is in the database, batches are stored in one transaction.
+        """
+        return DetectionEvent.objects.filter(
+            camera=event.camera, timestamp=event.timestamp, kind=event.kind, label=event.label,
+            track_id=event.track_id, start_x=event.start_x, start_y=event.start_y, end_x=event.end_x,
+            end_y=event.end_y,
+        ).exists()
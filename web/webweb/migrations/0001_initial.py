@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectionEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('camera', models.CharField(blank=True, max_length=64)),
+                ('timestamp', models.FloatField()),
+                ('kind', models.CharField(choices=[('detection', 'detection'), ('track_start', 'track start'), ('track_end', 'track end')], default='detection', max_length=16)),
+                ('label', models.CharField(blank=True, max_length=64)),
+                ('confidence', models.FloatField(blank=True, null=True)),
+                ('start_x', models.IntegerField(blank=True, null=True)),
+                ('start_y', models.IntegerField(blank=True, null=True)),
+                ('end_x', models.IntegerField(blank=True, null=True)),
+                ('end_y', models.IntegerField(blank=True, null=True)),
+                ('track_id', models.IntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='detectionevent',
+            index=models.Index(fields=['camera', 'timestamp'], name='detection_camera_time'),
+        ),
+        migrations.AddIndex(
+            model_name='detectionevent',
+            index=models.Index(fields=['camera', 'label', 'timestamp'], name='detection_camera_label_time'),
+        ),
+        migrations.AddIndex(
+            model_name='detectionevent',
+            index=models.Index(fields=['label', 'timestamp'], name='detection_label_time'),
+        ),
+    ]
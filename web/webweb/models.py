@@ -1,3 +1,51 @@
 from django.db import models
 
-# Create your models here.
+
+class DetectionEvent(models.Model):
+    """
+    Detection or track event of a camera, written in bulk by the `ingest_detections` command from the rows the camera
+    processes push with `DetectionLog`.
+
+    Queries select a camera and a time range, and usually a label, so both go first in the indexes and the matching
+    rows are read off a single range of an index, whatever the size of the table.
+    """
+
+    KINDS = (
+        ('detection', 'detection'),
+        ('track_start', 'track start'),
+        ('track_end', 'track end'),
+    )
+
+    # id of the camera, empty for the single camera started by `Camera.py`
+    camera = models.CharField(max_length=64, blank=True)
+    # seconds since the epoch, like the timestamps of the recorded events
+    timestamp = models.FloatField()
+    kind = models.CharField(max_length=16, choices=KINDS, default='detection')
+    # empty for track events, the tracked objects carry no label
+    label = models.CharField(max_length=64, blank=True)
+    confidence = models.FloatField(null=True, blank=True)
+    # box (start x, start y, end x, end y) in pixels, track events have their centroid as both corners
+    start_x = models.IntegerField(null=True, blank=True)
+    start_y = models.IntegerField(null=True, blank=True)
+    end_x = models.IntegerField(null=True, blank=True)
+    end_y = models.IntegerField(null=True, blank=True)
+    track_id = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['camera', 'timestamp'], name='detection_camera_time'),
+            models.Index(fields=['camera', 'label', 'timestamp'], name='detection_camera_label_time'),
+            models.Index(fields=['label', 'timestamp'], name='detection_label_time'),
+        ]
+
+    @staticmethod
+    def from_row(row):
+        """
+        :param row: Dict pushed by `DetectionLog`.
+        """
+        (start_x, start_y, end_x, end_y) = row.get('box') or (None, None, None, None)
+        return DetectionEvent(
+            camera=row.get('camera') or '', timestamp=row['time'], kind=row.get('kind', 'detection'),
+            label=row.get('label') or '', confidence=row.get('confidence'), start_x=start_x, start_y=start_y,
+            end_x=end_x, end_y=end_y, track_id=row.get('track_id'),
+        )
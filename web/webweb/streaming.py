@@ -0,0 +1,288 @@
+import asyncio
+import threading
+import time
+
+from FrameTransport import rendition_key, viewer_key
+
+
+class FrameBroadcaster:
+    """
+    Push the frames of one camera to all of its viewers.
+
+    A single thread polls the frame reader while there are viewers and wakes them up when a new frame is published,
+    so the transport is read once per frame instead of once per viewer. `idle_seconds` tells how long it has had no
+    viewers, so that unused broadcasters can be dropped.
+    """
+
+    def __init__(self, frame_reader, poll_interval=0.01, with_detections=False):
+        """
+        :param frame_reader: `FrameTransport.FrameReader` of the camera.
+        :param poll_interval: Time in seconds between two polls of the reader.
+        :param with_detections: Whether to read the detections along with the frames, see `updates`. Only for
+            `FrameTransport.RedisFrameReader`.
+        """
+        self.frame_reader = frame_reader
+        self.poll_interval = poll_interval
+        self.with_detections = with_detections
+        self.condition = threading.Condition()
+        self.viewers = 0
+        self.idle_since = time.monotonic()
+        self.polling = False
+        self.version = 0
+        self.seq = None
+        self.img = None
+        self.detections = None
+
+    def poll(self):
+        while True:
+            with self.condition:
+                if self.viewers == 0:
+                    self.polling = False
+                    return
+
+            if self.with_detections:
+                (seq, img, detections) = self.frame_reader.read_with_detections()
+            else:
+                ((seq, img), detections) = (self.frame_reader.read(), None)
+            if img is not None and (seq != self.seq or (seq is None and img != self.img)):
+                with self.condition:
+                    self.seq = seq
+                    self.img = img
+                    self.detections = detections
+                    self.version += 1
+                    self.condition.notify_all()
+            time.sleep(self.poll_interval)
+
+    def frames(self):
+        """
+        Generate the JPEG data of the frames as they are published, until the viewer disconnects.
+        """
+        updates = self.updates()
+        try:
+            for (_, img, _) in updates:
+                yield img
+        finally:
+            updates.close()
+
+    def updates(self):
+        """
+        Same as `frames`, with the sequence number and the detections of each frame.
+        :return: Generator of (sequence number, JPEG data, JSON detections or `None`).
+        """
+        with self.condition:
+            self.viewers += 1
+            if not self.polling:
+                self.polling = True
+                threading.Thread(target=self.poll, daemon=True).start()
+
+        try:
+            version = 0
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.version != version)
+                    version = self.version
+                    update = (self.seq, self.img, self.detections)
+                yield update
+        finally:
+            with self.condition:
+                self.viewers -= 1
+                if self.viewers == 0:
+                    self.idle_since = time.monotonic()
+
+    def idle_seconds(self):
+        """
+        :return: Time in seconds since the last viewer left, 0 while there are viewers.
+        """
+        with self.condition:
+            return 0 if self.viewers else time.monotonic() - self.idle_since
+
+
+class ViewerMarks:
+    """
+    Tell the camera processes someone is watching them, see `FrameScheduler.AdaptiveFrameScheduler`. Shared by the
+    WSGI views and the ASGI handlers, the viewer key of a camera is refreshed at most once per `interval` seconds.
+    """
+
+    def __init__(self, timeout, interval=1.0):
+        """
+        :param timeout: Time in seconds the key lives, the camera is unwatched once it expires.
+        :param interval: Shortest time in seconds between two refreshes of the key of a camera.
+        """
+        self.timeout = timeout
+        self.interval = interval
+        self.marks = {}
+
+    def due(self, camera):
+        now = time.monotonic()
+        if now - self.marks.get(camera, 0) < self.interval:
+            return False
+        self.marks[camera] = now
+        return True
+
+    def mark(self, redis_client, camera):
+        """
+        :param redis_client: Connection to the Redis server.
+        :param camera: Id of the camera, `None` for the single camera started by `Camera.py`.
+        """
+        if self.due(camera):
+            redis_client.set(viewer_key(camera), 1, ex=self.timeout)
+
+    async def mark_async(self, redis_client, camera):
+        """
+        Same as `mark` with an asyncio connection (`redis.asyncio.Redis`).
+        """
+        if self.due(camera):
+            await redis_client.set(viewer_key(camera), 1, ex=self.timeout)
+
+    async def keep_marked(self, redis_client, camera):
+        """
+        Keep the key of a camera alive until cancelled, e.g. while a stream is open, new frames or not.
+        """
+        while True:
+            await self.mark_async(redis_client, camera)
+            await asyncio.sleep(self.interval)
+
+
+def mjpeg_part(img, boundary='frame', headers=None):
+    """
+    Wrap a JPEG frame into a part of a `multipart/x-mixed-replace` response.
+    :param headers: Extra headers of the part, e.g. `X-Detections`.
+    """
+    extra = ''.join(f'{name}: {value}\r\n' for (name, value) in (headers or {}).items())
+    head = f'--{boundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(img)}\r\n{extra}\r\n'
+    return head.encode() + img + b'\r\n'
+
+
+def detection_headers(seq, detections):
+    """
+    Headers of a part carrying the detections of its frame, read by the page to draw them over that very frame.
+    :param detections: JSON data from `Detections.detections_to_json`, `None` if the camera sends none.
+    """
+    headers = {'X-Sequence': '' if seq is None else seq}
+    if detections is not None:
+        headers['X-Detections'] = detections.decode() if isinstance(detections, bytes) else detections
+    return headers
+
+
+def mjpeg_parts(frames, boundary='frame'):
+    """
+    Wrap JPEG frames into the parts of a `multipart/x-mixed-replace` response.
+    """
+    for img in frames:
+        yield mjpeg_part(img, boundary)
+
+
+class AsyncCameraFrames:
+    def __init__(self, key, rendition):
+        """
+        :param key: Key the frames of the camera are published under, see `FrameTransport.frame_key`.
+        :param rendition: Name of the rendition.
+        """
+        self.key = key
+        self.img_key = rendition_key(key, rendition)
+        self.viewers = 0
+        self.version = 0
+        self.seq = None
+        self.img = None
+        self.detections = None
+        self.condition = asyncio.Condition()
+
+
+class AsyncFrameHub:
+    """
+    Fan the frames published by `FrameTransport.RedisFramePublisher` out to the viewers of an asyncio web server.
+
+    The hub holds one pattern subscription to the `<key>:notify` channels for the whole process. When a camera with
+    viewers publishes a frame, the hub fetches it once and wakes all of them, so the number of Redis requests does not
+    grow with the number of viewers.
+    """
+
+    def __init__(self, redis_client, channel_pattern='image*:notify'):
+        """
+        :param redis_client: Asyncio connection to the Redis server (`redis.asyncio.Redis`).
+        :param channel_pattern: Pattern matching the notification channels of all the cameras.
+        """
+        self.redis_client = redis_client
+        self.channel_pattern = channel_pattern
+        self.cameras = {}
+        self.listener = None
+
+    def camera(self, key, rendition):
+        if (key, rendition) not in self.cameras:
+            self.cameras[(key, rendition)] = AsyncCameraFrames(key, rendition)
+        return self.cameras[(key, rendition)]
+
+    async def listen(self):
+        pubsub = self.redis_client.pubsub()
+        await pubsub.psubscribe(self.channel_pattern)
+        async for message in pubsub.listen():
+            if message['type'] != 'pmessage':
+                continue
+            key = message['channel'].decode()[:-len(':notify')]
+            for camera in list(self.cameras.values()):
+                if camera.key == key and camera.viewers > 0:
+                    await self.fetch(camera)
+
+    async def fetch(self, camera):
+        # the detections come along, `MGET` reads them together with the frame they belong to
+        (img, seq, detections) = await self.redis_client.mget(
+            camera.img_key, f'{camera.key}:seq', f'{camera.key}:detections'
+        )
+        if img is None:
+            return
+        async with camera.condition:
+            camera.seq = None if seq is None else int(seq)
+            camera.img = img
+            camera.detections = detections
+            camera.version += 1
+            camera.condition.notify_all()
+
+    def start(self):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.ensure_future(self.listen())
+
+    async def latest_frame(self, key, rendition=None):
+        """
+        Get the most recently published frame of a camera.
+        :param key: Key the frames are published under, see `FrameTransport.frame_key`.
+        :param rendition: Name of the rendition, the full resolution one by default.
+        :return: (sequence number, JPEG data)
+        """
+        camera = self.camera(key, rendition)
+        # frames are only kept up to date while someone is watching the stream
+        if camera.viewers == 0 or camera.img is None:
+            await self.fetch(camera)
+        return camera.seq, camera.img
+
+    async def frames(self, key, rendition=None):
+        """
+        Generate the JPEG data of the frames of a camera as they are published.
+        :param key: Key the frames are published under, see `FrameTransport.frame_key`.
+        :param rendition: Name of the rendition, the full resolution one by default.
+        """
+        updates = self.updates(key, rendition)
+        try:
+            async for (_, img, _) in updates:
+                yield img
+        finally:
+            await updates.aclose()
+
+    async def updates(self, key, rendition=None):
+        """
+        Same as `frames`, with the sequence number and the detections of each frame.
+        :return: Async generator of (sequence number, JPEG data, JSON detections or `None`).
+        """
+        self.start()
+        camera = self.camera(key, rendition)
+        camera.viewers += 1
+        try:
+            await self.fetch(camera)
+            version = 0
+            while True:
+                async with camera.condition:
+                    await camera.condition.wait_for(lambda: camera.version != version)
+                    version = camera.version
+                    update = (camera.seq, camera.img, camera.detections)
+                yield update
+        finally:
+            camera.viewers -= 1
@@ -1,14 +1,93 @@
 from django.shortcuts import render
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, Http404, HttpResponseRedirect
+from django.http import HttpResponse, Http404, HttpResponseRedirect, StreamingHttpResponse, HttpResponseNotModified
+from django.http import JsonResponse
 from django.contrib.auth import logout,authenticate, login
 from django.contrib.auth.models import User
+from django.conf import settings
+import json
+import datetime
+import os
+import tempfile
+from django.utils import timezone
 import redis
-import redis_lock
+from FrameTransport import RedisFrameReader, SharedMemoryFrameReader, Rendition, frame_key, rendition_key
+from FrameTransport import shared_frame_path
+from Metrics import metrics, render, read_published_snapshots
+from EventRecorder import ClipIndex, read_events, clip_path, parse_range, read_chunks
+from webweb.models import DetectionEvent
+from webweb.streaming import FrameBroadcaster, ViewerMarks, detection_headers, mjpeg_part, mjpeg_parts
 r = redis.StrictRedis(host='localhost', port=6379, db=0)
 # the first image fetch is slow, so we put it here
-with redis_lock.Lock(r, "image"):
-    img = r.get('image')
+img = RedisFrameReader(r, frame_key(), settings.FRAME_LOCKING).read()
+
+renditions = {rendition['name']: Rendition.from_config(rendition) for rendition in settings.FRAME_RENDITIONS}
+
+frame_readers = {}
+
+
+def frame_published(camera, size=Rendition.full):
+    """
+    :return: Whether a camera publishes frames in a rendition, only those get a reader or a broadcaster so that
+        arbitrary query parameters do not fill the caches.
+    """
+    if settings.FRAME_TRANSPORT == 'shm':
+        path = shared_frame_path(camera)
+        return size in renditions and os.path.dirname(path) == tempfile.gettempdir() and os.path.exists(path)
+    return bool(r.exists(rendition_key(frame_key(camera), size)))
+
+
+def get_frame_reader(camera, size=Rendition.full):
+    """
+    Get the reader of a camera, readers are kept for the whole process so encoded frames are shared by all the viewers.
+    :param camera: Id of the camera, `None` for the single camera started by `Camera.py`.
+    :param size: Name of the rendition.
+    :raise Http404: If the camera does not publish frames in that rendition.
+    """
+    if (camera, size) not in frame_readers:
+        if not frame_published(camera, size):
+            raise Http404
+        if settings.FRAME_TRANSPORT == 'shm':
+            reader = SharedMemoryFrameReader(shared_frame_path(camera), rendition=renditions[size])
+        else:
+            reader = RedisFrameReader(r, frame_key(camera), settings.FRAME_LOCKING, size)
+        frame_readers.setdefault((camera, size), reader)
+    return frame_readers[(camera, size)]
+
+
+frame_broadcasters = {}
+# seconds a broadcaster without viewers is kept
+broadcaster_idle_timeout = 60
+
+
+def get_frame_broadcaster(camera, size=Rendition.full, with_detections=False):
+    """
+    Get the broadcaster of a camera, shared by all the viewers of its stream.
+    :param camera: Id of the camera, `None` for the single camera started by `Camera.py`.
+    :param size: Name of the rendition.
+    :param with_detections: Whether the broadcaster reads the detections along with the frames.
+    :raise Http404: If the camera does not publish frames in that rendition.
+    """
+    for (key, broadcaster) in list(frame_broadcasters.items()):
+        if broadcaster.idle_seconds() > broadcaster_idle_timeout:
+            frame_broadcasters.pop(key, None)
+    key = (camera, size, with_detections)
+    if key not in frame_broadcasters:
+        frame_broadcasters.setdefault(
+            key, FrameBroadcaster(get_frame_reader(camera, size), with_detections=with_detections)
+        )
+    return frame_broadcasters[key]
+
+
+viewer_marks = ViewerMarks(settings.FRAME_VIEWER_TIMEOUT)
+
+
+def mark_viewed(camera):
+    """
+    Tell the camera process someone is watching the camera, see `webweb.streaming.ViewerMarks`.
+    :param camera: Id of the camera, `None` for the single camera started by `Camera.py`.
+    """
+    viewer_marks.mark(r, camera)
 
 
 # Create your views here.
@@ -16,7 +95,9 @@ def index(request):
     error = "" if 'error' not in request.session else request.session['error']
     if 'error' in request.session:
         del request.session['error']
-    return render_to_response("index.html", {'logged_in': request.user.is_authenticated, 'error':error})
+    return render_to_response("index.html", {
+        'logged_in': request.user.is_authenticated, 'error':error, 'client_overlay': settings.FRAME_CLIENT_OVERLAY
+    })
 
 
 def user_logout(request):
@@ -72,8 +153,186 @@ def user_reset(request):
     
     
 def my_image(request):
-    print('img!')
-    img = None
-    with redis_lock.Lock(r, "image"):
-        img = r.get('image')
-    return HttpResponse(img, content_type="image/jpg")
\ No newline at end of file
+    with metrics.timer('web_request_seconds', view='jpg'):
+        # cameras of `CameraSupervisor.py` are selected by `?camera=<id>`, renditions by `?size=<name>`
+        reader = get_frame_reader(request.GET.get('camera'), request.GET.get('size', Rendition.full))
+        mark_viewed(request.GET.get('camera'))
+        with metrics.timer('web_read_seconds', camera=request.GET.get('camera')):
+            (seq, img) = reader.read()
+        if seq is None:
+            return HttpResponse(img, content_type="image/jpg")
+
+        # the sequence number only changes when a new frame is published, idle cameras are answered with 304
+        etag = f'"{seq}"'
+        if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+            metrics.inc('web_not_modified_total', camera=request.GET.get('camera'))
+        else:
+            response = HttpResponse(img, content_type="image/jpg")
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+def counted_frames(frames, camera):
+    for frame in frames:
+        metrics.inc('web_stream_frames_total', camera=camera)
+        mark_viewed(camera)
+        yield frame
+
+
+def my_stream(request):
+    # one long-lived response per viewer, each new frame is pushed as a part of a multipart (MJPEG) stream;
+    # `?detections=1` adds the sequence number and the detections of each frame to its part, for the client overlay
+    camera = request.GET.get('camera')
+    size = request.GET.get('size', Rendition.full)
+    if 'detections' in request.GET:
+        if settings.FRAME_TRANSPORT != 'redis':
+            raise Http404
+        broadcaster = get_frame_broadcaster(camera, size, with_detections=True)
+        parts = (
+            mjpeg_part(img, headers=detection_headers(seq, detections))
+            for (seq, img, detections) in counted_frames(broadcaster.updates(), camera)
+        )
+    else:
+        parts = mjpeg_parts(counted_frames(get_frame_broadcaster(camera, size).frames(), camera))
+    return StreamingHttpResponse(parts, content_type="multipart/x-mixed-replace; boundary=frame")
+
+
+def my_detections(request):
+    # detections of the latest frame, without the frame, see `Detections.detections_to_json`
+    if settings.FRAME_TRANSPORT != 'redis':
+        raise Http404
+    camera = request.GET.get('camera')
+    (seq, detections) = RedisFrameReader(r, frame_key(camera), settings.FRAME_LOCKING).read_detections()
+    data = json.loads(detections) if detections is not None else {'detections': []}
+    data['seq'] = seq
+    return JsonResponse(data)
+
+
+def my_metrics(request):
+    # metrics of this web server process and of the camera processes, see `Metrics.MetricsPublisher`
+    snapshots = [metrics.snapshot()] + read_published_snapshots(r)
+    return HttpResponse(render(snapshots), content_type="text/plain; version=0.0.4")
+
+
+def float_param(request, name):
+    value = request.GET.get(name)
+    try:
+        return None if value is None else float(value)
+    except ValueError:
+        raise Http404
+
+
+def my_events(request):
+    # recorded events of a camera, filtered by `start`, `end` (timestamps) and `label`, see `EventRecorder`
+    try:
+        events = read_events(
+            settings.FRAME_RECORDINGS, request.GET.get('camera'), float_param(request, 'start'),
+            float_param(request, 'end'), request.GET.get('label')
+        )
+    except ValueError:
+        raise Http404
+    return JsonResponse({'events': events})
+
+
+def open_clip(request):
+    try:
+        path = clip_path(settings.FRAME_RECORDINGS, request.GET.get('camera'), request.GET.get('event'))
+        return path, ClipIndex(path + '.idx')
+    except (ValueError, OSError):
+        raise Http404
+
+
+def my_clip(request):
+    # MJPEG clip of an event from the frame at `t` (timestamp) on, the whole clip by default; single ranges of bytes
+    # of it are served for players that seek
+    (path, index) = open_clip(request)
+    if len(index) == 0:
+        raise Http404
+    (_, start, _) = index.frame(index.find(float_param(request, 't') or 0))
+    (_, offset, length) = index.frame(len(index) - 1)
+    size = offset + length - start
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        (first, last) = (0, size - 1)
+        response = StreamingHttpResponse(read_chunks(path, start, start + last), content_type='video/x-motion-jpeg')
+    else:
+        (first, last) = byte_range
+        response = StreamingHttpResponse(
+            read_chunks(path, start + first, start + last), status=206, content_type='video/x-motion-jpeg'
+        )
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    response['Content-Length'] = str(last - first + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def my_clip_frame(request):
+    # single frame of an event at `t` (timestamp), looked up in the index of the clip
+    (path, index) = open_clip(request)
+    if len(index) == 0:
+        raise Http404
+    (timestamp, offset, length) = index.frame(index.find(float_param(request, 't') or 0))
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        img = f.read(length)
+    response = HttpResponse(img, content_type="image/jpg")
+    response['X-Frame-Timestamp'] = str(timestamp)
+    return response
+
+
+def time_param(request, name):
+    # seconds since the epoch, or ISO 8601 like `2020-05-01T14:00`, in TIME_ZONE unless the offset is given
+    value = request.GET.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise Http404
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment.timestamp()
+
+
+def my_detection_history(request):
+    # stored detections and track events, e.g. `?camera=3&label=person&start=2020-05-01T14:00&end=2020-05-01T15:00`,
+    # see `DetectionLog` and the `ingest_detections` command; at most `limit` rows, oldest first. Detections are
+    # sampled about once a second, plus every label or object id as it appears
+    events = DetectionEvent.objects.filter(camera=request.GET.get('camera') or '')
+    if 'label' in request.GET:
+        events = events.filter(label=request.GET['label'])
+    if 'kind' in request.GET:
+        events = events.filter(kind=request.GET['kind'])
+    (start, end) = (time_param(request, 'start'), time_param(request, 'end'))
+    if start is not None:
+        events = events.filter(timestamp__gte=start)
+    if end is not None:
+        events = events.filter(timestamp__lt=end)
+    try:
+        limit = min(int(request.GET.get('limit', 1000)), 10000)
+    except ValueError:
+        raise Http404
+    if limit < 0:
+        raise Http404
+
+    fields = ['timestamp', 'kind', 'label', 'confidence', 'start_x', 'start_y', 'end_x', 'end_y', 'track_id']
+    rows = events.order_by('timestamp').values_list(*fields)[:limit]
+    return JsonResponse({'events': [
+        {
+            'time': timestamp, 'kind': kind, 'label': label, 'confidence': confidence,
+            'box': None if start_x is None else [start_x, start_y, end_x, end_y], 'track_id': track_id,
+        }
+        for (timestamp, kind, label, confidence, start_x, start_y, end_x, end_y, track_id) in rows
+    ]})